@@ -0,0 +1,250 @@
+"""
+    fleet.py
+    A stand-in for a fleet of geth nodes and the chain tip services, served
+    from one local HTTP server. Node i answers JSON-RPC at /node/<i>/.
+"""
+
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeNode(object):
+    """One simulated geth node. Its height follows the fleet's tip unless it
+    is stalled; a stall ends after `stall_seconds` or when the node is
+    restarted, after which it syncs back up at `catchup_rate` blocks/sec."""
+
+    def __init__(self, fleet, index, rng):
+        self.fleet = fleet
+        self.index = index
+        self.lag = rng.randint(0, 1)
+        self.peers = rng.randint(8, 50)
+        self.stall_at = None
+        self.frozen = None
+        self.recovering_from = None
+        self.drop_at = None
+        self.restarts = 0
+        duration = fleet.duration
+        if rng.random() < fleet.stall_rate:
+            self.stall_at = fleet.started + rng.uniform(0, duration / 2)
+        if rng.random() < fleet.peer_drop_rate:
+            self.drop_at = fleet.started + rng.uniform(0, duration / 2)
+        self.lock = threading.Lock()
+
+    def height(self, now):
+        tip = self.fleet.tip(now) - self.lag
+        with self.lock:
+            if self.stall_at is not None and now >= self.stall_at:
+                if self.frozen is None:
+                    self.frozen = self.fleet.tip(self.stall_at) - self.lag
+                if now < self.stall_at + self.fleet.stall_seconds:
+                    return self.frozen
+                self._recover(self.stall_at + self.fleet.stall_seconds)
+            if self.recovering_from is not None:
+                height, since = self.recovering_from
+                caught_up = height + int((now - since) * self.fleet.catchup_rate)
+                if caught_up < tip:
+                    return caught_up
+                self.recovering_from = None
+        return tip
+
+    def syncing(self, now):
+        height = self.height(now)
+        with self.lock:
+            recovering_from = self.recovering_from
+        if recovering_from is None:
+            return False
+        return {
+            'startingBlock': hex(recovering_from[0]),
+            'currentBlock': hex(height),
+            'highestBlock': hex(self.fleet.tip(now))
+        }
+
+    def peer_count(self, now):
+        if self.drop_at is not None and self.drop_at <= now < self.drop_at + self.fleet.peer_drop_seconds:
+            return 0
+        return self.peers
+
+    def restart(self, now):
+        with self.lock:
+            self.restarts += 1
+            if self.frozen is not None:
+                self._recover(now)
+            self.drop_at = None
+
+    def _recover(self, now):
+        self.recovering_from = (self.frozen, now)
+        self.frozen = None
+        self.stall_at = None
+
+
+class Fleet(object):
+
+    def __init__(self, nodes, duration=60, block_time=12.0, latency_ms=20, jitter_ms=10,
+            stall_rate=0.02, stall_seconds=120, catchup_rate=50,
+            timeout_rate=0.001, timeout_seconds=15, error_rate=0.005,
+            peer_drop_rate=0.02, peer_drop_seconds=120, seed=1):
+        self.started = time.time()
+        self.duration = duration
+        self.genesis = 10000000
+        self.block_time = block_time
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.catchup_rate = catchup_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_seconds = timeout_seconds
+        self.error_rate = error_rate
+        self.peer_drop_rate = peer_drop_rate
+        self.peer_drop_seconds = peer_drop_seconds
+        self.rng = random.Random(seed)
+        self.nodes = [FakeNode(self, i, self.rng) for i in range(nodes)]
+        self.counters = {
+            'http_requests': 0,
+            'batches': 0,
+            'rpc_calls': 0,
+            'injected_timeouts': 0,
+            'injected_errors': 0,
+            'restarts': 0,
+            'tip_requests': 0
+        }
+        self.methods = {}
+        self.lock = threading.Lock()
+
+    def tip(self, now):
+        return self.genesis + int((now - self.started) / self.block_time)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def count_method(self, method):
+        with self.lock:
+            self.methods[method] = self.methods.get(method, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['methods'] = dict(self.methods)
+        stats['stalls'] = len([n for n in self.nodes if n.frozen is not None])
+        return stats
+
+    def answer(self, node, request, now):
+        method = request.get('method')
+        self.count_method(method)
+        reply = { 'jsonrpc': '2.0', 'id': request.get('id') }
+        if method == 'eth_blockNumber':
+            reply['result'] = hex(node.height(now))
+        elif method == 'eth_syncing':
+            reply['result'] = node.syncing(now)
+        elif method == 'net_peerCount':
+            reply['result'] = hex(node.peer_count(now))
+        else:
+            reply['error'] = { 'code': -32601, 'message': 'the method %s does not exist' % method }
+        return reply
+
+
+class FleetHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    fleet = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        fleet = self.fleet
+        fleet.count('http_requests')
+        url = urllib.parse.urlparse(self.path)
+        now = time.time()
+        if url.path.startswith('/etherscan'):
+            fleet.count('tip_requests')
+            self._json(200, { 'status': '1', 'message': 'OK', 'result': hex(fleet.tip(now)) })
+        elif url.path.startswith('/etherchain'):
+            fleet.count('tip_requests')
+            self._json(200, { 'recordsTotal': fleet.tip(now) })
+        elif url.path == '/restart':
+            self._restart(urllib.parse.parse_qs(url.query).get('node', [''])[0], now)
+        elif url.path == '/stats':
+            self._json(200, fleet.stats())
+        else:
+            self._json(404, { 'error': 'not found' })
+
+    def do_POST(self):
+        fleet = self.fleet
+        fleet.count('http_requests')
+        length = int(self.headers.get('content-length', 0))
+        body = self.rfile.read(length)
+        now = time.time()
+        path = self.path.strip('/').split('/')
+        if path[0] == 'infura':
+            fleet.count('tip_requests')
+            request = json.loads(body)
+            self._json(200, { 'jsonrpc': '2.0', 'id': request.get('id'), 'result': hex(fleet.tip(now)) })
+            return
+        if path[0] != 'node' or len(path) < 2 or not path[1].isdigit() or int(path[1]) >= len(fleet.nodes):
+            self._json(404, { 'error': 'no such node' })
+            return
+        node = fleet.nodes[int(path[1])]
+
+        delay = max(0, fleet.rng.gauss(fleet.latency, fleet.jitter))
+        if fleet.rng.random() < fleet.timeout_rate:
+            fleet.count('injected_timeouts')
+            delay = fleet.timeout_seconds
+        time.sleep(delay)
+        if fleet.rng.random() < fleet.error_rate:
+            fleet.count('injected_errors')
+            self._send(502, 'text/html', b'<html><body><h1>502 Bad Gateway</h1></body></html>')
+            return
+
+        request = json.loads(body)
+        if isinstance(request, list):
+            fleet.count('batches')
+            fleet.count('rpc_calls', len(request))
+            reply = [fleet.answer(node, item, now) for item in request]
+        else:
+            fleet.count('rpc_calls')
+            reply = fleet.answer(node, request, now)
+        self._json(200, reply)
+
+    def _restart(self, uri, now):
+        self.fleet.count('restarts')
+        path = urllib.parse.urlparse(uri).path.strip('/').split('/')
+        if len(path) == 2 and path[0] == 'node' and path[1].isdigit() and int(path[1]) < len(self.fleet.nodes):
+            self.fleet.nodes[int(path[1])].restart(now)
+        self._json(200, { 'status': 'ok' })
+
+    def _json(self, code, obj):
+        self._send(code, 'application/json', json.dumps(obj).encode('utf-8'))
+
+    def _send(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header('content-type', content_type)
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FleetServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # clients giving up on an injected timeout are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def serve(port, ready, **options):
+    """Process entry point. Sends the bound port through `ready` and serves
+    until the process is terminated."""
+    FleetHandler.fleet = Fleet(**options)
+    server = FleetServer(('127.0.0.1', port), FleetHandler)
+    ready.send(server.server_address[1])
+    server.serve_forever()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+    run.py
+    Runs the real Quarian loop against a simulated fleet and reports poll
+    latency, RPC volume, CPU and memory. See bench/README.md.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+
+import fleet
+from quarian.common.core import Quarian
+
+
+SETTINGS = """
+[quarian]
+    reference_node = {base}/node/0/
+    check_every_seconds = {check_every}
+    loglevel = {loglevel}
+    restart_command_type = {restart_type}
+    restart_command = {restart_command}
+    max_concurrent_nodes = {max_concurrent_nodes}
+    batch_evaluation = {batch_evaluation}
+    get_highest_from = {sources}
+    infura_api_key = bench
+    ignore_firstrun_node = True
+    nodelist = {nodelist}
+    checklist = {checks}
+
+[quarian:check:chaintip]
+    allow_trailing_syncing = 50
+    allow_trailing_stalled = 20
+    restart_grace_period_strategy = adaptive
+    restart_grace_period_sec = 30
+    restart_grace_period_adaptive_blocks_per_sec = 5
+
+[quarian:check:peercount]
+    grace_period = 60
+    min_peer_count = 5
+
+[quarian:check:proxy]
+    restart_delay_sec = 60
+    restart_codes = 502
+
+[quarian:check:timer]
+    restart_every_sec = 86400
+"""
+
+
+def percentiles(values, points=(50, 90, 99)):
+    if not values:
+        return dict(('p%d' % p, None) for p in points + (100,))
+    values = sorted(values)
+    out = {}
+    for p in points:
+        out['p%d' % p] = values[min(len(values) - 1, int(len(values) * p / 100.0))]
+    out['p100'] = values[-1]
+    return out
+
+
+def rss_bytes():
+    """Current resident set size, or peak RSS where /proc is unavailable."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def start_fleet(args):
+    ctx = multiprocessing.get_context('spawn')
+    parent, child = ctx.Pipe()
+    proc = ctx.Process(target=fleet.serve, args=(args.port, child), kwargs={
+            'nodes': args.nodes,
+            'duration': args.duration,
+            'block_time': args.block_time,
+            'latency_ms': args.latency_ms,
+            'jitter_ms': args.jitter_ms,
+            'stall_rate': args.stall_rate,
+            'stall_seconds': args.stall_seconds,
+            'catchup_rate': args.catchup_rate,
+            'timeout_rate': args.timeout_rate,
+            'timeout_seconds': args.timeout_seconds,
+            'error_rate': args.error_rate,
+            'peer_drop_rate': args.peer_drop_rate,
+            'peer_drop_seconds': args.peer_drop_seconds,
+            'seed': args.seed
+        }, name='quarian-bench-fleet', daemon=True)
+    proc.start()
+    if not parent.poll(30):
+        raise RuntimeError("Fake fleet did not start")
+    return proc, 'http://127.0.0.1:%d' % parent.recv()
+
+
+def write_settings(args, base):
+    if args.restart == 'shell':
+        restart_command = "curl -fsS -o /dev/null -G %s/restart --data-urlencode node=$NODE_URL" % base
+    else:
+        restart_command = "%s/restart" % base
+    text = SETTINGS.format(base=base,
+        check_every=args.check_every,
+        loglevel=args.loglevel,
+        restart_type=args.restart,
+        restart_command=restart_command,
+        max_concurrent_nodes=args.max_concurrent_nodes,
+        batch_evaluation=args.batch_evaluation,
+        sources=args.sources,
+        checks=args.checks,
+        nodelist=",".join(["%s/node/%d/" % (base, i) for i in range(args.nodes)]))
+    handle, path = tempfile.mkstemp(prefix='quarian-bench-', suffix='.conf')
+    with os.fdopen(handle, 'w') as f:
+        f.write(text)
+    return path
+
+
+def instrument(q):
+    """Record every poll's duration and start lag without changing what
+    the loop does."""
+    polls = []
+    lags = []
+    check = q.check
+    collect = q.collect
+    pop_due = q.scheduler.pop_due
+
+    def timed_check(uri):
+        started = time.time()
+        try:
+            return check(uri)
+        finally:
+            polls.append(time.time() - started)
+
+    def timed_collect(uri):
+        # batched polls: the snapshot, checks are timed per batch
+        started = time.time()
+        try:
+            return collect(uri)
+        finally:
+            polls.append(time.time() - started)
+
+    def recorded_pop_due(now=None):
+        due = pop_due(now)
+        lags.extend([lag for node, lag in due])
+        return due
+
+    q.check = timed_check
+    q.collect = timed_collect
+    q.scheduler.pop_due = recorded_pop_due
+    return polls, lags
+
+
+def run(args):
+    fleet_proc, base = start_fleet(args)
+    settings_path = write_settings(args, base)
+    try:
+        rss_before = rss_bytes()
+        started = time.time()
+        q = Quarian(argparse.Namespace(settings_file=settings_path, loglevel=args.loglevel,
+            record=args.record, profile=args.profile, profile_interval=args.duration,
+            shard_index=None, shard_count=None))
+        startup = time.time() - started
+        q.etherscan_api_uri = base + '/etherscan/api'
+        q.etherchain_api_uri = base + '/etherchain/blocks/data'
+        q.infura_api_uri = base + '/infura/%s'
+        polls, lags = instrument(q)
+
+        cpu_before = cpu_seconds()
+        started = time.time()
+        loop = threading.Thread(target=q.check_every, name='quarian-bench-loop', daemon=True)
+        loop.start()
+        while time.time() - started < args.duration and loop.is_alive():
+            time.sleep(1)
+        elapsed = time.time() - started
+        cpu = cpu_seconds() - cpu_before
+        rss = rss_bytes()
+        with urllib.request.urlopen(base + '/stats', timeout=10) as res:
+            stats = json.loads(res.read().decode('utf-8'))
+        restarts = len(q.restarts.outcomes)
+        q.console.flush()
+        if q.recorder is not None:
+            q.recorder.close()
+        if q.profiler is not None:
+            q.profiler.stop()
+    finally:
+        fleet_proc.terminate()
+        os.unlink(settings_path)
+
+    nodes = args.nodes
+    report = {
+        'nodes': nodes,
+        'duration_sec': round(elapsed, 1),
+        'startup_sec': round(startup, 3),
+        'polls': len(polls),
+        'polls_per_node_per_min': round(len(polls) / float(nodes) / elapsed * 60, 2),
+        'poll_duration_sec': percentiles(polls),
+        'poll_start_lag_sec': percentiles(lags),
+        'http_requests': stats['http_requests'],
+        'rpc_calls': stats['rpc_calls'],
+        'rpc_batches': stats['batches'],
+        'rpc_calls_per_node_per_min': round(stats['rpc_calls'] / float(nodes) / elapsed * 60, 2),
+        'rpc_methods': stats['methods'],
+        'tip_requests': stats['tip_requests'],
+        'injected_timeouts': stats['injected_timeouts'],
+        'injected_errors': stats['injected_errors'],
+        'restarts_requested': restarts,
+        'restarts_received': stats['restarts'],
+        'nodes_stalled_at_end': stats['stalls'],
+        'cpu_sec': round(cpu, 2),
+        'cpu_pct': round(100 * cpu / elapsed, 1),
+        'cpu_ms_per_poll': round(1000 * cpu / max(1, len(polls)), 3),
+        'rss_mb': round(rss / 1048576.0, 1),
+        'rss_kb_per_node': round((rss - rss_before) / 1024.0 / nodes, 1)
+    }
+    return report
+
+
+def print_report(report):
+    def ms(value):
+        return '-' if value is None else '%.1fms' % (value * 1000)
+
+    print("")
+    print("Quarian benchmark: %d nodes for %.0fs (startup %.2fs)" % \
+        (report['nodes'], report['duration_sec'], report['startup_sec']))
+    for name in ['poll_duration_sec', 'poll_start_lag_sec']:
+        p = report[name]
+        print("  %-22s p50 %s  p90 %s  p99 %s  max %s" % (name.replace('_sec', ''),
+            ms(p['p50']), ms(p['p90']), ms(p['p99']), ms(p['p100'])))
+    print("  %-22s %d (%.2f per node per minute)" % ('polls', report['polls'],
+        report['polls_per_node_per_min']))
+    print("  %-22s %d in %d batches over %d HTTP requests (%.2f per node per minute)" % \
+        ('rpc calls', report['rpc_calls'], report['rpc_batches'], report['http_requests'],
+        report['rpc_calls_per_node_per_min']))
+    print("  %-22s %s" % ('rpc methods', ", ".join(["%s=%d" % (k, v) for k, v in
+        sorted(report['rpc_methods'].items())])))
+    print("  %-22s %d" % ('tip source requests', report['tip_requests']))
+    print("  %-22s %d timeouts, %d 5xx" % ('injected faults', report['injected_timeouts'],
+        report['injected_errors']))
+    print("  %-22s %d requested, %d received, %d nodes still stalled" % ('restarts',
+        report['restarts_requested'], report['restarts_received'], report['nodes_stalled_at_end']))
+    print("  %-22s %.2fs (%.1f%% of one core, %.3fms per poll)" % ('cpu', report['cpu_sec'],
+        report['cpu_pct'], report['cpu_ms_per_poll']))
+    print("  %-22s %.1fMB (%.1fKB per node)" % ('rss', report['rss_mb'], report['rss_kb_per_node']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Quarian against a simulated geth fleet.")
+    parser.add_argument('--nodes', type=int, default=500)
+    parser.add_argument('--duration', type=float, default=60,
+        help="Seconds to run the loop for.")
+    parser.add_argument('--checks', default='chaintip,peercount',
+        help="Comma-separated checklist.")
+    parser.add_argument('--sources', default='etherscan',
+        help="Comma-separated get_highest_from (etherscan, etherchain, infura, geth, fleet).")
+    parser.add_argument('--check-every', type=int, default=8)
+    parser.add_argument('--max-concurrent-nodes', type=int, default=64)
+    parser.add_argument('--batch-evaluation', choices=['auto', 'off'], default='auto',
+        help="'auto' checks nodes due together as one batch when numpy is installed.")
+    parser.add_argument('--restart', choices=['http', 'shell'], default='http',
+        help="'shell' restarts the exact node through curl; 'http' only counts restarts.")
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--jitter-ms', type=float, default=10)
+    parser.add_argument('--block-time', type=float, default=2.0,
+        help="Seconds per block. Shorter than mainnet so stalls matter within a short run.")
+    parser.add_argument('--stall-rate', type=float, default=0.02,
+        help="Fraction of nodes that stop importing blocks during the run.")
+    parser.add_argument('--stall-seconds', type=float, default=120)
+    parser.add_argument('--catchup-rate', type=float, default=50,
+        help="Blocks/sec a node syncs at after a stall.")
+    parser.add_argument('--timeout-rate', type=float, default=0.001,
+        help="Fraction of requests that hang for --timeout-seconds.")
+    parser.add_argument('--timeout-seconds', type=float, default=15)
+    parser.add_argument('--error-rate', type=float, default=0.005,
+        help="Fraction of requests answered with a proxy 502.")
+    parser.add_argument('--peer-drop-rate', type=float, default=0.02,
+        help="Fraction of nodes that lose all peers during the run.")
+    parser.add_argument('--peer-drop-seconds', type=float, default=120)
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--loglevel', default='error')
+    parser.add_argument('--record', default=None,
+        help="Record a trace of the run, for quarian.py --replay.")
+    parser.add_argument('--profile', default=None, metavar='PREFIX',
+        help="Profile the run, as quarian.py --profile PREFIX does.")
+    parser.add_argument('--json', default=None,
+        help="Also write the report to this file as JSON.")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    sys.stdout.flush()
+    # the loop and its pools never exit on their own
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,27 +13,53 @@
      Authentication happens one of two ways: either with a PSK (preshared key)
      or with TLS client cert on the reverse proxy in front of this listener.
      For no auth (trusted networks), set auth type to 'noauth'.
+
+     Restarts run in the background. /restart answers immediately with a job
+     id, and /status/<job_id> reports how the restart went. Only one restart
+     runs at a time: requests arriving while one is in flight, or within
+     ignore_restart_requests_for_sec of the last one, get that job's id back
+     instead of starting another.
+
+     After a restart succeeds, geth's own RPC is polled until it answers and
+     its block number moves again; the job records when. /ready reports
+     whether geth is serving and importing, for Quarian or a load balancer
+     to wait on.
 """
 
+import asyncio
 import hashlib
-import json
+import logging
 import os
 import sys
 import time
+import uuid
 
+from collections import OrderedDict
 from configparser import ConfigParser
-from subprocess import Popen, PIPE
 
-from flask import Flask, jsonify, request, Response
-app = Flask(__name__)
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
 
 DEBUG = ('DEBUG' in os.environ)
 
 restart_delay = 30
+restart_timeout = 120
 auth_type = 'noauth'
 auth_token = None
 restart_command = ''
+listen_address = '127.0.0.1'
 listen_port = 8546
+geth_rpc_uri = 'http://127.0.0.1:8545/'
+readiness_timeout = 900
+readiness_poll_interval = 2
+
+# job id -> job dict, oldest first
+jobs = OrderedDict()
+max_jobs = 100
+current_job = None
+last_job = None
+# restarts and recovery watchers running in the background. the event loop
+# only holds weak references to tasks, so they live here until done
+tasks = set()
 
 def gen_auth_token():
     """Creates a secret token for this server."""
@@ -48,7 +74,8 @@ def authenticate_user_psk(http_bearer_token):
 
 def load_settings(settings_file=None):
     """Load settings for the HTTP Restarter."""
-    global restart_delay, auth_type, auth_token, restart_command, listen_port
+    global restart_delay, restart_timeout, auth_type, auth_token, restart_command, \
+        listen_address, listen_port, geth_rpc_uri, readiness_timeout
 
     candidate_locations = [
         os.path.realpath(os.path.join(os.getcwd(), 'settings.conf')),
@@ -81,8 +108,12 @@ def load_settings(settings_file=None):
         if not restart_command:
             print("restart_command must be specified in settings.")
             sys.exit(1)
+        listen_address = config['quarian:restarter:http'].get('listen_address', '127.0.0.1')
         listen_port = int(config['quarian:restarter:http'].get('listen_port', 8546))
-        restart_delay = config['quarian:restarter:http'].get('ignore_restart_requests_for_sec', 30)
+        restart_delay = int(config['quarian:restarter:http'].get('ignore_restart_requests_for_sec', 30))
+        restart_timeout = int(config['quarian:restarter:http'].get('restart_timeout_sec', 120))
+        geth_rpc_uri = config['quarian:restarter:http'].get('geth_rpc_uri', 'http://127.0.0.1:8545/')
+        readiness_timeout = int(config['quarian:restarter:http'].get('readiness_timeout_sec', 900))
         auth_type = config['quarian:restarter:http'].get('auth_type', 'noauth')
         if auth_type == 'psk':
             print("Selected PSK authentication.")
@@ -98,42 +129,192 @@ def load_settings(settings_file=None):
             print("Warning: 'noauth' selected. Without upstream authentication or filtering, your server is subject to DoS")
 
 
-@app.route('/')
-def index():
+def check_auth(request):
+    """Returns an error Response if the request is not authenticated."""
+    if auth_type != 'psk':
+        return None
+    # quarian sends 'authorization'; 'authentication' is kept for old clients
+    token = request.headers.get('authorization', request.headers.get('authentication', False))
+    if not token:
+        return web.json_response({
+            'success': False,
+            'msg': 'Authentication required'
+        }, status=401)
+    if authenticate_user_psk(token) is False:
+        return web.json_response({
+            'success': False,
+            'msg': 'Incorrect token'
+        }, status=403)
+    return None
+
+
+def start_task(coroutine):
+    """Run `coroutine` in the background, keeping it alive until done."""
+    task = asyncio.ensure_future(coroutine)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+
+def job_response(job, status=200, **extra):
+    body = dict(job)
+    body['success'] = job['status'] != 'failed'
+    body['status_url'] = '/status/%s' % job['job_id']
+    body.update(extra)
+    return web.json_response(body, status=status)
+
+
+async def block_number():
+    """geth's current block, or None if it isn't answering RPC."""
+    payload = { 'jsonrpc': '2.0', 'id': 1, 'method': 'eth_blockNumber', 'params': [] }
+    try:
+        async with ClientSession(timeout=ClientTimeout(total=5)) as session:
+            async with session.post(geth_rpc_uri, json=payload) as response:
+                body = await response.json(content_type=None)
+        return int(body['result'], 16)
+    except (ClientError, asyncio.TimeoutError, KeyError, TypeError, ValueError):
+        return None
+
+
+async def watch_recovery(job):
+    """Poll geth after a restart until it answers RPC and imports a block,
+    or readiness_timeout_sec passes."""
+    job['recovery'] = 'waiting'
+    while time.time() - job['finished'] < readiness_timeout:
+        block = await block_number()
+        if block is not None:
+            if job['rpc_at'] is None:
+                job['rpc_at'] = time.time()
+                job['rpc_block'] = block
+            elif block > job['rpc_block']:
+                job['importing_at'] = time.time()
+                job['recovery'] = 'importing'
+                return
+        await asyncio.sleep(readiness_poll_interval)
+    job['recovery'] = 'timed out'
+
+
+def recovery_times(job):
+    """Seconds from the end of the restart to RPC and to importing."""
+    return dict((name, job[at] - job['finished'] if job.get(at) is not None else None)
+        for name, at in (('time_to_rpc', 'rpc_at'), ('time_to_import', 'importing_at')))
+
+
+async def run_restart(job):
+    """Execute the shell command to restart geth and record the result."""
+    global current_job
+    job['status'] = 'running'
+    job['started'] = time.time()
+    try:
+        proc = await asyncio.create_subprocess_shell(restart_command,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=restart_timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            stdout, stderr = await proc.communicate()
+            job['msg'] = 'Restart command timed out after %ds' % restart_timeout
+        job['status_code'] = proc.returncode
+        job['stdout'] = stdout.decode(errors='replace')
+        job['stderr'] = stderr.decode(errors='replace')
+        job['status'] = 'succeeded' if proc.returncode == 0 else 'failed'
+    except Exception as e:
+        job['status'] = 'failed'
+        job['msg'] = str(e)
+    finally:
+        job['finished'] = time.time()
+        current_job = None
+    if job['status'] == 'succeeded':
+        start_task(watch_recovery(job))
+
+
+async def index(request):
     """Returns a basic JSON heartbeat."""
-    return jsonify({ 'success': True })
-
-
-@app.route('/restart', methods=['GET'])
-def restart():
-    """Restarts the geth instance."""
-    global auth_type
-    if auth_type == 'psk':
-        auth_token = request.headers.get('authentication', False)
-        if not auth_token:
-            return Response(json.dumps({
-                'success': False,
-                'msg': 'Authentication required'
-            }), 401, {'Content-type': 'application/json'})
-        res = authenticate_user_psk(auth_token)
-        if res is False:
-            return Response(json.dumps({
-                'success': False,
-                'msg': 'Incorrect token'
-            }), 403, {'Content-type': 'application/json'})
-
-    # execute the shell command to restart geth
-    proc = Popen(restart_command, shell=True, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = proc.communicate()
-    code = proc.returncode
-    success = (proc.returncode == 0)
-    return jsonify({
-            'success': success,
-            'status_code': code,
-            'stdout': stdout.decode(),
-            'stderr': stderr.decode()
-        })
+    return web.json_response({ 'success': True })
+
+
+async def restart(request):
+    """Queues a restart of the geth instance."""
+    global current_job, last_job
+    denied = check_auth(request)
+    if denied is not None:
+        return denied
+
+    if current_job is not None:
+        return job_response(jobs[current_job], 202, merged=True)
+    if last_job is not None and jobs[last_job]['queued'] + restart_delay > time.time():
+        return job_response(jobs[last_job], 202, merged=True,
+            msg='Restarted less than %ds ago, request ignored' % restart_delay)
+
+    job_id = uuid.uuid4().hex
+    job = {
+        'job_id': job_id,
+        'status': 'queued',
+        'queued': time.time(),
+        'started': None,
+        'finished': None,
+        'status_code': None,
+        'stdout': '',
+        'stderr': '',
+        'recovery': None,
+        'rpc_at': None,
+        'rpc_block': None,
+        'importing_at': None
+    }
+    jobs[job_id] = job
+    while len(jobs) > max_jobs:
+        jobs.popitem(last=False)
+    current_job = job_id
+    last_job = job_id
+    start_task(run_restart(job))
+    return job_response(job, 202, merged=False)
+
+
+async def status(request):
+    """Reports on a restart job."""
+    denied = check_auth(request)
+    if denied is not None:
+        return denied
+    job = jobs.get(request.match_info['job_id'])
+    if job is None:
+        return web.json_response({
+            'success': False,
+            'msg': 'Unknown job'
+        }, status=404)
+    return job_response(job)
+
+
+async def ready(request):
+    """Whether geth answers RPC and, if it was restarted, has imported a
+    block since. 200 when ready, 503 when not."""
+    block = await block_number()
+    job = jobs[last_job] if last_job is not None else None
+    recovering = job is not None and (job['status'] in ('queued', 'running') \
+        or job['recovery'] == 'waiting')
+    body = {
+        'ready': block is not None and not recovering,
+        'rpc': block is not None,
+        'block': block,
+        'recovering': recovering
+    }
+    if job is not None:
+        body['job_id'] = job['job_id']
+        body.update(recovery_times(job))
+    return web.json_response(body, status=200 if body['ready'] else 503)
+
+
+def make_app():
+    app = web.Application()
+    app.router.add_get('/', index)
+    app.router.add_get('/restart', restart)
+    app.router.add_post('/restart', restart)
+    app.router.add_get('/status/{job_id}', status)
+    app.router.add_get('/ready', ready)
+    return app
+
 
 if __name__ == '__main__':
     load_settings()
-    app.run(debug=DEBUG, port=listen_port)
\ No newline at end of file
+    if DEBUG:
+        logging.basicConfig(level=logging.DEBUG)
+    web.run_app(make_app(), host=listen_address, port=listen_port)
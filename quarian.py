@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
 from quarian.common.core import Quarian
+from quarian.common.shard import ShardSupervisor
 
 def main():
     parser = argparse.ArgumentParser(description="Monitors delinquent Geth nodes.")
@@ -9,9 +11,44 @@ def main():
         help="Path to a settings.conf file to use over default settings.")
     parser.add_argument('--loglevel', default='info',
         help="Log level.")
+    parser.add_argument('--shards', type=int, default=None,
+        help="Split the nodelist across this many worker processes.")
+    parser.add_argument('--shard-index', type=int, default=None,
+        help="Only watch this shard (0-based) of the nodelist. Use with " + \
+            "--shard-count to split a fleet across cooperating instances.")
+    parser.add_argument('--shard-count', type=int, default=None,
+        help="Total number of cooperating instances when using --shard-index.")
+    parser.add_argument('--record', default=None,
+        help="Append every node response and chain tip seen to this trace file " + \
+            "(gzip compressed if it ends in .gz).")
+    parser.add_argument('--replay', default=None,
+        help="Run a recorded trace through the checks in the settings file and " + \
+            "report the restarts they decide on, instead of watching nodes.")
+    parser.add_argument('--profile', nargs='?', const='quarian-profile', default=None,
+        metavar='PREFIX',
+        help="Time the polling hot path by node, check and RPC method, and write " + \
+            "PREFIX.txt and PREFIX.folded (collapsed stacks for flame graphs) periodically.")
+    parser.add_argument('--profile-interval', type=float, default=60,
+        help="Seconds between profile reports.")
+    parser.add_argument('--replay-report', default=None,
+        help="Also write the full replay report, every decision included, to this JSON file.")
     args = parser.parse_args()
+    if args.shard_index is not None and not args.shard_count:
+        parser.error("--shard-index requires --shard-count")
+    if args.replay:
+        from quarian.common.replay import Replay, format_report
+        report = Replay(args, args.replay).run()
+        print(format_report(report))
+        if args.replay_report:
+            with open(args.replay_report, 'w') as f:
+                json.dump(report, f, indent=2)
+        return
     q = Quarian(args)
-    q.check_every()
+    shards = args.shards if args.shards is not None else int(q.shards)
+    if q.supervising:
+        ShardSupervisor(q, args, shards).run()
+    else:
+        q.check_every()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
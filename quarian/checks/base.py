@@ -3,14 +3,21 @@
     Quarian Check Base Class
 """
 
-from web3 import Web3, HTTPProvider
+import threading
+import time
+
 from quarian.common.output import Output
 
 class CheckBase(object):
 
-    web3_reference = None
-    web3_geth = None
     console = None
+    # JSON-RPC methods (no params) this check reads from the node snapshot
+    rpc_methods = []
+    # per-node fields this check keeps in the core's state store
+    state_fields = []
+    # restarts this check asks for are maintenance rather than repairs, so
+    # they queue behind restarts of nodes that are out of spec
+    routine = False
 
     global_options = None
     check_options = None
@@ -19,16 +26,92 @@ class CheckBase(object):
         """Configures the check. Do bootstrapping here."""
         self.global_options = global_options
         self.check_options = check_options
-        self.web3_reference = Web3(HTTPProvider(self.global_options['reference_node']))
         self.core = core
         self.console = core.console
+        # checks are shared by every node and nodes are polled concurrently,
+        # so the per-node client must be local to the polling thread and
+        # anything remembered about a node must live in self.state
+        self._local = threading.local()
+        self.name = self.__class__.__module__.split('.')[-1]
+        self.state = core.state.namespace(self.name, self.state_fields)
+
+    @property
+    def client(self):
+        """Pooled JSON-RPC client of the node being checked on this thread."""
+        return getattr(self._local, 'client', None)
+
+    @property
+    def history(self):
+        """Recent per-node samples (height, syncing, peers, rpc_latency),
+        for decisions over a window rather than a single poll."""
+        return self.core.history
+
+    @property
+    def web3_geth(self):
+        """Web3 instance of the node being checked on this thread."""
+        client = self.client
+        return client.web3 if client is not None else None
+
+    @property
+    def web3_reference(self):
+        """Web3 instance of the reference node."""
+        return self.core.clients.get(self.core.reference_node).web3
+
+    def now(self):
+        """Current time. Use this rather than time.time(), so a replayed
+        trace runs the check on its own clock."""
+        return self.core.clock()
 
     def set_geth_instance(self, uri):
-        """Set self.web3_geth for check module use."""
-        self.web3_geth = Web3(HTTPProvider(uri))
+        """Point self.client and self.web3_geth at the node's pooled client."""
+        self._local.client = self.core.clients.get(uri)
 
-    def check(self, uri):
-        """Returns a Boolean on whether or not Quarian should restart Geth."""
+    def rpc_methods_for(self, uri):
+        """The rpc_methods to collect for `uri` this cycle. Override to skip
+        methods when the answer is already known some other way."""
+        return self.rpc_methods
+
+    def needs_attention(self, uri):
+        """Ask the scheduler to poll `uri` at the minimum interval for now,
+        e.g. while it is trailing but still inside a grace period."""
+        self.core.scheduler.tighten(uri)
+
+    def in_spec(self, uri):
+        """Whether the node is where this check wants it, as of the check
+        that just ran, even if it is not worth a restart yet (e.g. still
+        inside a grace period). A restarted node holds its restart slot
+        until every check says True."""
+        return True
+
+    def check(self, uri, snapshot=None):
+        """Returns a Boolean on whether or not Quarian should restart Geth.
+        `snapshot` holds this cycle's results for `rpc_methods`."""
         raise NotImplementedError(
             "The check method has not been implemented by this check.\n" + \
-            "All Quarian checks must have a check method. Please add this.")
\ No newline at end of file
+            "All Quarian checks must have a check method. Please add this.")
+
+    def evaluate_fleet(self, fleet):
+        """Optional batch form of check(), for many nodes polled together.
+        `fleet` is a quarian.common.fleet.FleetSnapshot of NumPy arrays, one
+        row per node. Return a boolean array, True where the node should be
+        restarted, or None (the default) to have check() called node by
+        node instead. Only used when NumPy is installed. Per-node state is
+        read and written with self.state.gather/scatter over fleet.slots."""
+        return None
+
+    def check_rows(self, fleet, rows, mask):
+        """Run check() one node at a time on `rows` of `fleet`, e.g. ones
+        that need an extra RPC call, and fill in their entries of `mask`."""
+        for i in rows:
+            uri = fleet.uris[i]
+            self.set_geth_instance(uri)
+            self.console.bind(node=uri)
+            self.core.clients.set_deadline(time.time() + self.core.node_deadline_seconds)
+            try:
+                mask[i] = self.check(uri, fleet.snapshots[i]) is True
+            except Exception:
+                self.console.error("Check %s failed!" % self.name)
+                self.core.metrics.check_errors.inc(check=self.name)
+            finally:
+                self.core.clients.set_deadline(None)
+                self.console.unbind('node')
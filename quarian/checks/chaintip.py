@@ -5,15 +5,18 @@
     number of blocks behind / trailing a canonical mainnet block, then
     restart the node.
 """
+import math
 import time
 import requests
+from quarian.common.fleet import numpy
 from .base import CheckBase
 
 class CheckChainTip(CheckBase):
 
-    web3_reference = None
-    web3_geth = None
     console = None
+    rpc_methods = ['eth_blockNumber', 'eth_syncing']
+    state_fields = ['last_restart', 'adaptive_grace_period_target', 'adaptive_grace_period_started',
+        'catchup_rate', 'catchup_delta', 'catchup_at', 'trailing']
 
     global_options = None
     check_options = None
@@ -23,10 +26,13 @@ class CheckChainTip(CheckBase):
 
     restart_grace_period_strategy = 'fixed'
     restart_grace_period_sec = 60
+    # assumed catch-up speed until a node's own has been measured
     restart_grace_period_adaptive_blocks_per_sec = 3
+    # time constant of the per-node catch-up rate average
+    restart_grace_period_adaptive_rate_window_sec = 300
+    restart_grace_period_adaptive_max_sec = 21600
 
-    last_restart = None
-    adaptive_grace_period_target = None
+    ignore_firstrun_node = True
 
     def __init__(self, global_options, check_options, core):
         super().__init__(global_options, check_options, core)
@@ -52,22 +58,46 @@ class CheckChainTip(CheckBase):
             self.restart_grace_period_sec = int(self.check_options['restart_grace_period_sec'])
         if 'restart_grace_period_adaptive_blocks_per_sec' in self.check_options:
             self.restart_grace_period_adaptive_blocks_per_sec = \
-                int(self.check_options['restart_grace_period_adaptive_blocks_per_sec'])
+                float(self.check_options['restart_grace_period_adaptive_blocks_per_sec'])
+        if 'restart_grace_period_adaptive_rate_window_sec' in self.check_options:
+            self.restart_grace_period_adaptive_rate_window_sec = \
+                float(self.check_options['restart_grace_period_adaptive_rate_window_sec'])
+        if 'restart_grace_period_adaptive_max_sec' in self.check_options:
+            self.restart_grace_period_adaptive_max_sec = \
+                int(self.check_options['restart_grace_period_adaptive_max_sec'])
 
-    def check(self, uri):
+    def rpc_methods_for(self, uri):
+        """Nothing to poll for nodes whose heads arrive by subscription."""
+        if self.core.heads.head(uri) is not None:
+            return []
+        return self.rpc_methods
+
+    def check(self, uri, snapshot=None):
         """Check if the node is trailing the chain tip."""
 
-        self.console.debug("Checking node... (%s)" % uri)
+        self.console.debug("Checking node... (%s)", uri)
         try:
             actual_highest, provider = self.core.get_highest_known_block()
-            current_block, syncing  = self._get_current_highest_block_geth(uri, True)
+            head = self.core.heads.head(uri)
+            if head is not None:
+                # the node's newHeads subscription already told us
+                current_block = head
+                syncing = None
+                if actual_highest - current_block >= min(self.allow_trailing_syncing,
+                        self.allow_trailing_stalled):
+                    syncing = (self.client.call('eth_syncing') is not False)
+            else:
+                current_block, syncing  = self._get_current_highest_block_geth(uri, True, snapshot)
         except requests.exceptions.ConnectionError:
             self.console.error("Connection Failed, attempting restart (%s)" % uri)
-            return self._issue_restart()
+            self.state.set(uri, 'trailing', None)
+            return self._issue_restart(uri)
         except requests.exceptions.Timeout:
             self.console.error("Connection Timeout, attempting restart (%s)" % uri)
-            return self._issue_restart()
-        self.console.debug("Block reported: %d (%s)" % (current_block, uri))
+            self.state.set(uri, 'trailing', None)
+            return self._issue_restart(uri)
+        self.console.debug("Block reported: %d (%s)", current_block, uri)
+        self.state.set(uri, 'trailing', actual_highest - current_block)
 
         restart_trigger = False
         if (actual_highest < current_block):
@@ -83,50 +113,230 @@ class CheckChainTip(CheckBase):
                         self.console.info("Node trailing (Δ %d), ignored because of firstrun (%s)" % (delta, uri))
                     else:
                         self.console.warn("✘  Node (syncing) trailing (Δ %d), attempting restart (%s)" % (delta, uri))
-                        return self._issue_restart(delta)
+                        return self._issue_restart(uri, delta)
             else:
                 if delta >= self.allow_trailing_stalled:
                      self.console.warn("✘  Node (stalled) trailing (Δ %d), attempting restart (%s)" % (delta, uri))
-                     return self._issue_restart(delta)
+                     return self._issue_restart(uri, delta)
 
         if restart_trigger is False:
-            self.console.debug("✅  Node within spec (Δ %d) (%s)" % ((actual_highest - current_block), uri))
+            self.console.debug("✅  Node within spec (Δ %d) (%s)", (actual_highest - current_block), uri)
+            self._reset_grace_period(uri)
         return False
 
 
-    def _issue_restart(self, blockdelta=None):
+    def evaluate_fleet(self, fleet):
+        """check() for a whole batch of nodes in one pass. Nodes whose poll
+        failed, or that need eth_syncing asked because their subscribed
+        head is trailing, go through check() one by one."""
+        tip, provider = fleet.tip
+        height = fleet.height
+        mask = numpy.zeros(len(fleet), dtype=bool)
+        with numpy.errstate(invalid='ignore'):
+            delta = tip - height
+            single = fleet.error | numpy.isnan(height) | numpy.where(fleet.from_head,
+                delta >= min(self.allow_trailing_syncing, self.allow_trailing_stalled),
+                numpy.isnan(fleet.syncing))
+        self.check_rows(fleet, numpy.flatnonzero(single), mask)
+
+        rows = numpy.flatnonzero(~single)
+        if not len(rows):
+            return mask
+        slots = fleet.slots[rows]
+        delta = delta[rows]
+        height = height[rows]
+        # a subscribed head this close to the tip is in spec either way
+        syncing = fleet.syncing[rows] == 1
+        self.state.scatter('trailing', slots, delta)
+        ahead = int(numpy.count_nonzero(delta < 0))
+        if ahead:
+            self.console.warn("Canonical source %s is behind %d nodes." % (provider, ahead))
+
+        over = (delta > 0) & numpy.where(syncing, delta >= self.allow_trailing_syncing,
+            delta >= self.allow_trailing_stalled)
+        if self.ignore_firstrun_node:
+            firstrun = over & syncing & (height == 0)
+            for i in numpy.flatnonzero(firstrun):
+                self.console.info("Node trailing (Δ %d), ignored because of firstrun (%s)" % \
+                    (delta[i], fleet.uris[rows[i]]))
+            over &= ~firstrun
+        self._reset_grace_periods(slots[~over])
+
+        over_rows = numpy.flatnonzero(over)
+        for i in over_rows:
+            uri = fleet.uris[rows[i]]
+            self.console.warn("✘  Node (%s) trailing (Δ %d), attempting restart (%s)" % \
+                ('syncing' if syncing[i] else 'stalled', delta[i], uri))
+            self.needs_attention(uri)
+        mask[rows[over_rows]] = self._issue_restarts(fleet, rows[over_rows], delta[over_rows])
+        return mask
+
+
+    def in_spec(self, uri):
+        """Answering, and trailing the tip by less than allow_trailing_stalled."""
+        trailing = self.state.get(uri, 'trailing')
+        return trailing is not None and trailing < self.allow_trailing_stalled
+
+
+    def _issue_restart(self, uri, blockdelta=None):
         """Issue a restart, but only if the time is not within the grace period."""
-        now = time.time()
+        now = self.now()
+        # out of spec either way, keep a close eye on it
+        self.needs_attention(uri)
 
         if self.restart_grace_period_strategy == 'fixed':
-            delta = (now - self.last_restart)
+            delta = (now - self.state.get(uri, 'last_restart', 0))
             if delta > self.restart_grace_period_sec:
-                self.last_restart = time.time()
+                self.state.set(uri, 'last_restart', now)
                 return True
         elif self.restart_grace_period_strategy == 'adaptive':
-            if self.adaptive_grace_period_target is None:
-                if blockdelta is None:
-                    # got a connection error, just restart
-                    self.last_restart = time.time()
-                    return True
-                else:
-                    self.adaptive_grace_period_target = now + (blockdelta *
-                        self.restart_grace_period_adaptive_blocks_per_sec)
-                    self.console.debug("Adaptive grace period set to catch " + \
-                        "up on block delta. Time set to %s." % \
-                        time.strftime('%Y-%m-%d %H:%M:%S',
-                            time.localtime(self.adaptive_grace_period_target)))
-            if now >= self.adaptive_grace_period_target:
+            target = self.state.get(uri, 'adaptive_grace_period_target')
+            if target is None and blockdelta is None:
+                # got a connection error, just restart
+                self.state.set(uri, 'last_restart', now)
+                return True
+            if blockdelta is not None:
+                target = self._project_grace_period(uri, blockdelta, now, target)
+            if now >= target:
                 self.console.debug("Node is still failing after grace period exceeded.")
-                self.last_restart = time.time()
-                self.adaptive_grace_period_target = None
+                self.state.set(uri, 'last_restart', now)
+                self._reset_grace_period(uri)
                 return True
         return False
 
 
-    def _get_current_highest_block_geth(self, uri, reportSyncing=False):
+    def _project_grace_period(self, uri, blockdelta, now, target):
+        """Re-project the adaptive grace period from the node's measured
+        catch-up rate. A node that is not closing the gap keeps its current
+        target, so it runs out; one that is gets until it should be caught
+        up, never more than restart_grace_period_adaptive_max_sec in all."""
+        last_delta = self.state.get(uri, 'catchup_delta')
+        rate = self._update_catchup_rate(uri, blockdelta, now)
+        if rate is None:
+            rate = self.restart_grace_period_adaptive_blocks_per_sec
+        started = self.state.setdefault(uri, 'adaptive_grace_period_started', now)
+        # the average decays slowly after a stall, so only a node that
+        # closed some of the gap since its last poll gets more time
+        closing = last_delta is None or blockdelta < last_delta
+        if rate > 0 and (closing or target is None):
+            target = min(now + blockdelta / rate, started + self.restart_grace_period_adaptive_max_sec)
+        elif target is None:
+            target = now + self.restart_grace_period_sec
+        self.state.set(uri, 'adaptive_grace_period_target', target)
+        self.console.debug("Adaptive grace period until %s, catching up at %.2f blocks/sec (%s)",
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(target)), rate, uri)
+        return target
+
+
+    def _update_catchup_rate(self, uri, blockdelta, now):
+        """Exponentially weighted average of how fast the node closes its
+        gap to the tip, in blocks/sec. Weighted by elapsed time, so it does
+        not depend on how often the node is polled. None until measured."""
+        last_delta = self.state.get(uri, 'catchup_delta')
+        last_at = self.state.get(uri, 'catchup_at')
+        rate = self.state.get(uri, 'catchup_rate')
+        self.state.set(uri, 'catchup_delta', blockdelta)
+        self.state.set(uri, 'catchup_at', now)
+        if last_delta is None or now <= last_at:
+            return rate if rate is not None else self._historical_rate(uri, now)
+        elapsed = now - last_at
+        sample = (last_delta - blockdelta) / elapsed
+        if rate is None:
+            rate = sample
+        else:
+            weight = 1 - math.exp(-elapsed / self.restart_grace_period_adaptive_rate_window_sec)
+            rate += weight * (sample - rate)
+        self.state.set(uri, 'catchup_rate', rate)
+        return rate
+
+
+    def _historical_rate(self, uri, now):
+        """First estimate, from the node's recorded heights less the
+        reference node's, when both are in the history."""
+        window = self.restart_grace_period_adaptive_rate_window_sec
+        rate = self.history.rate(uri, 'height', window, now)
+        if rate is None:
+            return None
+        tip_rate = self.history.rate(self.core.reference_node, 'height', window, now)
+        return rate - (tip_rate or 0)
+
+
+    def _issue_restarts(self, fleet, rows, blockdelta):
+        """_issue_restart() for `rows` of `fleet`, all trailing by
+        `blockdelta`. Returns which of them to restart."""
+        now = fleet.now
+        slots = fleet.slots[rows]
+        state = self.state
+        if self.restart_grace_period_strategy == 'fixed':
+            last = numpy.nan_to_num(state.gather('last_restart', slots))
+            fire = now - last > self.restart_grace_period_sec
+            state.scatter('last_restart', slots[fire], now)
+            return fire
+
+        # _update_catchup_rate
+        target = state.gather('adaptive_grace_period_target', slots)
+        last_delta = state.gather('catchup_delta', slots)
+        last_at = state.gather('catchup_at', slots)
+        rate = state.gather('catchup_rate', slots)
+        state.scatter('catchup_delta', slots, blockdelta)
+        state.scatter('catchup_at', slots, now)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            measured = ~numpy.isnan(last_delta) & (now > last_at)
+            elapsed = now - last_at
+            sample = (last_delta - blockdelta) / elapsed
+            weight = 1 - numpy.exp(-elapsed / self.restart_grace_period_adaptive_rate_window_sec)
+            updated = numpy.where(numpy.isnan(rate), sample, rate + weight * (sample - rate))
+            state.scatter('catchup_rate', slots[measured], updated[measured])
+            rate = numpy.where(measured, updated, rate)
+            for i in numpy.flatnonzero(numpy.isnan(rate)):
+                historical = self._historical_rate(fleet.uris[rows[i]], now)
+                if historical is not None:
+                    rate[i] = historical
+            rate[numpy.isnan(rate)] = self.restart_grace_period_adaptive_blocks_per_sec
+
+            # _project_grace_period
+            started = state.gather('adaptive_grace_period_started', slots)
+            started[numpy.isnan(started)] = now
+            state.scatter('adaptive_grace_period_started', slots, started)
+            closing = numpy.isnan(last_delta) | (blockdelta < last_delta)
+            project = (rate > 0) & (closing | numpy.isnan(target))
+            target = numpy.where(project,
+                numpy.minimum(now + blockdelta / rate,
+                    started + self.restart_grace_period_adaptive_max_sec),
+                numpy.where(numpy.isnan(target), now + self.restart_grace_period_sec, target))
+        state.scatter('adaptive_grace_period_target', slots, target)
+        if self.console.enabled('debug'):
+            for i in range(len(rows)):
+                self.console.debug("Adaptive grace period until %s, catching up at %.2f blocks/sec (%s)",
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(target[i])), rate[i],
+                    fleet.uris[rows[i]])
+
+        fire = now >= target
+        if fire.any():
+            self.console.debug("%d nodes still failing after grace period exceeded.",
+                int(numpy.count_nonzero(fire)))
+            state.scatter('last_restart', slots[fire], now)
+            self._reset_grace_periods(slots[fire])
+        return fire
+
+
+    def _reset_grace_periods(self, slots):
+        for field in ['adaptive_grace_period_target', 'adaptive_grace_period_started',
+                'catchup_rate', 'catchup_delta', 'catchup_at']:
+            self.state.scatter(field, slots, numpy.nan)
+
+
+    def _reset_grace_period(self, uri):
+        for field in ['adaptive_grace_period_target', 'adaptive_grace_period_started',
+                'catchup_rate', 'catchup_delta', 'catchup_at']:
+            self.state.set(uri, field, None)
+
+
+    def _get_current_highest_block_geth(self, uri, reportSyncing=False, snapshot=None):
         """Get the highest block geth is currently at"""
+        rpc = snapshot if snapshot is not None else self.client
+        block_number = int(rpc.call('eth_blockNumber'), 16)
         if reportSyncing:
-            syncing = (self.web3_geth.eth.syncing is not False)
-            return (self.web3_geth.eth.blockNumber, syncing)
-        return self.web3_geth.eth.blockNumber
\ No newline at end of file
+            syncing = (rpc.call('eth_syncing') is not False)
+            return (block_number, syncing)
+        return block_number
\ No newline at end of file
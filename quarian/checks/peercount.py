@@ -6,37 +6,79 @@
     state entries or block headers/receipts.
 """
 
-import time
+from quarian.common.fleet import numpy
 from .base import CheckBase
 
 class CheckPeerCount(CheckBase):
 
-    web3_reference = None
-    web3_geth = None
     console = None
+    rpc_methods = ['net_peerCount']
+    state_fields = ['last_check']
 
     global_options = None
     check_options = None
 
     min_peer_count = 5
     grace_period = 300
-    last_check = None
 
     def __init__(self, global_options, check_options, core):
         super().__init__(global_options, check_options, core)
         self.min_peer_count = int(self.check_options['min_peer_count'])
         self.grace_period = int(self.check_options['grace_period'])
 
-    def check(self, uri):
+    def in_spec(self, uri):
+        peers = self.history.latest(uri, 'peers')
+        return peers is not None and peers[1] >= self.min_peer_count
+
+    def evaluate_fleet(self, fleet):
+        """check() for a whole batch of nodes in one pass. Nodes without a
+        peer count in their snapshot go through check() and fail there."""
+        now = fleet.now
+        peers = fleet.peers
+        mask = numpy.zeros(len(fleet), dtype=bool)
+        unknown = numpy.isnan(peers)
+        self.check_rows(fleet, numpy.flatnonzero(unknown), mask)
+
+        rows = numpy.flatnonzero(~unknown)
+        slots = fleet.slots[rows]
+        low = peers[rows] < self.min_peer_count
+        for i in numpy.flatnonzero(low):
+            self.needs_attention(fleet.uris[rows[i]])
+        last_check = self.state.gather('last_check', slots)
+        unset = numpy.isnan(last_check)
+        self.state.scatter('last_check', slots[unset], now)
+        due = low & ~unset & (now > last_check + self.grace_period)
+        self.state.scatter('last_check', slots[due], now)
+        for i in numpy.flatnonzero(due):
+            uri = fleet.uris[rows[i]]
+            peak = self.history.max(uri, 'peers', self.grace_period, now)
+            if peak is not None and peak >= self.min_peer_count:
+                self.console.debug("Peer count reached %d within the grace period, not restarting (%s)",
+                    int(peak), uri)
+                continue
+            self.console.warn("✘  Node is below minimum peer count %d, attempting restart (%s)" % (self.min_peer_count, uri))
+            mask[rows[i]] = True
+        return mask
+
+    def check(self, uri, snapshot=None):
         """Returns a Boolean on whether or not Quarian should restart Geth."""
-        num_peers = self.web3_geth.net.peerCount
-        now = time.time()
-        self.console.debug("Node has peer count %d, minimum %d (%s)" % (num_peers, self.min_peer_count, uri))
-        if self.last_check is not None:
-            if num_peers < self.min_peer_count and (now > self.last_check + self.grace_period):
-                self.last_check = now
+        rpc = snapshot if snapshot is not None else self.client
+        num_peers = int(rpc.call('net_peerCount'), 16)
+        now = self.now()
+        self.console.debug("Node has peer count %d, minimum %d (%s)", num_peers, self.min_peer_count, uri)
+        last_check = self.state.get(uri, 'last_check')
+        if num_peers < self.min_peer_count:
+            self.needs_attention(uri)
+        if last_check is not None:
+            if num_peers < self.min_peer_count and (now > last_check + self.grace_period):
+                self.state.set(uri, 'last_check', now)
+                peak = self.history.max(uri, 'peers', self.grace_period, now)
+                if peak is not None and peak >= self.min_peer_count:
+                    self.console.debug("Peer count reached %d within the grace period, not restarting (%s)",
+                        int(peak), uri)
+                    return False
                 self.console.warn("✘  Node is below minimum peer count %d, attempting restart (%s)" % (self.min_peer_count, uri))
                 return True
         else:
-            self.last_check = now
+            self.state.set(uri, 'last_check', now)
         return False
\ No newline at end of file
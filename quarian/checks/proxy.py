@@ -5,38 +5,37 @@
     in PEM format.
 """
 
+import os
 import time
 
-import requests
-
 from .base import CheckBase
 
 class CheckProxy(CheckBase):
 
-    web3_reference = None
-    web3_geth = None
     console = None
+    rpc_methods = ['eth_blockNumber']
+    state_fields = ['last_restart']
 
-    last_restart = None
     tls_client_cert_path = None
     restart_delay = 30
 
     def __init__(self, global_options, check_options, core):
         super().__init__(global_options, check_options, core)
-        self.last_restart = time.time()
+        self.started = self.now()
         self.restart_delay = int(self.check_options.get('restart_delay_sec', 30))
         self.tls_client_cert_path = self.check_options.get('tls_client_cert_file', None)
-        self.restart_codes = self.check_options.get('restart_codes', '500,502,503').split(',')
+        self.restart_codes = [int(code) for code in \
+            self.check_options.get('restart_codes', '500,502,503').split(',')]
         self.user_agent = self.global_options.get('user_agent', 'Quarian/CheckProxy (//github.com/10a7/quarian)')
 
-    def check(self, uri):
+    def check(self, uri, snapshot=None):
         """Returns a Boolean on whether or not Quarian should restart Geth."""
-        now = time.time()
-        if (now - self.last_restart) <= self.restart_delay:
+        now = self.now()
+        last_restart = self.state.setdefault(uri, 'last_restart', self.started)
+        if (now - last_restart) <= self.restart_delay:
             self.console.debug("Not restarting node due to proxycheck, still in delay period.")
             return False
 
-        json_data = '{"jsonrpc":"2.0","method":"eth_blockNumber","params":[],"id":'+str(int(time.time()))+'}'
         request_with_cert = False
         if self.tls_client_cert_path is not None:
             if os.path.isfile(self.tls_client_cert_path):
@@ -44,23 +43,28 @@ class CheckProxy(CheckBase):
             else:
                 self.console.error("TLS client certificate path %s is not a file." % self.tls_client_cert_path)
 
-        if request_with_cert is True:
-            req = requests.post(uri,
-                data=json_data,
-                cert=self.tls_client_cert_path,
-                headers={'user-agent': self.user_agent,
-                    'content-type': 'application/json' })
+        if request_with_cert is False and snapshot is not None:
+            # the cycle's batch request already went through the proxy
+            status_code = snapshot.status_code
         else:
-            req = requests.post(uri,
+            json_data = '{"jsonrpc":"2.0","method":"eth_blockNumber","params":[],"id":'+str(int(time.time()))+'}'
+            req = self.client.session.post(uri,
                 data=json_data,
+                cert=self.tls_client_cert_path if request_with_cert else None,
+                timeout=self.core.clients.timeout(),
                 headers={'user-agent': self.user_agent,
                     'content-type': 'application/json' })
+            status_code = req.status_code
+
+        if status_code is None:
+            self.console.debug("Proxy did not answer, leaving this to other checks (%s)", uri)
+            return False
 
-        if req.status_code in self.restart_codes:
-            self.console.warn("✘  Node failed proxy check with status code %d, attempting restart." % req.status_code)
-            self.last_restart = now
+        if status_code in self.restart_codes:
+            self.console.warn("✘  Node failed proxy check with status code %d, attempting restart." % status_code)
+            self.state.set(uri, 'last_restart', now)
             return True
         else:
-            self.console.debug("✅  Node within spec, reverse proxy returned status code %d" % req.status_code)
+            self.console.debug("✅  Node within spec, reverse proxy returned status code %d", status_code)
 
         return False
@@ -3,28 +3,37 @@
     Simply fires a restart once enough Quarian uptime has passed.
 """
 
-import time
+import zlib
 from .base import CheckBase
 
 class CheckTimer(CheckBase):
 
-    web3_reference = None
-    web3_geth = None
     console = None
+    state_fields = ['last_restart']
+    routine = True
 
     restart_every_sec = None
-    last_restart = None
+    # nodes' first restarts are spread over this many seconds before
+    # restart_every_sec is up, so the fleet doesn't come due all at once
+    restart_spread_sec = None
 
     def __init__(self, global_options, check_options, core):
         super().__init__(global_options, check_options, core)
-        self.last_restart = time.time()
+        self.started = self.now()
         self.restart_every_sec = int(self.check_options['restart_every_sec'])
+        self.restart_spread_sec = int(self.check_options.get('restart_spread_sec',
+            self.restart_every_sec))
 
-    def check(self, uri):
+    def check(self, uri, snapshot=None):
         """Returns a Boolean on whether or not Quarian should restart Geth."""
-        now = time.time()
-        if (now - self.last_restart) >= self.restart_every_sec:
-            self.last_restart = now
+        now = self.now()
+        last_restart = self.state.setdefault(uri, 'last_restart', self.started - self._offset(uri))
+        if (now - last_restart) >= self.restart_every_sec:
+            self.state.set(uri, 'last_restart', now)
             return True
         else:
             return False
+
+    def _offset(self, uri):
+        """Stable per-node share of restart_spread_sec."""
+        return self.restart_spread_sec * (zlib.crc32(uri.encode('utf-8')) / 2.0 ** 32)
@@ -0,0 +1,171 @@
+"""
+    Checkpoint
+    Periodic, crash-safe copies of the per-node check state.
+"""
+
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from array import array
+
+MAGIC = b'QCKP'
+VERSION = 1
+# magic, version, byte order (0 little, 1 big), written at, index length
+HEADER = struct.Struct('<4sIIdI')
+CRC = struct.Struct('<I')
+
+
+class StateCheckpoint(object):
+    """Keeps a copy of the core's NodeStateStore in `path`, rewritten every
+    `interval_seconds` on a background thread when the state changed, and
+    once more at exit. Each copy goes to a temporary file that replaces the
+    last one only once it is complete and synced, so a crash at any point
+    leaves either the old or the new copy. The file is a small JSON index
+    of nodes and fields followed by every field's raw column of doubles,
+    which load() reads back in one pass.
+
+    Grace periods, timers and restart times then carry on across controller
+    restarts instead of starting over: a grace period that ran out while
+    Quarian was down ends on the first poll."""
+
+    interval_seconds = 10
+
+    def __init__(self, core, path, interval_seconds=None):
+        self.core = core
+        self.console = core.console
+        self.path = path
+        if interval_seconds is not None:
+            self.interval_seconds = float(interval_seconds)
+        # of the index and columns, to skip writing an unchanged state
+        self.last_crc = None
+        self.stopping = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+
+
+    def load(self):
+        """Restore the store from the file, keeping only nodes that are
+        still in the nodelist. Returns how many nodes were restored."""
+        started = time.time()
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        except OSError as e:
+            self.console.warn("Could not read state checkpoint %s: %s" % (self.path, e))
+            return 0
+        try:
+            nodes, columns = self._decode(data)
+        except ValueError as e:
+            self.console.warn("State checkpoint %s is unusable, starting fresh: %s" % (self.path, e))
+            return 0
+        store = self.core.state
+        store.restore(nodes, columns)
+        listed = set(self.core.nodes)
+        for uri in nodes:
+            if uri is not None and uri not in listed:
+                store.forget(uri)
+        restored = len(store.nodes())
+        self.console.info("Restored state for %d nodes from %s in %.1fms" % \
+            (restored, self.path, (time.time() - started) * 1000))
+        return restored
+
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run, name='quarian-checkpoint', daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        """Stop the background thread and write a last checkpoint."""
+        self.stopping.set()
+        self.write()
+
+
+    def write(self):
+        """Write a checkpoint now, unless nothing changed since the last
+        one. Returns True if the file was written."""
+        with self.lock:
+            nodes, columns = self.core.state.export()
+            index, names = self._index(nodes, columns)
+            crc = zlib.crc32(index)
+            for name in names:
+                crc = zlib.crc32(columns[name], crc)
+            if crc == self.last_crc:
+                return False
+            data = self._encode(index, names, columns)
+            tmp = "%s.tmp" % self.path
+            try:
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+            except OSError as e:
+                self.console.error("Could not write state checkpoint %s: %s" % (self.path, e))
+                return False
+            self.last_crc = crc
+            return True
+
+
+    def _run(self):
+        while not self.stopping.wait(self.interval_seconds):
+            started = time.time()
+            if self.write():
+                self.console.debug("State checkpoint written in %.1fms",
+                    (time.time() - started) * 1000)
+
+
+    def _index(self, nodes, columns):
+        names = sorted(columns)
+        index = json.dumps({ 'nodes': nodes, 'fields': names }, separators=(',', ':'))
+        return index.encode('utf-8'), names
+
+
+    def _encode(self, index, names, columns):
+        parts = [HEADER.pack(MAGIC, VERSION, 0 if sys.byteorder == 'little' else 1,
+            time.time(), len(index)), index]
+        parts.extend(columns[name] for name in names)
+        data = b''.join(parts)
+        return data + CRC.pack(zlib.crc32(data))
+
+
+    def _decode(self, data):
+        if len(data) < HEADER.size + CRC.size:
+            raise ValueError("too short")
+        magic, version, byteorder, written_at, index_size = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("not a state checkpoint")
+        if version != VERSION:
+            raise ValueError("version %d, this Quarian reads %d" % (version, VERSION))
+        body = len(data) - CRC.size
+        if zlib.crc32(data[:body]) != CRC.unpack_from(data, body)[0]:
+            raise ValueError("checksum mismatch")
+        offset = HEADER.size
+        index = json.loads(data[offset:offset + index_size].decode('utf-8'))
+        offset += index_size
+        nodes = index['nodes']
+        width = len(nodes) * array('d').itemsize
+        if offset + width * len(index['fields']) != body:
+            raise ValueError("size does not match its index")
+        swap = byteorder != (0 if sys.byteorder == 'little' else 1)
+        columns = {}
+        for name in index['fields']:
+            raw = data[offset:offset + width]
+            offset += width
+            if swap:
+                column = array('d')
+                column.frombytes(raw)
+                column.byteswap()
+                raw = column.tobytes()
+            columns[name] = raw
+        self.console.debug("State checkpoint %s is %.0fs old", self.path, time.time() - written_at)
+        return nodes, columns
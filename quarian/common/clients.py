@@ -0,0 +1,201 @@
+"""
+    Clients
+    Long-lived, connection-pooled JSON-RPC clients, one per node URI.
+"""
+
+import itertools
+import json
+import threading
+import time
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+
+class RPCError(Exception):
+    pass
+
+
+class NodeClient(object):
+    """Keep-alive JSON-RPC client for a single node. The underlying session
+    is rebuilt after `reconnect_after_failures` consecutive transport
+    failures, so a node that restarted or dropped our sockets gets a clean
+    connection pool instead of half-dead keep-alive connections."""
+
+    def __init__(self, uri, registry):
+        self.uri = uri
+        self.registry = registry
+        self.consecutive_failures = 0
+        self.last_success = None
+        self.reconnects = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._web3 = None
+        self.session = self._new_session()
+
+
+    @property
+    def healthy(self):
+        return self.consecutive_failures < self.registry.reconnect_after_failures
+
+
+    @property
+    def web3(self):
+        """A Web3 instance for this node, built once. Prefer call() on the
+        hot path; this exists for checks that want the web3 API."""
+        if self._web3 is None:
+            # web3 is slow to import and most checks never need it
+            import web3
+            self._web3 = web3.Web3(web3.HTTPProvider(self.uri,
+                request_kwargs={ 'timeout': self.registry.timeout() }))
+        return self._web3
+
+
+    def call(self, method, params=None):
+        """Issue one JSON-RPC call and return its result."""
+        payload = {
+            'jsonrpc': '2.0',
+            'method': method,
+            'params': params or [],
+            'id': next(self._ids)
+        }
+        res = self.post(payload)
+        try:
+            body = res.json()
+        except ValueError:
+            raise RPCError("Node returned HTTP %d with a non-JSON body" % res.status_code)
+        if 'error' in body:
+            raise RPCError("%s failed: %s" % (method, body['error'].get('message', body['error'])))
+        result = body.get('result')
+        if self.registry.recorder is not None:
+            self.registry.recorder.call(self.uri, method, params, result)
+        return result
+
+
+    def post(self, payload):
+        """POST a JSON payload to the node and return the raw response.
+        Raises requests.Timeout at once if the node's deadline has passed."""
+        timeout = self.registry.budgeted_timeout()
+        try:
+            res = self.session.post(self.uri,
+                data=json.dumps(payload),
+                headers={ 'content-type': 'application/json' },
+                timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            self._failed()
+            raise
+        self.consecutive_failures = 0
+        self.last_success = time.time()
+        return res
+
+
+    def reconnect(self):
+        """Drop every pooled connection and start a fresh session."""
+        with self._lock:
+            old = self.session
+            self.session = self._new_session()
+            self.reconnects += 1
+            self.consecutive_failures = 0
+        old.close()
+
+
+    def close(self):
+        self.session.close()
+
+
+    def _failed(self):
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.registry.reconnect_after_failures:
+            self.registry.console.debug("Node failed %d times in a row, reconnecting (%s)" % \
+                (self.consecutive_failures, self.uri))
+            self.reconnect()
+
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+            pool_maxsize=self.registry.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['user-agent'] = self.registry.user_agent
+        return session
+
+
+class NodeClientRegistry(object):
+    """Owns one NodeClient per node URI for the lifetime of the core."""
+
+    pool_size = 4
+    connect_timeout = 3
+    read_timeout = 10
+    reconnect_after_failures = 3
+    user_agent = "Quarian/0.1 (//github.com/10a7/quarian)"
+
+    def __init__(self, core, pool_size=None, connect_timeout=None, read_timeout=None,
+            reconnect_after_failures=None):
+        self.console = core.console
+        self.user_agent = getattr(core, 'user_agent', self.user_agent)
+        if pool_size is not None:
+            self.pool_size = int(pool_size)
+        if connect_timeout is not None:
+            self.connect_timeout = int(connect_timeout)
+        if read_timeout is not None:
+            self.read_timeout = int(read_timeout)
+        if reconnect_after_failures is not None:
+            self.reconnect_after_failures = int(reconnect_after_failures)
+        # a TraceWriter when recording
+        self.recorder = None
+        self.clients = {}
+        self.lock = threading.Lock()
+        # the deadline of the node being polled on this thread
+        self.local = threading.local()
+
+
+    def get(self, uri):
+        """Returns the client for `uri`, creating it on first use."""
+        client = self.clients.get(uri)
+        if client is None:
+            with self.lock:
+                client = self.clients.get(uri)
+                if client is None:
+                    client = NodeClient(uri, self)
+                    self.clients[uri] = client
+        return client
+
+
+    def discard(self, uri):
+        """Close and forget the client for `uri`."""
+        with self.lock:
+            client = self.clients.pop(uri, None)
+        if client is not None:
+            client.close()
+
+
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+
+    def set_deadline(self, deadline):
+        """Give every call made on this thread until `deadline` (a
+        time.time() value, or None for no limit), so all of one node's
+        calls in a poll share node_deadline_seconds."""
+        self.local.deadline = deadline
+
+
+    def budgeted_timeout(self):
+        """timeout(), cut to what is left of this thread's deadline."""
+        deadline = getattr(self.local, 'deadline', None)
+        if deadline is None:
+            return self.timeout()
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise requests.Timeout("Node deadline passed, not calling it again this poll")
+        return (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+
+
+    def close(self):
+        with self.lock:
+            clients = list(self.clients.values())
+            self.clients = {}
+        for client in clients:
+            client.close()
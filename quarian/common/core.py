@@ -4,27 +4,42 @@
     Quarian class
 """
 
-import glob
-import importlib
+import atexit
 import os
 import shlex
+import signal
 import subprocess
-import sys
-import re
 import time
 import urllib
 
 import requests
-import web3
 
 from configparser import ConfigParser
+from .checkpoint import StateCheckpoint
+from .clients import NodeClientRegistry
+from .fleet import FleetSnapshot, available as fleet_available
+from .heads import HeadTracker
+from .history import History
+from .metrics import Metrics
+from .oracle import ChainTipOracle
 from .output import Output
+from .plugins import load_check, PluginException
+from .poller import Poller
+from .profiler import Profiler
+from .recovery import RecoveryTracker
+from .restarts import RestartExecutor, MERGED, SUCCEEDED
+from .scheduler import Scheduler
+from .shard import shard_nodes
+from .sources import build_sources
+from .snapshot import take_snapshot
+from .state import NodeStateStore
+from .trace import TraceWriter
 
 class Quarian(object):
     """Quarian primary class. Expects to be run locally with
     a single Geth instance."""
 
-    SUPPORTED_SOURCES = ['geth','etherscan','etherchain']
+    SUPPORTED_SOURCES = ['geth','etherscan','etherchain','infura','fleet']
 
     # actual flags/options
     # if you add something here, whitelist it in _load_settings
@@ -32,7 +47,13 @@ class Quarian(object):
     user_agent = "Quarian/0.1 (//github.com/10a7/quarian)"
     check_every = 8
     loglevel = "debug"
+    log_format = "text"
     etherscan_api_key = "PUT_YOUR_API_KEY_HERE"
+    infura_api_key = None
+    # chain tip source endpoints, overridden by bench/ to point at stubs
+    etherscan_api_uri = "https://api.etherscan.io/api"
+    etherchain_api_uri = "https://www.etherchain.org/blocks/data?draw=0&start=0&length=0"
+    infura_api_uri = "https://mainnet.infura.io/%s"
     restart_command = "supervisorctl restart geth"
     restart_command_type = "shell"
     restart_http_auth_token = None
@@ -42,36 +63,250 @@ class Quarian(object):
     allow_trailing_syncing = 500
     allow_trailing_stalled = 50
     check_every_seconds = 8
+    max_concurrent_nodes = 16
+    node_deadline_seconds = 20
+    min_check_interval_seconds = 5
+    max_check_interval_seconds = 120
+    check_interval_backoff = 1.5
+    check_interval_jitter = 0.1
     ignore_firstrun_node = True
-    get_highest_from = 'etherscan'
+    get_highest_from = ['etherscan']
+    chain_tip_ttl_seconds = 10
+    chain_tip_stale_seconds = 120
+    chain_tip_strategy = "highest"
+    chain_tip_quorum = 2
+    chain_tip_hedge_seconds = 1.0
+    chain_tip_timeout_seconds = 5
+    chain_tip_breaker_failures = 3
+    chain_tip_breaker_cooldown_seconds = 60
+    fleet_tip_quorum = 2
+    fleet_tip_max_age_seconds = 60
+    rpc_pool_size = 4
+    rpc_connect_timeout_seconds = 3
+    rpc_timeout_seconds = 10
+    rpc_reconnect_after_failures = 3
+    max_concurrent_restarts = 4
+    restart_max_fraction = 0.1
+    restart_stagger_seconds = 10
+    restart_recovery_timeout_seconds = 900
+    restart_recovery_tip_blocks = 5
+    restart_shell_timeout_seconds = 120
+    restart_http_timeout_seconds = 10
+    metrics_listen_address = "127.0.0.1"
+    metrics_port = 0
+    shards = 1
+    head_subscription_uri = ""
+    head_stale_seconds = 90
+    head_lag_attention_blocks = 3
+    history_samples = 240
+    history_file = ""
+    history_max_nodes = 4096
+    state_file = ""
+    state_checkpoint_seconds = 10
+    settings_watch_seconds = 5
+    batch_evaluation = "auto"
+    batch_evaluation_min_nodes = 64
+    batch_evaluation_window_seconds = 1.0
 
     check_instances = {}
     check_options = {}
     global_options = {}
 
+    # settings a reload can't apply to a running process
+    RESTART_SETTINGS = ['max_concurrent_nodes', 'rpc_pool_size', 'max_concurrent_restarts',
+        'metrics_listen_address', 'metrics_port', 'shards', 'history_samples', 'history_file',
+        'history_max_nodes', 'state_file']
 
-    def __init__(self, args):
+
+    def __init__(self, args, shared_tip=None, reports=None, restart_slots=None, clock=None):
+        """`shared_tip`, `reports` and `restart_slots` are set when running
+        as one shard under a ShardSupervisor: the chain tip is read from the
+        supervisor, metrics are sent back to it instead of served locally,
+        and the restart rollout limit is shared with the other shards. `clock`
+        replaces time.time for checks, e.g. a virtual clock when replaying
+        a trace. A core that will supervise shards (shards > 1 and no
+        shard index) only sets up settings, the chain tip oracle and
+        metrics; its shards poll the nodes."""
+        started = time.time()
+        self.clock = clock if clock is not None else time.time
+        self.startup_phases = []
         self.console = Output()
         if args.loglevel:
             self.loglevel = args.loglevel
         self.console.set_loglevel(self.loglevel)
+        self.shared_tip = shared_tip
+        self.reports = reports
+        self.restart_slots = restart_slots
 
         self._load_settings(args.settings_file)
-        self._load_checks()
+        self.console.set_format(self.log_format)
+        phase = self._startup_phase('settings', started)
+        self.shard_index = getattr(args, 'shard_index', None)
+        self.shard_count = getattr(args, 'shard_count', None) or 1
+        # nodes across all shards, for fleet-wide limits
+        self.fleet_size = len(self.nodelist)
+        if self.shard_index is not None and self.shard_count > 1:
+            self.nodelist = shard_nodes(self.nodelist, self.shard_index, self.shard_count)
+            self.console.bind_all(shard=self.shard_index)
+            self.console.info("Shard %d/%d owns %d nodes" % \
+                (self.shard_index + 1, self.shard_count, len(self.nodelist)))
+        self.nodes = self._normalize_nodes(self.nodelist)
+        self.reload_requested = False
+        self.replaying = bool(getattr(args, 'replay', None))
+        shards = getattr(args, 'shards', None)
+        self.supervising = self.shard_index is None and not self.replaying and \
+            int(shards if shards is not None else self.shards) > 1
+        if self.reports is not None or self.replaying:
+            self.metrics_port = 0
+        if self.replaying:
+            # a replay must not write over the live node history or state
+            self.history_file = ""
+            self.state_file = ""
+        self.recorder = None
+        record = getattr(args, 'record', None)
+        if record and not self.supervising:
+            if self.shard_index is not None and self.shard_count > 1:
+                record = "%s.%d" % (record, self.shard_index)
+            self.recorder = TraceWriter(record, { 'reference_node': self.reference_node })
+            atexit.register(self.recorder.close)
+            self.console.info("Recording a trace to %s" % record)
+        self.metrics = Metrics()
+        self.clients = NodeClientRegistry(self, self.rpc_pool_size,
+            self.rpc_connect_timeout_seconds,
+            min(self.rpc_timeout_seconds, self.node_deadline_seconds),
+            self.rpc_reconnect_after_failures)
+        self.clients.recorder = self.recorder
+        self.state = NodeStateStore()
+        self.checkpoint = None
+        if self.state_file and not self.supervising:
+            state_file = self.state_file
+            if self.shard_index is not None and self.shard_count > 1:
+                state_file = "%s.%d" % (state_file, self.shard_index)
+            self.checkpoint = StateCheckpoint(self, state_file, self.state_checkpoint_seconds)
+            self.checkpoint.load()
+        history_file = self.history_file if not self.supervising else None
+        if history_file and self.shard_index is not None and self.shard_count > 1:
+            # every shard keeps its own file
+            history_file = "%s.%d" % (history_file, self.shard_index)
+        self.history = History(self, self.history_samples, history_file, self.history_max_nodes)
+        if history_file:
+            self.history.retain(self.nodes + [self.reference_node])
+        phase = self._startup_phase('state', phase)
+        if not self.supervising:
+            self._load_checks()
+            phase = self._startup_phase('checks', phase)
+        if self.batch_evaluation != 'off' and not fleet_available():
+            self.console.debug("NumPy is not installed, nodes are checked one at a time")
+
+        self.poller = None
+        self.restarts = None
+        if not self.supervising:
+            self._start_executors()
+        self.scheduler = Scheduler(self.check_every_seconds,
+            self.min_check_interval_seconds, self.max_check_interval_seconds,
+            self.check_interval_backoff, self.check_interval_jitter)
+        self.recovery = RecoveryTracker(self, self.restart_recovery_tip_blocks,
+            self.restart_recovery_timeout_seconds)
+        self.heads = HeadTracker(self, self.head_subscription_uri,
+            self.head_stale_seconds, self.head_lag_attention_blocks)
+        self.tip_sources = build_sources(self, self.chain_tip_breaker_failures,
+            self.chain_tip_breaker_cooldown_seconds, self.chain_tip_timeout_seconds)
+        self.oracle = ChainTipOracle(self, self.get_highest_from, self.tip_sources,
+            self.chain_tip_ttl_seconds, self.chain_tip_stale_seconds, self.chain_tip_strategy,
+            self.chain_tip_quorum, self.chain_tip_hedge_seconds, self.chain_tip_timeout_seconds)
+        phase = self._startup_phase('engine', phase)
+
+        self.profiler = None
+        profile = getattr(args, 'profile', None)
+        if profile and not self.supervising:
+            if self.shard_index is not None and self.shard_count > 1:
+                profile = "%s.%d" % (profile, self.shard_index)
+            self.profiler = Profiler(self, profile, getattr(args, 'profile_interval', None))
+            self.profiler.install()
+            self.profiler.start()
+            atexit.register(self.profiler.stop)
+            self.console.info("Profiling to %s.txt and %s.folded" % (profile, profile))
+
+        if self.metrics_port:
+            self.metrics.serve(self.metrics_listen_address, self.metrics_port)
+            self.console.info("Serving metrics on http://%s:%d/metrics" % \
+                (self.metrics_listen_address, self.metrics_port))
+            phase = self._startup_phase('metrics', phase)
+
+        for name, seconds in self.startup_phases:
+            self.metrics.startup_duration.set(seconds, phase=name)
+        self.console.info("Quarian started in %.3fs (%s)." % (time.time() - started,
+            ", ".join(["%s %.3fs" % (name, seconds) for name, seconds in self.startup_phases])))
+
+
+    def _start_executors(self):
+        """The worker pools that poll and restart nodes."""
+        self.poller = Poller(self, self.max_concurrent_nodes, self.node_deadline_seconds)
+        self.restarts = RestartExecutor(self, self._restart_geth, self.max_concurrent_restarts,
+            self.restart_max_fraction, self.restart_stagger_seconds,
+            self.restart_recovery_timeout_seconds, self.restart_slots)
+        self.restarts.add_listener(self._record_restart)
 
-        self.console.info("Quarian started.")
-        self.web3 = web3.Web3(web3.HTTPProvider(self.reference_node))
+
+    def _startup_phase(self, name, since):
+        """Record how long a startup phase took; returns when it ended."""
+        now = time.time()
+        self.startup_phases.append((name, now - since))
+        return now
 
 
     def check(self, uri):
-        """Check on Geth, and restart."""
+        """Check on Geth, and restart. Returns True if the node looked
+        healthy, which lets the scheduler back off polling it."""
+        started = time.time()
+        self.console.bind(node=uri)
+        # the snapshot and every call checks make share one deadline
+        self.clients.set_deadline(started + self.node_deadline_seconds)
+        try:
+            snapshot = self.take_snapshot(uri)
+            healthy = self.evaluate(uri, snapshot)
+            if self.recorder is not None:
+                # after the checks, so a chain tip they fetched is ahead of
+                # it in the trace
+                self.recorder.snapshot(snapshot)
+            return healthy
+        finally:
+            self.clients.set_deadline(None)
+            self.console.unbind()
+            self.metrics.node_duration.observe(time.time() - started, node=uri)
+
+
+    def collect(self, uri):
+        """The snapshot half of check(), for nodes evaluated as a batch."""
+        started = time.time()
+        self.console.bind(node=uri)
+        self.clients.set_deadline(started + self.node_deadline_seconds)
+        try:
+            return self.take_snapshot(uri)
+        finally:
+            self.clients.set_deadline(None)
+            self.console.unbind()
+            self.metrics.node_duration.observe(time.time() - started, node=uri)
+
+
+    def evaluate(self, uri, snapshot):
+        """Run the checklist against a snapshot of `uri` and queue a restart
+        if any check asks for one. Returns True if the node looked healthy.
+        Replays call this with recorded snapshots."""
+        self._record_history(uri, snapshot)
+        if self.recovery.is_tracking(uri) and self.recovery.observe(uri, snapshot):
+            # still starting up, checks would only restart it again
+            return False
+        reasons = []
         for check_name in self.checklist:
             check_instance = self.check_instances[check_name]
             check_instance.set_geth_instance(uri)
+            self.console.bind(check=check_name)
+            check_started = time.time()
             try:
-                res = check_instance.check(uri)
+                res = check_instance.check(uri, snapshot)
                 if res is True:
-                    self._restart_geth(uri)
+                    reasons.append(check_name)
                 else:
                     continue
             except:
@@ -79,124 +314,504 @@ class Quarian(object):
                 # this way unintended failures don't kill the watchdog
                 # raise them in logs as bugs instead
                 self.console.error("Check %s failed!" % check_name)
+                self.metrics.check_errors.inc(check=check_name)
+            finally:
+                self.metrics.check_duration.observe(time.time() - check_started,
+                    node=uri, check=check_name)
+        self.console.unbind('check')
+        return self._conclude(uri, snapshot, reasons)
+
+
+    def evaluate_batch(self, snapshots):
+        """evaluate() for many nodes polled together, given as a list of
+        (uri, snapshot). Checks that implement evaluate_fleet decide on the
+        whole batch in one vectorized pass; the others are run node by
+        node. Returns {uri: healthy}. Needs NumPy."""
+        results = {}
+        evaluated = []
+        for uri, snapshot in snapshots:
+            self._record_history(uri, snapshot)
+            if self.recovery.is_tracking(uri) and self.recovery.observe(uri, snapshot):
+                results[uri] = False
+            else:
+                evaluated.append((uri, snapshot))
+        fleet = FleetSnapshot(self, evaluated, self.clock())
+        reasons = [[] for uri in fleet.uris]
+        for check_name in self.checklist:
+            check_instance = self.check_instances[check_name]
+            self.console.bind(check=check_name)
+            check_started = time.time()
+            try:
+                mask = check_instance.evaluate_fleet(fleet)
+            except:
+                # state may be half updated, don't run it again node by node
+                self.console.error("Check %s failed on a batch of %d nodes!" % (check_name, len(fleet)))
+                self.metrics.check_errors.inc(check=check_name)
+                continue
+            finally:
+                self.metrics.check_batch_duration.observe(time.time() - check_started,
+                    check=check_name)
+            if mask is None:
+                for i, uri in enumerate(fleet.uris):
+                    check_instance.set_geth_instance(uri)
+                    self.console.bind(node=uri)
+                    self.clients.set_deadline(time.time() + self.node_deadline_seconds)
+                    try:
+                        if check_instance.check(uri, fleet.snapshots[i]) is True:
+                            reasons[i].append(check_name)
+                    except:
+                        self.console.error("Check %s failed!" % check_name)
+                        self.metrics.check_errors.inc(check=check_name)
+                    finally:
+                        self.clients.set_deadline(None)
+                        self.console.unbind('node')
+            else:
+                for i in mask.nonzero()[0]:
+                    reasons[i].append(check_name)
+        self.console.unbind('check')
+        for i, uri in enumerate(fleet.uris):
+            self.console.bind(node=uri)
+            try:
+                results[uri] = self._conclude(uri, fleet.snapshots[i], reasons[i])
+            finally:
+                self.console.unbind('node')
+        if self.recorder is not None:
+            for uri, snapshot in snapshots:
+                self.recorder.snapshot(snapshot)
+        return results
+
+
+    def batch_evaluation_enabled(self, count):
+        """Whether `count` nodes due together are polled as one batch."""
+        return self.batch_evaluation != 'off' and count >= self.batch_evaluation_min_nodes \
+            and fleet_available()
+
+
+    def _conclude(self, uri, snapshot, reasons):
+        """Act on the checks' verdict on one node; True if it looked healthy."""
+        if reasons:
+            if self.recorder is not None:
+                self.recorder.restart(uri, reasons)
+            # one restart per node, however many checks asked for it
+            self.restarts.submit(uri, reasons,
+                all(self.check_instances[reason].routine for reason in reasons))
+        elif snapshot.error is None and self.restarts.is_recovering(uri):
+            self._check_recovered(uri)
+
+        if snapshot.has('eth_syncing') and snapshot.call('eth_syncing') is not False:
+            self.scheduler.tighten(uri)
+        return not reasons and snapshot.error is None and \
+            not self.restarts.is_pending(uri, routine=False)
+
+
+    def _check_recovered(self, uri):
+        """Free the node's restart slot once every check is happy with it."""
+        for check_name in self.checklist:
+            try:
+                if not self.check_instances[check_name].in_spec(uri):
+                    return
+            except Exception:
+                self.console.error("Check %s failed to tell if the node is in spec!" % check_name)
+                return
+        self.restarts.recovered(uri)
+
+
+    def take_snapshot(self, uri):
+        """Collect every RPC method the checklist needs from a node in one
+        JSON-RPC batch round trip."""
+        methods = []
+        for check_name in self.checklist:
+            check_instance = self.check_instances.get(check_name)
+            if check_instance is None:
+                continue
+            for method in check_instance.rpc_methods_for(uri):
+                if method not in methods:
+                    methods.append(method)
+        if 'eth_blockNumber' not in methods and self.recovery.is_suppressed(uri):
+            # a restarted node's subscription is down with it
+            methods.append('eth_blockNumber')
+        snapshot = take_snapshot(self.clients.get(uri), methods)
+        if snapshot.latency is not None:
+            self.metrics.rpc_duration.observe(snapshot.latency, node=uri)
+        if snapshot.error is not None:
+            self.console.debug("Snapshot failed: %s (%s)", snapshot.error, uri)
+            if isinstance(snapshot.error, requests.Timeout):
+                self.metrics.rpc_errors.inc(node=uri, kind='timeout')
+            elif isinstance(snapshot.error, requests.ConnectionError):
+                self.metrics.rpc_errors.inc(node=uri, kind='connection')
+            else:
+                self.metrics.rpc_errors.inc(node=uri, kind='rpc')
+        elif snapshot.errors:
+            self.metrics.rpc_errors.inc(len(snapshot.errors), node=uri, kind='rpc')
+        return snapshot
+
+
+    def _record_history(self, uri, snapshot):
+        """Record what the snapshot saw before checks run, so checks can
+        query windows that include this poll."""
+        now = self.clock()
+        history = self.history
+        try:
+            history.record(uri, 'rpc_latency', snapshot.latency, now)
+            if snapshot.has('eth_blockNumber'):
+                history.record(uri, 'height', int(snapshot.results['eth_blockNumber'], 16), now)
+            if snapshot.has('eth_syncing'):
+                history.record(uri, 'syncing', 0 if snapshot.results['eth_syncing'] is False else 1, now)
+            if snapshot.has('net_peerCount'):
+                history.record(uri, 'peers', int(snapshot.results['net_peerCount'], 16), now)
+        except (TypeError, ValueError) as e:
+            self.console.debug("Unparseable snapshot result: %s (%s)", e, uri)
+        except Exception as e:
+            # history is for checks to look back on, never a reason to skip them
+            self.console.error("Recording history failed: %s (%s)" % (e, uri))
 
 
     def check_every(self, sec=None):
+        fixed_interval = sec is not None
         if sec is None:
             sec = int(self.check_every_seconds)
         self.console.debug("Setting up polling at every %d seconds" % sec)
         actual_highest, provider = self.get_highest_known_block()
         self.console.info("Actual highest block: %d via %s" % (actual_highest, provider))
+        if 'geth' in self.get_highest_from:
+            self.heads.follow(self.reference_node, reference=True)
+        for node in self.nodes:
+            self.scheduler.add(node)
+            self.heads.follow(node)
+        self.metrics.cycle_budget.set(sec)
+        self._watch_settings()
+        if self.checkpoint is not None:
+            self.checkpoint.start()
+            atexit.register(self.checkpoint.stop)
+        last_report = time.time()
+        last_settings_check = time.time()
         while True:
-            for node in self.nodelist:
-                if node.find("http://") != 0:
-                    node = 'http://' + node
-                self.check(node)
-            time.sleep(sec)
+            now = time.time()
+            if self.reload_requested or (self.settings_watch_seconds > 0 and
+                    now - last_settings_check >= self.settings_watch_seconds):
+                last_settings_check = now
+                if self.reload_requested or self._settings_changed():
+                    self.reload_requested = False
+                    self.reload_settings()
+                    if not fixed_interval:
+                        sec = int(self.check_every_seconds)
+                        self.metrics.cycle_budget.set(sec)
+            due = self.scheduler.pop_due(now)
+            for node, lag in due:
+                self.metrics.poll_lag.observe(lag)
+                if lag > sec:
+                    self.console.warn("Poll started %.1fs late (%s)" % (lag, node))
+                    self.metrics.poll_overruns.inc()
+            if due:
+                nodes = [node for node, lag in due]
+                if self.batch_evaluation_enabled(len(nodes)):
+                    self.poller.dispatch_batch(nodes, self._polled)
+                else:
+                    self.poller.dispatch(nodes, self._polled)
+            if now - last_report >= sec:
+                last_report = now
+                oracle_stats = self._format_oracle_stats()
+                self.console.debug("Chain tip oracle: %s", oracle_stats)
+                self.metrics.restarts_waiting.set(self.restarts.waiting_count())
+                self.metrics.restarting_nodes.set(self.restarts.restarting_count())
+                self.metrics.recovering_nodes.set(self.recovery.recovering_count())
+                if self.reports is not None:
+                    self._report_to_supervisor()
+            next_due = self.scheduler.next_due()
+            if next_due is None:
+                time.sleep(1)
+            else:
+                # nodes are spread out over their intervals, let enough of
+                # them come due to make a batch, if even a fully backed off
+                # fleet would
+                least = 0.05
+                if self.batch_evaluation_enabled(int(len(self.nodes) * \
+                        self.batch_evaluation_window_seconds / self.max_check_interval_seconds)):
+                    least = self.batch_evaluation_window_seconds
+                time.sleep(max(least, min(1, next_due - time.time())))
 
 
-    def get_highest_known_block(self):
-        """Get the highest known block from data sources."""
-        highest = []
-        providers = []
-        for source in self.get_highest_from:
-            try:
-                if source == 'etherscan':
-                    res = self._get_highest_known_block_etherscan()
-                    if res is not False:
-                        highest.append(res)
-                        providers.append('etherscan')
-                elif source == 'etherchain':
-                    res = self._get_highest_known_block_etherchain()
-                    if res is not False:
-                        highest.append(res)
-                        providers.append('etherchain')
-                elif source == 'infura':
-                    res = self._get_highest_known_block_infura()
-                    if res is not False:
-                        highest.append(res)
-                        providers.append('infura')
-                elif source == 'geth':
-                    res = self._get_highest_known_block_geth(self.DEFAULTS['geth_location'])
-                    highest.append(res)
-                    providers.append('geth')
-                else:
-                    self.console.warn("Unknown blockchain provider %s" % source)
-            except:
-                self.console.error("Error getting highest block from source %s" % source)
-        if len(highest) == 0:
-            self.console.error("Do not have a highest block from sources.")
-            return (0, 'failure')
-        best = max(highest)
-        provider = providers[highest.index(best)]
-        return (best, provider)
+    def _watch_settings(self):
+        """Reload settings on SIGHUP, where signals can be handled."""
+        if not hasattr(signal, 'SIGHUP'):
+            return
+        def request_reload(signum, frame):
+            self.reload_requested = True
+        try:
+            signal.signal(signal.SIGHUP, request_reload)
+        except ValueError:
+            # not the main thread; the mtime watch still works
+            pass
 
 
-    def _geth_is_syncing(self):
-        """check if geth is syncing"""
-        return (self.web3.eth.syncing is not False)
+    def _settings_changed(self):
+        try:
+            return os.stat(self.settings_file).st_mtime != self.settings_mtime
+        except OSError:
+            return False
 
 
-    def _get_highest_known_block_geth(self):
-        """Get the highest block from the local geth, the highest known
-        if geth is still syncing. Note that this is likely not going to
-        be tracking the true highest if you are just syncing or geth
-        is really far behind."""
+    def reload_settings(self):
+        """Re-read the settings file and apply only what changed. Nodes that
+        are still listed keep their state, schedule and pooled connections,
+        and checks whose options did not change keep running as they are.
+        An unreadable or invalid file changes nothing."""
+        fresh = Quarian.__new__(Quarian)
+        fresh.console = self.console
+        fresh.global_options = {}
+        fresh.check_options = {}
         try:
-            syncing = self.web3.eth.syncing
-            if syncing is False:
-                return (self.web3.eth.blockNumber, syncing)
-            else:
-                return self.web3.eth.syncing['highestBlock']
-        except requests.ConnectionError:
-            self.console.error("Can't connect to canonical geth.")
-
-
-    def _get_highest_known_block_etherscan(self):
-        """Get the highest block from etherscan"""
-        uri = "https://api.etherscan.io/api"
-        res = requests.get(uri,
-            data={ 'module': 'proxy', 'action':
-                'eth_blockNumber',
-                'apikey': self.etherscan_api_key },
-            headers= { 'user-agent': self.user_agent },
-            timeout=5)
-
-        if res.status_code == 200 and res.json():
-            try:
-                block_number = int(res.json()['result'], 16)
-                return block_number
-            except KeyError:
-                return False
-        return False
+            fresh._load_settings(self.settings_file, verbose=False)
+        except Exception as e:
+            self.console.error("Not reloading settings, %s is invalid: %s" % (self.settings_file, e))
+            return False
+        self.settings_mtime = fresh.settings_mtime
+
+        # compare what the files said (a removed key means the default),
+        # not the attributes, which e.g. sharding has already narrowed
+        defaults = Quarian.__dict__
+        changed = [name for name in sorted(set(self.global_options) | set(fresh.global_options))
+            if fresh.global_options.get(name, defaults.get(name)) != \
+                self.global_options.get(name, defaults.get(name))]
+        changed_options = [name for name in sorted(set(self.check_options) | set(fresh.check_options))
+            if fresh.check_options.get(name) != self.check_options.get(name)]
+        if not changed and not changed_options:
+            self.console.info("Settings file %s reloaded, nothing changed." % self.settings_file)
+            return True
+
+        for name in changed:
+            # nodes and checks are swapped in by _apply_* so polls never
+            # see a half-applied list
+            if name not in ['nodelist', 'checklist']:
+                setattr(self, name, getattr(fresh, name))
+        self.global_options.clear()
+        self.global_options.update(fresh.global_options)
+        self.check_options.clear()
+        self.check_options.update(fresh.check_options)
+        self._apply_settings(changed)
+        summary = []
+        if 'nodelist' in changed:
+            summary.append(self._apply_nodelist(fresh.nodelist))
+        if 'checklist' in changed or changed_options:
+            summary.append(self._apply_checklist(fresh.checklist, changed_options))
+
+        self.console.info("Settings reloaded: %s" % "; ".join(
+            [", ".join(changed + ["[quarian:check:%s]" % name for name in changed_options])] + summary))
+        for name in changed:
+            if name in self.RESTART_SETTINGS:
+                self.console.warn("%s changed, this takes effect when Quarian restarts" % name)
+        return True
 
 
-    def _get_highest_known_block_etherchain(self):
-        """Get the highest block from etherchain.org as nicely as possible"""
-        uri = 'https://www.etherchain.org/blocks/data?draw=0&start=0&length=0'
-        res = requests.get(uri,
-            headers = { 'user-agent': self.user_agent },
-            timeout=5)
-        if res.status_code == 200:
+    def _apply_settings(self, changed):
+        """Push changed settings into the components that copied them."""
+        changed = set(changed)
+        if 'loglevel' in changed:
+            self.console.set_loglevel(self.loglevel)
+        if 'log_format' in changed:
+            self.console.set_format(self.log_format)
+        if changed & set(['check_every_seconds', 'min_check_interval_seconds',
+                'max_check_interval_seconds', 'check_interval_backoff', 'check_interval_jitter']):
+            self.scheduler.configure(self.check_every_seconds, self.min_check_interval_seconds,
+                self.max_check_interval_seconds, self.check_interval_backoff,
+                self.check_interval_jitter)
+        if changed & set(['restart_max_fraction', 'restart_stagger_seconds',
+                'restart_recovery_timeout_seconds']) and self.restarts is not None:
+            self.restarts.configure(self.restart_max_fraction, self.restart_stagger_seconds,
+                self.restart_recovery_timeout_seconds)
+        if changed & set(['restart_recovery_tip_blocks', 'restart_recovery_timeout_seconds']):
+            self.recovery.configure(self.restart_recovery_tip_blocks,
+                self.restart_recovery_timeout_seconds)
+        if 'state_checkpoint_seconds' in changed and self.checkpoint is not None:
+            self.checkpoint.interval_seconds = float(self.state_checkpoint_seconds)
+        if 'node_deadline_seconds' in changed and self.poller is not None:
+            self.poller.node_deadline_seconds = int(self.node_deadline_seconds)
+        if changed & set(['rpc_connect_timeout_seconds', 'rpc_timeout_seconds',
+                'node_deadline_seconds', 'rpc_reconnect_after_failures', 'user_agent']):
+            self.clients.connect_timeout = int(self.rpc_connect_timeout_seconds)
+            self.clients.read_timeout = min(self.rpc_timeout_seconds, self.node_deadline_seconds)
+            self.clients.reconnect_after_failures = int(self.rpc_reconnect_after_failures)
+            self.clients.user_agent = self.user_agent
+        if changed & set(['get_highest_from', 'chain_tip_ttl_seconds', 'chain_tip_stale_seconds',
+                'chain_tip_strategy', 'chain_tip_quorum', 'chain_tip_hedge_seconds',
+                'chain_tip_timeout_seconds']):
+            with self.oracle.lock:
+                self.oracle.sources = list(self.get_highest_from)
+                self.oracle.ttl_seconds = int(self.chain_tip_ttl_seconds)
+                self.oracle.stale_seconds = int(self.chain_tip_stale_seconds)
+                if self.chain_tip_strategy in self.oracle.STRATEGIES:
+                    self.oracle.strategy = self.chain_tip_strategy
+                self.oracle.quorum = int(self.chain_tip_quorum)
+                self.oracle.hedge_seconds = float(self.chain_tip_hedge_seconds)
+                self.oracle.fetch_timeout = float(self.chain_tip_timeout_seconds)
+            for source in self.tip_sources.values():
+                source.timeout = self.chain_tip_timeout_seconds
+        if changed & set(['chain_tip_breaker_failures', 'chain_tip_breaker_cooldown_seconds']):
+            for source in self.tip_sources.values():
+                source.breaker.failure_threshold = int(self.chain_tip_breaker_failures)
+                source.breaker.cooldown_seconds = float(self.chain_tip_breaker_cooldown_seconds)
+        if changed & set(['head_subscription_uri', 'head_stale_seconds', 'head_lag_attention_blocks']):
+            self.heads.template = self.head_subscription_uri
+            self.heads.stale_seconds = int(self.head_stale_seconds)
+            self.heads.lag_attention_blocks = int(self.head_lag_attention_blocks)
+        if changed & set(['reference_node', 'get_highest_from']):
+            if self.heads.reference is not None and self.heads.reference not in self.nodes:
+                self.heads.unfollow(self.heads.reference)
+            self.heads.reference = None
+            if 'geth' in self.get_highest_from and not self.supervising:
+                self.heads.follow(self.reference_node, reference=True)
+
+
+    def _apply_nodelist(self, nodelist):
+        self.fleet_size = len(nodelist)
+        if self.shard_index is not None and self.shard_count > 1:
+            nodelist = shard_nodes(nodelist, self.shard_index, self.shard_count)
+        nodes = self._normalize_nodes(nodelist)
+        added = [node for node in nodes if node not in self.nodes]
+        removed = [node for node in self.nodes if node not in nodes]
+        self.nodelist = nodelist
+        self.nodes = nodes
+        if self.supervising:
+            # the shards follow, poll and restart the nodes
+            return "%d nodes added, %d removed" % (len(added), len(removed))
+        for node in removed:
+            self.scheduler.remove(node)
+            if node != self.heads.reference:
+                self.heads.unfollow(node)
+            if node != self.reference_node:
+                self.clients.discard(node)
+            self.state.forget(node)
+            self.history.forget(node)
+            self.restarts.forget(node)
+            self.recovery.forget(node)
+        for node in added:
+            self.scheduler.add(node)
+            self.heads.follow(node)
+        return "%d nodes added, %d removed" % (len(added), len(removed))
+
+
+    def _apply_checklist(self, checklist, changed_options):
+        """Instantiate new checks and checks whose options changed, then
+        swap the checklist. Per-node check state lives in self.state, so a
+        re-created check picks up where the old one left off."""
+        if self.supervising:
+            # checks only run in the shards
+            self.checklist = list(checklist)
+            return "checks are run by the shards"
+        reloaded = []
+        for name in checklist:
+            module = None
+            if name in self.check_instances:
+                module = self.check_instances[name].__class__.__module__.split('.')[-1]
+                if name not in changed_options and module not in changed_options:
+                    continue
             try:
-                return res.json()['recordsTotal']
-            except KeyError:
-                return False
-        return False
+                self.check_instances[name] = self._instantiate_check(name)
+                reloaded.append(name)
+            except Exception as e:
+                self.console.error("Could not load check %s, %s: %s" % (name,
+                    "keeping the running one" if module is not None else "skipping it", e))
+        active = [name for name in checklist if name in self.check_instances]
+        removed = [name for name in self.checklist if name not in active]
+        self.checklist = active
+        for name in removed:
+            self.check_instances.pop(name, None)
+        return "checks reloaded: %s, removed: %s" % (",".join(reloaded) or "none",
+            ",".join(removed) or "none")
 
-    def _get_highest_known_block_infura(self):
-        """Get the highest known block from Consensys Infura"""
-        infura_uri = "https://mainnet.infura.io/%s" % (self.infura_api_key)
+
+    def _normalize_nodes(self, nodelist):
+        nodes = []
+        seen = set()
+        for node in nodelist:
+            if node.find("://") == -1:
+                node = 'http://' + node
+            if node not in seen:
+                seen.add(node)
+                nodes.append(node)
+        return nodes
+
+
+    def _report_to_supervisor(self):
         try:
-            infura_web3 = web3.Web3(web3.HTTPProvider(infura_uri))
-            number = infura_web3.eth.blockNumber
-            return int(number)
-        except:
-            self.console.error("Could not retrieve from Infura.")
-        return False
+            self.reports.put_nowait({
+                'shard': self.shard_index,
+                'nodes': len(self.nodes),
+                'busy': self.poller.busy(),
+                'restarting': self.restarts.pending_count(),
+                'metrics': self.metrics.snapshot()
+            })
+        except Exception as e:
+            self.console.warn("Could not report to supervisor: %s" % e)
+
+
+    def _polled(self, uri, healthy):
+        self.scheduler.report(uri, healthy is True)
+        self.metrics.poll_interval.set(self.scheduler.interval(uri), node=uri)
+
+
+    def _format_oracle_stats(self):
+        stats = self.oracle.stats()
+        for result in stats:
+            self.metrics.tip_cache.set_total(stats[result], result=result)
+        sources = self.oracle.source_stats()
+        for source, source_stats in sources.items():
+            self.metrics.tip_source_open.set(0 if source_stats['breaker'] == 'closed' else 1,
+                source=source)
+        return ", ".join(["%s=%d" % (k, stats[k]) for k in sorted(stats)] +
+            ["%s %s/%s" % (source, sources[source]['breaker'],
+                '-' if sources[source]['latency'] is None else '%.3fs' % sources[source]['latency'])
+                for source in sorted(sources)])
+
+
+    def _record_restart(self, uri, reasons, result, duration):
+        # watch a node closely while it comes back up
+        self.scheduler.tighten(uri)
+        if result == SUCCEEDED:
+            self.recovery.restarted(uri, reasons)
+        else:
+            self.recovery.forget(uri)
+        for reason in reasons:
+            self.metrics.restarts.inc(node=uri, reason=reason, result=result)
+
+
+    def get_highest_known_block(self):
+        """Get the highest known block from data sources. Served from the
+        shared chain tip oracle, so this is cheap to call once per node.
+        Shards read the tip their supervisor published, and only fall
+        back to fetching it themselves if that goes stale. Local sources
+        like 'fleet' are always worked out by the shard itself."""
+        res = self._highest_known_block()
+        if self.recorder is not None:
+            self.recorder.tip(res[0], res[1])
+        return res
+
+
+    def _highest_known_block(self):
+        if self.shared_tip is None:
+            return self.oracle.get_highest_known_block()
+        local = self.oracle.local_sources()
+        if len(local) == len(self.oracle.sources):
+            return self.oracle.get_highest_known_block()
+        res = self.shared_tip.read(self.chain_tip_stale_seconds)
+        if res is None:
+            self.console.warn("Shared chain tip is stale, fetching it directly")
+            return self.oracle.get_highest_known_block()
+        if local:
+            own = self.oracle.get_highest_known_block(local)
+            if own[0] > res[0]:
+                return own
+        return res
+
+
+    def _geth_is_syncing(self):
+        """check if geth is syncing"""
+        return (self.clients.get(self.reference_node).call('eth_syncing') is not False)
+
 
     def _restart_geth(self, uri):
-        """Restarts geth based upon restart_command. returns Boolean."""
+        """Restarts geth based upon restart_command. returns Boolean, or
+        MERGED if the http-restarter merged or throttled the request."""
         self.console.debug("Restart geth on node (%s)" % uri)
 
         if self.restart_command_type == 'shell':
@@ -207,7 +822,13 @@ class Quarian(object):
             cmd = self.restart_command.replace("$NODE_URL", uri)
             self.console.debug("Executing SHELL command `%s`" % cmd)
             proc = subprocess.Popen(cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-            stdout, stderr = proc.communicate()
+            try:
+                stdout, stderr = proc.communicate(timeout=self.restart_shell_timeout_seconds)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.communicate()
+                self.console.error("Subprocess timed out after %ds" % self.restart_shell_timeout_seconds)
+                return False
             if proc.returncode != 0:
                 self.console.error("Subprocess returned status code %d" % proc.returncode)
                 return False
@@ -216,79 +837,106 @@ class Quarian(object):
             return True
 
         elif self.restart_command_type == 'http':
-            self.console.debug("Executing GET to HTTP endpoint" % self.restart_command)
+            self.console.debug("Executing GET to HTTP endpoint %s" % self.restart_command)
+            deadline = time.time() + self.restart_http_timeout_seconds
             try:
-                headers = { 'user-agent': self.user_agent }
+                request_options = {
+                    'headers': { 'user-agent': self.user_agent },
+                    'timeout': self.restart_http_timeout_seconds
+                }
                 if self.restart_http_auth_token:
                     self.console.debug("Bearer token specified, adding to HTTP header.")
-                    headers['authorization'] = "Bearer %s" % self.restart_http_auth_token
+                    request_options['headers']['authorization'] = "Bearer %s" % self.restart_http_auth_token
 
                 if self.restart_http_tls_client_cert:
                     self.console.debug("TLS client certificate specified.")
                     if not os.path.isfile(self.restart_http_tls_client_cert):
-                        self.console.error("Client cert %s specified but is not a file. " + \
-                            "Failing to issue restart." % self.restart_http_tls_client_cert)
+                        self.console.error(("Client cert %s specified but is not a file. " + \
+                            "Failing to issue restart.") % self.restart_http_tls_client_cert)
                         return False
-                    else:
-                        res = requests.get(self.restart_command,
-                            headers=headers,
-                            cert=self.restart_http_tls_client_cert,
-                            timeout=5)
-                else:
-                    res = requests.get(self.restart_command,
-                        headers=headers,
-                        timeout=5)
-                if res.status_code == 200:
-                    return True
-                else:
+                    request_options['cert'] = self.restart_http_tls_client_cert
+                res = requests.get(self.restart_command, **request_options)
+                if res.status_code not in (200, 202):
                     self.console.error("Restart URI returned %d" % (res.status_code))
                     return False
+                return self._await_restart_job(uri, res, request_options, deadline)
             except requests.ConnectionError:
                 self.console.error("Restart command failed with connection error (%s)" % self.restart_command)
                 return False
-            except requests.ConnectTimeout:
+            except requests.Timeout:
                 self.console.error("Restart command failed with timeout (%s)" % self.restart_command)
                 return False
+            except requests.RequestException as e:
+                self.console.error("Restart command failed: %s (%s)" % (e, self.restart_command))
+                return False
+
+
+    def _await_restart_job(self, uri, res, request_options, deadline):
+        """Follow an http-restarter job until it has finished, polling its
+        status_url until `deadline`. Endpoints that answer without a job
+        are taken at their word."""
+        try:
+            job = res.json()
+        except ValueError:
+            job = None
+        if not isinstance(job, dict) or 'job_id' not in job:
+            return res.status_code == 200 or (isinstance(job, dict) and job.get('success') is True)
+        if job.get('merged'):
+            # another request's restart is running, or one just finished
+            self.console.info("Restarter merged the request into job %s (%s), not restarting: %s" % \
+                (job['job_id'], job.get('status'), job.get('msg', 'one is in flight')))
+            return MERGED
+        status_url = urllib.parse.urljoin(self.restart_command, job.get('status_url',
+            '/status/%s' % job['job_id']))
+        self.recovery.restarter_job(uri, urllib.parse.urljoin(self.restart_command, '/ready'),
+            job['job_id'], request_options)
+        while job.get('status') not in ('succeeded', 'failed'):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.console.error("Restart job %s still %s after %ds, giving up on it" % \
+                    (job['job_id'], job.get('status'), self.restart_http_timeout_seconds))
+                return False
+            time.sleep(min(1, remaining))
+            try:
+                res = requests.get(status_url, **dict(request_options, timeout=max(1, remaining)))
+                if res.status_code != 200:
+                    self.console.error("Restart job status returned %d" % res.status_code)
+                    return False
+                job = res.json()
+            except (requests.RequestException, ValueError) as e:
+                self.console.error("Could not follow restart job %s: %s" % (job['job_id'], e))
+                return False
+        if job['status'] == 'failed':
+            self.console.error("Restart job %s failed: %s" % (job['job_id'],
+                job.get('msg') or 'exit status %s' % job.get('status_code')))
+            return False
+        return True
 
 
     def _load_checks(self):
-        """Loads checks from the checks directory."""
-        check_class_list = []
-        checks_directory = os.path.realpath(os.path.join(
-                                os.path.dirname(__file__), '..', 'checks'))
-        self.console.debug("Loading checks from directory %s" % checks_directory)
-        for filepath in glob.glob(os.path.join(checks_directory, '*.py')):
-            if os.path.basename(filepath) == 'base.py':
-                self.console.debug("Skipping analysis of base.py")
-            class_re = "class\s+(.*)\([\w_]*[\s,]*CheckBase[\s,]*.*\)"
-            compiled_class_re = re.compile(class_re)
-            with open(filepath, 'r') as f:
-                class_file = f.read().split("\n")
-                for line in class_file:
-                    result = re.match(compiled_class_re, line)
-                    if result is not None:
-                        class_name = result.groups()[0]
-                        self.console.debug("Found class name %s in %s" % (class_name, filepath))
-                        instance = self._instantiate_from_filepath(filepath, class_name)
-                        name_str = os.path.basename(filepath).replace('.py', '')
-                        self.check_instances[name_str] = instance
-
-
-    def _instantiate_from_filepath(self, filepath, className):
-        """Instantiate a check class from a filepath and className."""
-        check_module = os.path.basename(filepath).replace('.py', '')
-        mod = importlib.import_module("quarian.checks.%s" % check_module)
-        cls = getattr(mod, className)
+        """Loads the checks named in checklist, and only those."""
+        for name in self.checklist:
+            started = time.time()
+            self.check_instances[name] = self._instantiate_check(name)
+            self.console.debug("Loaded check %s in %.3fs", name, time.time() - started)
+
+
+    def _instantiate_check(self, name):
+        try:
+            cls = load_check(name)
+        except PluginException as e:
+            self.console.error(str(e))
+            raise
         self.console.debug("-> Importing class %s" % str(cls))
-        check_options = {}
-        if not check_module in self.check_options:
-            self.console.warn("No options specified for check %s in file." % check_module)
-        else:
-            check_options = self.check_options[check_module]
+        module = cls.__module__.split('.')[-1]
+        check_options = self.check_options.get(name, self.check_options.get(module))
+        if check_options is None:
+            self.console.warn("No options specified for check %s in file." % name)
+            check_options = {}
         return cls(self.global_options, check_options, self)
 
 
-    def _load_settings(self, settings_file=None):
+    def _load_settings(self, settings_file=None, verbose=True):
         """Load settings.conf"""
         candidate_locations = [
              os.path.realpath(os.path.join(os.getcwd(), 'settings.conf')),
@@ -304,12 +952,15 @@ class Quarian(object):
         location_filepath = None
         for location in candidate_locations:
             if os.path.isfile(location):
-                self.console.info("Using settings file %s" % location)
+                if verbose:
+                    self.console.info("Using settings file %s" % location)
                 location_filepath = location
 
         if location_filepath is None:
             raise FileNotFoundError("Cannot find Quarian configuration file.")
 
+        self.settings_file = location_filepath
+        self.settings_mtime = os.stat(location_filepath).st_mtime
         config = ConfigParser()
         config.read(location_filepath)
 
@@ -318,11 +969,54 @@ class Quarian(object):
             'user_agent',
             'check_every_seconds',
             'loglevel',
+            'log_format',
             'etherscan_api_key',
             'restart_command',
             'restart_command_type',
             'restart_http_auth_token',
             'restart_http_tls_client_cert',
+            'max_concurrent_nodes',
+            'node_deadline_seconds',
+            'min_check_interval_seconds',
+            'max_check_interval_seconds',
+            'check_interval_backoff',
+            'check_interval_jitter',
+            'chain_tip_ttl_seconds',
+            'chain_tip_stale_seconds',
+            'chain_tip_strategy',
+            'chain_tip_quorum',
+            'chain_tip_hedge_seconds',
+            'chain_tip_timeout_seconds',
+            'chain_tip_breaker_failures',
+            'chain_tip_breaker_cooldown_seconds',
+            'fleet_tip_quorum',
+            'fleet_tip_max_age_seconds',
+            'rpc_pool_size',
+            'rpc_connect_timeout_seconds',
+            'rpc_timeout_seconds',
+            'rpc_reconnect_after_failures',
+            'max_concurrent_restarts',
+            'restart_max_fraction',
+            'restart_stagger_seconds',
+            'restart_recovery_timeout_seconds',
+            'restart_recovery_tip_blocks',
+            'restart_shell_timeout_seconds',
+            'restart_http_timeout_seconds',
+            'metrics_listen_address',
+            'metrics_port',
+            'shards',
+            'head_subscription_uri',
+            'head_stale_seconds',
+            'head_lag_attention_blocks',
+            'history_samples',
+            'history_file',
+            'history_max_nodes',
+            'state_file',
+            'state_checkpoint_seconds',
+            'settings_watch_seconds',
+            'batch_evaluation',
+            'batch_evaluation_min_nodes',
+            'batch_evaluation_window_seconds',
             'nodelist',
             'get_highest_from',
             'ignore_firstrun_node',
@@ -338,21 +1032,43 @@ class Quarian(object):
                 for setting in whitelisted_settings:
                     try:
                         if setting in ['nodelist', 'checklist']:
-                            exploded = config['quarian'][setting].split(',')
+                            exploded = [item.strip() for item in
+                                config['quarian'][setting].split(',') if item.strip()]
                             self.__setattr__(setting, exploded)
                             self.global_options[setting] = exploded
                         elif setting == 'get_highest_from':
-                            potential_list = config['quarian']['get_highest_from'].split(',')
+                            potential_list = [item.strip() for item in
+                                config['quarian']['get_highest_from'].split(',') if item.strip()]
                             self.get_highest_from = potential_list
                             self.global_options['get_highest_from'] = self.get_highest_from
-                        elif setting in ['check_every_seconds', 'allow_trailing_syncing', 'allow_trailing_stalled']:
+                        elif setting in ['check_every_seconds', 'allow_trailing_syncing', 'allow_trailing_stalled',
+                                'max_concurrent_nodes', 'node_deadline_seconds',
+                                'chain_tip_ttl_seconds', 'chain_tip_stale_seconds',
+                                'chain_tip_quorum', 'chain_tip_breaker_failures',
+                                'fleet_tip_quorum', 'fleet_tip_max_age_seconds',
+                                'rpc_pool_size', 'rpc_connect_timeout_seconds', 'rpc_timeout_seconds',
+                                'rpc_reconnect_after_failures', 'max_concurrent_restarts',
+                                'restart_shell_timeout_seconds', 'restart_http_timeout_seconds',
+                                'metrics_port', 'shards', 'head_stale_seconds',
+                                'head_lag_attention_blocks', 'history_samples', 'history_max_nodes',
+                                'settings_watch_seconds', 'restart_recovery_timeout_seconds',
+                                'state_checkpoint_seconds', 'restart_recovery_tip_blocks',
+                                'batch_evaluation_min_nodes']:
                             self.__setattr__(setting, int(config['quarian'][setting]))
                             self.global_options[setting] = int(config['quarian'][setting])
+                        elif setting in ['min_check_interval_seconds', 'max_check_interval_seconds',
+                                'check_interval_backoff', 'check_interval_jitter',
+                                'chain_tip_hedge_seconds', 'chain_tip_timeout_seconds',
+                                'chain_tip_breaker_cooldown_seconds', 'restart_max_fraction',
+                                'restart_stagger_seconds', 'batch_evaluation_window_seconds']:
+                            self.__setattr__(setting, float(config['quarian'][setting]))
+                            self.global_options[setting] = float(config['quarian'][setting])
                         else:
                             self.__setattr__(setting, config['quarian'][setting])
                             self.global_options[setting] = config['quarian'][setting]
                     except KeyError:
-                        self.console.info("Settings file is missing key %s, using default" % setting)
+                        if verbose:
+                            self.console.info("Settings file is missing key %s, using default" % setting)
                         continue
             elif section.find("quarian:check:") == 0:
                 check_name = section[14:]
@@ -0,0 +1,73 @@
+"""
+    Fleet
+    Many nodes' snapshots as NumPy arrays, for checks that decide on a
+    whole batch of nodes in one vectorized pass.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def available():
+    """Whether NumPy is installed. Batch evaluation needs it; without it
+    every node is checked on its own, as usual."""
+    return numpy is not None
+
+
+class FleetSnapshot(object):
+    """Row i of every array is node uris[i], polled in snapshots[i]:
+
+        height      eth_blockNumber, or the subscribed head; NaN if unknown
+        syncing     1.0 syncing, 0.0 not, NaN if not collected
+        peers       net_peerCount, NaN if unknown
+        error       the whole batch failed (timeout, connection, ...)
+        from_head   height came from a newHeads subscription
+        slots       the nodes' rows in the state store, for gather/scatter
+
+    `now` is the core's clock when the batch was evaluated. The chain tip
+    is only fetched if a check asks for `tip`."""
+
+    def __init__(self, core, snapshots, now):
+        self.core = core
+        self.uris = [uri for uri, snapshot in snapshots]
+        self.snapshots = [snapshot for uri, snapshot in snapshots]
+        self.now = now
+        self.slots = core.state.slots_for(self.uris)
+        self.error = numpy.array([snapshot.error is not None for snapshot in self.snapshots],
+            dtype=bool)
+        self.height = self._hex_column('eth_blockNumber')
+        self.peers = self._hex_column('net_peerCount')
+        self.syncing = numpy.array([(0.0 if snapshot.results['eth_syncing'] is False else 1.0)
+            if snapshot.has('eth_syncing') else numpy.nan for snapshot in self.snapshots])
+        self.from_head = numpy.zeros(len(self.uris), dtype=bool)
+        for i, uri in enumerate(self.uris):
+            head = core.heads.head(uri)
+            if head is not None:
+                self.height[i] = head
+                self.from_head[i] = True
+        self._tip = None
+
+
+    def __len__(self):
+        return len(self.uris)
+
+
+    @property
+    def tip(self):
+        """(block, provider) of the chain tip, fetched once per batch."""
+        if self._tip is None:
+            self._tip = self.core.get_highest_known_block()
+        return self._tip
+
+
+    def _hex_column(self, method):
+        values = numpy.full(len(self.snapshots), numpy.nan)
+        for i, snapshot in enumerate(self.snapshots):
+            if snapshot.has(method):
+                try:
+                    values[i] = int(snapshot.results[method], 16)
+                except (TypeError, ValueError):
+                    pass
+        return values
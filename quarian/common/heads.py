@@ -0,0 +1,199 @@
+"""
+    Heads
+    Follows newHeads subscriptions so node heads are known without polling.
+"""
+
+import codecs
+import json
+import socket
+import threading
+import time
+import urllib.parse
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+
+class HeadTracker(object):
+    """Subscribes to `newHeads` on every node (and the reference node) whose
+    subscription endpoint is reachable, and keeps each one's latest head in
+    memory. Endpoints come from a template such as `ws://$NODE_HOST:8546/`
+    or `ipc:///var/lib/geth/geth.ipc`. A head is only trusted while its
+    subscription is connected and has delivered something within
+    `stale_seconds`; otherwise head() returns None and callers poll."""
+
+    stale_seconds = 90
+    retry_seconds = 5
+    max_retry_seconds = 600
+    lag_attention_blocks = 3
+
+    def __init__(self, core, template, stale_seconds=None, lag_attention_blocks=None):
+        self.core = core
+        self.console = core.console
+        self.template = template
+        if stale_seconds is not None:
+            self.stale_seconds = int(stale_seconds)
+        if lag_attention_blocks is not None:
+            self.lag_attention_blocks = int(lag_attention_blocks)
+        self.heads = {}
+        self.live = set()
+        self.followers = {}
+        self.lock = threading.Lock()
+        self.reference = None
+
+
+    def follow(self, uri, reference=False):
+        """Start following `uri` on a daemon thread."""
+        endpoint = self.endpoint_for(uri)
+        if endpoint is None:
+            return
+        stop = threading.Event()
+        with self.lock:
+            if uri in self.followers:
+                return
+            self.followers[uri] = stop
+        if reference:
+            self.reference = uri
+        thread = threading.Thread(target=self._follow, args=(uri, endpoint, stop),
+            name='quarian-heads', daemon=True)
+        thread.start()
+
+
+    def unfollow(self, uri):
+        """Stop following `uri`. A subscription thread still blocked in
+        recv() exits on its next message, which is dropped."""
+        with self.lock:
+            stop = self.followers.pop(uri, None)
+            self.heads.pop(uri, None)
+            self.live.discard(uri)
+        if stop is not None:
+            stop.set()
+
+
+    def head(self, uri):
+        """Latest head of `uri` from its subscription, or None if there is
+        no live, recently updated subscription for it."""
+        with self.lock:
+            if uri not in self.live:
+                return None
+            entry = self.heads.get(uri)
+        if entry is None or time.time() - entry[1] > self.stale_seconds:
+            return None
+        return entry[0]
+
+
+    def endpoint_for(self, uri):
+        if not self.template:
+            return None
+        parsed = urllib.parse.urlparse(uri)
+        endpoint = self.template.replace("$NODE_URL", uri)
+        endpoint = endpoint.replace("$NODE_HOST", parsed.hostname or '')
+        if endpoint.startswith('ws') and websocket is None:
+            self.console.warn("WebSocket head subscriptions need the websocket-client " + \
+                "package, polling instead (%s)" % uri)
+            return None
+        return endpoint
+
+
+    def _update(self, uri, number, stop):
+        now = time.time()
+        with self.lock:
+            if self.followers.get(uri) is not stop:
+                # unfollowed while this head was on its way
+                return
+            self.heads[uri] = (number, now)
+            self.live.add(uri)
+        self.core.history.record(uri, 'height', number, now)
+        if self.core.recorder is not None:
+            self.core.recorder.head(uri, number, now)
+        if uri == self.reference:
+            self._flag_laggards(number)
+        elif self.reference is not None:
+            tip = self.head(self.reference)
+            if tip is not None and tip - number >= self.lag_attention_blocks:
+                self.core.scheduler.tighten(uri)
+
+
+    def _flag_laggards(self, tip):
+        with self.lock:
+            laggards = [uri for uri, (number, _) in self.heads.items()
+                if uri != self.reference and uri in self.live
+                    and tip - number >= self.lag_attention_blocks]
+        for uri in laggards:
+            self.core.scheduler.tighten(uri)
+
+
+    def _follow(self, uri, endpoint, stop):
+        delay = self.retry_seconds
+        while not stop.is_set():
+            try:
+                for number in self._subscribe(endpoint, stop):
+                    self._update(uri, number, stop)
+                    delay = self.retry_seconds
+            except Exception as e:
+                self.console.debug("Head subscription dropped: %s (%s)" % (e, endpoint))
+            with self.lock:
+                if self.followers.get(uri) is stop:
+                    self.live.discard(uri)
+            stop.wait(delay)
+            delay = min(self.max_retry_seconds, delay * 2)
+
+
+    def _subscribe(self, endpoint, stop):
+        """Yield head numbers from a newHeads subscription until it fails."""
+        request = json.dumps({ 'jsonrpc': '2.0', 'id': 1,
+            'method': 'eth_subscribe', 'params': ['newHeads'] })
+        if endpoint.startswith('ipc://'):
+            conn = _IPCConnection(endpoint[len('ipc://'):], self.stale_seconds)
+        else:
+            conn = websocket.create_connection(endpoint, timeout=self.stale_seconds)
+        try:
+            conn.send(request)
+            reply = json.loads(conn.recv())
+            if 'error' in reply:
+                raise Exception("eth_subscribe refused: %s" % reply['error'].get('message', reply['error']))
+            self.console.debug("Subscribed to newHeads on %s" % endpoint)
+            while not stop.is_set():
+                message = json.loads(conn.recv())
+                params = message.get('params') or {}
+                head = params.get('result') or {}
+                if 'number' in head:
+                    yield int(head['number'], 16)
+        finally:
+            conn.close()
+
+
+class _IPCConnection(object):
+    """Minimal send/recv of JSON messages over geth's IPC socket."""
+
+    def __init__(self, path, timeout):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.buffer = ''
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+
+    def send(self, message):
+        self.sock.sendall(message.encode('utf-8'))
+
+    def recv(self):
+        while True:
+            text = self.buffer.lstrip()
+            if text:
+                try:
+                    end = self.decoder.raw_decode(text)[1]
+                    self.buffer = text[end:]
+                    return text[:end]
+                except ValueError:
+                    pass
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("IPC socket closed")
+            # a chunk may end mid-character; keep the partial bytes for the next one
+            self.buffer += self.utf8.decode(chunk)
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,243 @@
+"""
+    History
+    Fixed-size per-node, per-metric sample history.
+"""
+
+import heapq
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'QHST'
+VERSION = 1
+FILE_HEADER = struct.Struct('<4sIIII')
+FILE_HEADER_SIZE = 64
+URI_BYTES = 256
+RING_HEADER = struct.Struct('<ii')
+SAMPLE = struct.Struct('<dd')
+
+
+class History(object):
+    """Ring buffers of (timestamp, value) samples, `samples` deep, for every
+    node and every metric in METRICS. All rings live in one flat buffer, so
+    memory is exactly nodes x metrics x samples x 16 bytes plus a small
+    header per node. With `path` set the buffer is a memory-mapped file
+    sized for `max_nodes`, so history survives a controller restart; once
+    every slot in it is taken, nodes without one go unrecorded."""
+
+    METRICS = ('height', 'syncing', 'peers', 'rpc_latency')
+
+    samples = 240
+    max_nodes = 4096
+
+    def __init__(self, core, samples=None, path=None, max_nodes=None):
+        self.console = core.console
+        if samples is not None:
+            self.samples = int(samples)
+        if max_nodes is not None:
+            self.max_nodes = int(max_nodes)
+        self.path = path or None
+        self.ring_size = RING_HEADER.size + self.samples * SAMPLE.size
+        self.slot_size = URI_BYTES + len(self.METRICS) * self.ring_size
+        self.metric_index = dict((name, i) for i, name in enumerate(self.METRICS))
+        self.slots = {}
+        # slots freed by forget(), lowest first, and the first never used
+        self.free = []
+        self.next_slot = 0
+        self.full_warned = False
+        self.lock = threading.Lock()
+        self.file = None
+        if self.path:
+            self._open_file()
+        else:
+            self.buf = bytearray()
+            self.capacity = 0
+
+
+    def record(self, uri, metric, value, ts=None):
+        if value is None:
+            return
+        ts = time.time() if ts is None else ts
+        with self.lock:
+            slot = self._slot(uri)
+            if slot is None:
+                return
+            offset = self._ring(slot, metric)
+            if offset is None:
+                return
+            head, count = RING_HEADER.unpack_from(self.buf, offset)
+            SAMPLE.pack_into(self.buf, offset + RING_HEADER.size + head * SAMPLE.size,
+                ts, float(value))
+            RING_HEADER.pack_into(self.buf, offset, (head + 1) % self.samples,
+                min(count + 1, self.samples))
+
+
+    def latest(self, uri, metric):
+        """Most recent (timestamp, value), or None."""
+        samples = self._samples(uri, metric, 1)
+        return samples[-1] if samples else None
+
+
+    def window(self, uri, metric, seconds, now=None):
+        """Samples from the last `seconds`, oldest first."""
+        now = time.time() if now is None else now
+        return [s for s in self._samples(uri, metric) if s[0] >= now - seconds]
+
+
+    def rate(self, uri, metric, seconds, now=None):
+        """Average change per second over the window, e.g. blocks/sec for
+        'height'. None without two samples at least a second apart."""
+        samples = self.window(uri, metric, seconds, now)
+        if len(samples) < 2 or samples[-1][0] - samples[0][0] < 1:
+            return None
+        return (samples[-1][1] - samples[0][1]) / (samples[-1][0] - samples[0][0])
+
+
+    def max(self, uri, metric, seconds, now=None):
+        samples = self.window(uri, metric, seconds, now)
+        return max([s[1] for s in samples]) if samples else None
+
+
+    def min(self, uri, metric, seconds, now=None):
+        samples = self.window(uri, metric, seconds, now)
+        return min([s[1] for s in samples]) if samples else None
+
+
+    def mean(self, uri, metric, seconds, now=None):
+        samples = self.window(uri, metric, seconds, now)
+        return sum([s[1] for s in samples]) / len(samples) if samples else None
+
+
+    def covers(self, uri, metric, seconds, now=None):
+        """True if history for `uri` reaches back at least `seconds`."""
+        now = time.time() if now is None else now
+        samples = self._samples(uri, metric)
+        return bool(samples) and samples[0][0] <= now - seconds
+
+
+    def forget(self, uri):
+        with self.lock:
+            self._release(uri)
+
+
+    def retain(self, uris):
+        """Forget every node not in `uris`, e.g. ones restored from the
+        file that have since left the nodelist."""
+        uris = set(uris)
+        with self.lock:
+            stale = [uri for uri in self.slots if uri not in uris]
+            for uri in stale:
+                self._release(uri)
+        if stale:
+            self.console.info("Dropped history of %d nodes no longer listed" % len(stale))
+
+
+    def flush(self):
+        if self.file is not None:
+            self.mapped.flush()
+
+
+    def close(self):
+        if self.file is not None:
+            self.mapped.flush()
+            self.buf.release()
+            self.mapped.close()
+            self.file.close()
+            self.file = None
+
+
+    def _samples(self, uri, metric, limit=None):
+        with self.lock:
+            slot = self.slots.get(uri)
+            if slot is None:
+                return []
+            offset = self._ring(slot, metric)
+            if offset is None:
+                return []
+            head, count = RING_HEADER.unpack_from(self.buf, offset)
+            if limit is not None:
+                count = min(count, limit)
+            out = []
+            base = offset + RING_HEADER.size
+            for i in range(count):
+                index = (head - count + i) % self.samples
+                out.append(SAMPLE.unpack_from(self.buf, base + index * SAMPLE.size))
+            return out
+
+
+    def _ring(self, slot, metric):
+        index = self.metric_index.get(metric)
+        if index is None:
+            return None
+        return slot * self.slot_size + URI_BYTES + index * self.ring_size
+
+
+    def _slot(self, uri):
+        """The slot of `uri`, taking a free one if it has none yet. None
+        when the history file is full."""
+        slot = self.slots.get(uri)
+        if slot is not None:
+            return slot
+        if self.free:
+            slot = heapq.heappop(self.free)
+        else:
+            if self.next_slot >= self.capacity:
+                if self.file is not None:
+                    if not self.full_warned:
+                        self.full_warned = True
+                        self.console.warn("History file is full (%d nodes), not recording " \
+                            "history for more nodes; raise history_max_nodes (%s)" % \
+                            (self.max_nodes, uri))
+                    return None
+                self.buf.extend(bytes(self.slot_size))
+                self.capacity += 1
+            slot = self.next_slot
+            self.next_slot += 1
+        start = slot * self.slot_size
+        self.buf[start:start + self.slot_size] = bytes(self.slot_size)
+        encoded = uri.encode('utf-8')[:URI_BYTES]
+        self.buf[start:start + len(encoded)] = encoded
+        self.slots[uri] = slot
+        return slot
+
+
+    def _release(self, uri):
+        slot = self.slots.pop(uri, None)
+        if slot is not None:
+            start = slot * self.slot_size
+            self.buf[start:start + self.slot_size] = bytes(self.slot_size)
+            heapq.heappush(self.free, slot)
+            self.full_warned = False
+
+
+    def _open_file(self):
+        self.capacity = self.max_nodes
+        size = FILE_HEADER_SIZE + self.max_nodes * self.slot_size
+        header = FILE_HEADER.pack(MAGIC, VERSION, self.samples, len(self.METRICS), self.max_nodes)
+        fresh = True
+        if os.path.isfile(self.path) and os.path.getsize(self.path) == size:
+            with open(self.path, 'rb') as f:
+                fresh = f.read(FILE_HEADER.size) != header
+            if fresh:
+                self.console.warn("History file %s has a different layout, starting over" % self.path)
+        self.file = open(self.path, 'r+b' if not fresh else 'w+b')
+        if fresh:
+            self.file.truncate(size)
+        self.mapped = mmap.mmap(self.file.fileno(), size)
+        if fresh:
+            self.mapped[:FILE_HEADER.size] = header
+        # slot offsets are relative to the end of the file header
+        self.buf = memoryview(self.mapped)[FILE_HEADER_SIZE:]
+        for slot in range(self.max_nodes):
+            start = slot * self.slot_size
+            raw = bytes(self.buf[start:start + URI_BYTES]).rstrip(b'\x00')
+            if raw:
+                self.slots[raw.decode('utf-8', 'replace')] = slot
+                self.next_slot = slot + 1
+        used = set(self.slots.values())
+        self.free = [slot for slot in range(self.next_slot) if slot not in used]
+        if self.slots:
+            self.console.info("Restored history for %d nodes from %s" % (len(self.slots), self.path))
+
@@ -0,0 +1,320 @@
+"""
+    Metrics
+    In-process counters, gauges and histograms, served in the Prometheus
+    text exposition format on /metrics.
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RECOVERY_BUCKETS = (5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(labelnames, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return '%d' % value
+    return repr(float(value))
+
+
+class Metric(object):
+    """A labelled metric family. Label values are passed as keyword
+    arguments named after `labelnames`."""
+
+    kind = 'untyped'
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def snapshot(self):
+        """A picklable copy of every series."""
+        with self.lock:
+            return dict((key, self._copy(value)) for key, value in self.values.items())
+
+    def merged(self, others):
+        """This metric's series combined with snapshots from other processes."""
+        values = self.snapshot()
+        for other in others:
+            for key, value in other.items():
+                if key in values:
+                    values[key] = self._combine(values[key], value)
+                else:
+                    values[key] = self._copy(value)
+        return values
+
+    def render(self, others=()):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for key, value in sorted(self.merged(others).items()):
+            lines.append('%s%s %s' % (self.name,
+                _format_labels(self.labelnames, key), _format_value(value)))
+        return lines
+
+    def _copy(self, value):
+        return value
+
+    def _combine(self, mine, theirs):
+        return theirs
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set_total(self, value, **labels):
+        """Mirror a running total kept elsewhere, e.g. by the oracle."""
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def _combine(self, mine, theirs):
+        return mine + theirs
+
+
+class Gauge(Metric):
+    """`combine` is how a series set in several processes is merged:
+    'last' keeps one process's value, which suits settings and per-node
+    series, 'sum' adds counts that each shard has its share of, and 'max'
+    keeps the slowest shard's durations."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, description, labelnames=(), combine='last'):
+        super().__init__(name, description, labelnames)
+        self.combine = combine
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def _combine(self, mine, theirs):
+        if self.combine == 'sum':
+            return mine + theirs
+        if self.combine == 'max':
+            return max(mine, theirs)
+        return theirs
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = [[0] * len(self.buckets), 0.0, 0]
+                self.values[key] = series
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        """Context manager observing the duration of its block."""
+        return _Timer(self, labels)
+
+    def render(self, others=()):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for key, (counts, total, count) in sorted(self.merged(others).items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append('%s_bucket%s %d' % (self.name,
+                    _format_labels(self.labelnames, key, ('le', _format_value(bound))),
+                    cumulative))
+            labels = _format_labels(self.labelnames, key)
+            lines.append('%s_sum%s %s' % (self.name, labels, _format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, labels, count))
+        return lines
+
+    def _copy(self, value):
+        return [list(value[0]), value[1], value[2]]
+
+    def _combine(self, mine, theirs):
+        return [[a + b for a, b in zip(mine[0], theirs[0])],
+            mine[1] + theirs[1], mine[2] + theirs[2]]
+
+
+class _Timer(object):
+
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time() - self.started, **self.labels)
+        return False
+
+
+class Metrics(object):
+    """Registry of every metric Quarian exports."""
+
+    def __init__(self):
+        self.families = OrderedDict()
+        self.remote = {}
+        self.server = None
+
+        self.cycle_budget = self.gauge('quarian_cycle_budget_seconds',
+            'Configured check_every_seconds, the base per-node polling interval.')
+        self.poll_lag = self.histogram('quarian_poll_lag_seconds',
+            'How late a node poll was dispatched relative to its due time.')
+        self.poll_overruns = self.counter('quarian_poll_overruns_total',
+            'Node polls dispatched more than check_every_seconds late.')
+        self.poll_interval = self.gauge('quarian_poll_interval_seconds',
+            'Current adaptive polling interval of a node.', ('node',))
+        self.deadline_overruns = self.counter('quarian_node_deadline_overruns_total',
+            'Node polls that ran past node_deadline_seconds; calls to the node fail once it passes.',
+            ('node',))
+        self.node_duration = self.histogram('quarian_node_duration_seconds',
+            'Wall time spent on one node in a cycle, snapshot and checks included.',
+            ('node',))
+        self.check_duration = self.histogram('quarian_check_duration_seconds',
+            'Wall time of a single check on a single node.', ('node', 'check'))
+        self.check_batch_duration = self.histogram('quarian_check_batch_duration_seconds',
+            'Wall time of a single check on a batch of nodes polled together.', ('check',))
+        self.rpc_duration = self.histogram('quarian_rpc_duration_seconds',
+            'Round trip time of the per-cycle JSON-RPC batch to a node.', ('node',))
+        self.rpc_errors = self.counter('quarian_rpc_errors_total',
+            'Failed JSON-RPC requests to nodes, by kind (timeout, connection, rpc).',
+            ('node', 'kind'))
+        self.check_errors = self.counter('quarian_check_errors_total',
+            'Checks that raised instead of returning a decision.', ('check',))
+        self.restarts = self.counter('quarian_restarts_total',
+            'Restarts issued, by the check that asked for it and the outcome ' \
+            '(success, failure, or merged by the restarter).',
+            ('node', 'reason', 'result'))
+        self.restarts_waiting = self.gauge('quarian_restarts_waiting',
+            'Restarts queued until the rolling restart has a free slot.', combine='sum')
+        self.restarting_nodes = self.gauge('quarian_restarting_nodes',
+            'Nodes restarting or not yet back in spec after a restart.', combine='sum')
+        self.recovering_nodes = self.gauge('quarian_recovering_nodes',
+            'Restarted nodes not yet answering RPC and importing blocks, with checks suppressed.',
+            combine='sum')
+        self.restart_time_to_rpc = self.histogram('quarian_restart_time_to_rpc_seconds',
+            'Time from a successful restart until the node answered RPC again.',
+            ('node', 'reason'), RECOVERY_BUCKETS)
+        self.restart_time_to_tip = self.histogram('quarian_restart_time_to_tip_seconds',
+            'Time from a successful restart until the node was back at the chain tip.',
+            ('node', 'reason'), RECOVERY_BUCKETS)
+        self.tip_source_duration = self.histogram('quarian_chain_tip_source_duration_seconds',
+            'Latency of fetching the chain tip from a source.', ('source',))
+        self.tip_source_errors = self.counter('quarian_chain_tip_source_errors_total',
+            'Failed chain tip fetches, by source.', ('source',))
+        self.tip_source_open = self.gauge('quarian_chain_tip_source_breaker_open',
+            'Whether a chain tip source is cut off by its circuit breaker (1) or not (0).',
+            ('source',), combine='max')
+        self.tip_cache = self.counter('quarian_chain_tip_cache_lookups_total',
+            'Chain tip oracle lookups by result (hits, misses, shared, stale, errors).',
+            ('result',))
+        self.startup_duration = self.gauge('quarian_startup_phase_seconds',
+            'Time spent in each startup phase (settings, state, checks, engine, metrics), ' \
+            'by the slowest shard.', ('phase',), combine='max')
+
+
+    def counter(self, name, description, labelnames=()):
+        return self._register(Counter(name, description, labelnames))
+
+    def gauge(self, name, description, labelnames=(), combine='last'):
+        return self._register(Gauge(name, description, labelnames, combine))
+
+    def histogram(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, description, labelnames, buckets))
+
+
+    def snapshot(self):
+        """Every family's series, for shipping to another process."""
+        return dict((name, family.snapshot()) for name, family in list(self.families.items()))
+
+
+    def set_remote(self, source, snapshot):
+        """Fold a snapshot from another process (e.g. a shard) into what
+        render() exports. A newer snapshot from `source` replaces the last."""
+        self.remote[source] = snapshot
+
+
+    def render(self):
+        lines = []
+        remote = list(self.remote.values())
+        for name, family in list(self.families.items()):
+            others = [snapshot[name] for snapshot in remote if name in snapshot]
+            lines.extend(family.render(others))
+        return '\n'.join(lines) + '\n'
+
+
+    def serve(self, address, port):
+        """Serve /metrics on a daemon thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, int(port)), Handler)
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever,
+            name='quarian-metrics', daemon=True)
+        thread.start()
+        return self.server
+
+
+    def _register(self, metric):
+        self.families[metric.name] = metric
+        return metric
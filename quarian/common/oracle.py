@@ -0,0 +1,232 @@
+"""
+    Oracle
+    Shared, TTL-cached view of the canonical chain tip.
+"""
+
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class ChainTipOracle(object):
+    """Answers "what is the highest block" for the whole fleet. Every source
+    is fetched at most once per `ttl_seconds`, and callers arriving while a
+    source is being fetched wait on that fetch instead of starting their
+    own. Once a value has expired it is still served, for up to
+    `stale_seconds`, while a refresh runs in the background, so a slow
+    source never holds up a check. Sources whose circuit breaker is open
+    are not asked at all.
+
+    When nothing usable is cached, `strategy` decides how long to wait:
+    'highest' waits for every source (up to `fetch_timeout`) and takes the
+    highest block, 'quorum' returns the highest of the first `quorum`
+    answers, and 'fastest' asks sources in order, hedging to the next one
+    if an answer takes longer than `hedge_seconds`, and returns the first
+    answer."""
+
+    STRATEGIES = ['highest', 'quorum', 'fastest']
+
+    ttl_seconds = 10
+    stale_seconds = 120
+    fetch_timeout = 10
+    strategy = 'highest'
+    quorum = 2
+    hedge_seconds = 1.0
+
+    def __init__(self, core, sources, registry, ttl_seconds=None, stale_seconds=None,
+            strategy=None, quorum=None, hedge_seconds=None, fetch_timeout=None):
+        """`sources` is the ordered list from get_highest_from, `registry`
+        maps a source name to its TipSource."""
+        self.console = core.console
+        self.sources = list(sources)
+        self.registry = registry
+        if ttl_seconds is not None:
+            self.ttl_seconds = int(ttl_seconds)
+        if stale_seconds is not None:
+            self.stale_seconds = int(stale_seconds)
+        if strategy is not None:
+            if strategy in self.STRATEGIES:
+                self.strategy = strategy
+            else:
+                self.console.error("Chain tip strategy %s is not supported, using %s" % \
+                    (strategy, self.strategy))
+        if quorum is not None:
+            self.quorum = int(quorum)
+        if hedge_seconds is not None:
+            self.hedge_seconds = float(hedge_seconds)
+        if fetch_timeout is not None:
+            self.fetch_timeout = float(fetch_timeout)
+        self.cache = {}
+        self.attempted = {}
+        self.inflight = {}
+        self.counters = { 'hits': 0, 'misses': 0, 'shared': 0, 'stale': 0, 'errors': 0, 'open': 0 }
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(self.registry)),
+            thread_name_prefix='quarian-oracle')
+
+
+    def get_highest_known_block(self, sources=None):
+        """Returns (block, provider) for the highest block across sources,
+        all of get_highest_from unless `sources` narrows it down."""
+        answers = []
+        pending = {}
+        queue = []
+        for source in (self.sources if sources is None else sources):
+            if source not in self.registry:
+                self.console.warn("Unknown blockchain provider %s" % source)
+            else:
+                queue.append(source)
+        wanted = self._wanted(len(queue))
+
+        # cached answers first; in 'fastest' mode fetches are started one
+        # at a time below instead
+        for source in list(queue):
+            if self.strategy == 'fastest' and (answers or pending):
+                break
+            queue.remove(source)
+            self._start(source, answers, pending)
+
+        deadline = time.time() + self.fetch_timeout
+        hedge_at = time.time() + self.hedge_seconds
+        while len(answers) < wanted and (pending or queue):
+            now = time.time()
+            if now >= deadline:
+                break
+            if queue and (not pending or now >= hedge_at):
+                # hedge: the sources we asked are slow or failed
+                self._start(queue.pop(0), answers, pending)
+                hedge_at = now + self.hedge_seconds
+                continue
+            timeout = deadline - now
+            if queue:
+                timeout = min(timeout, hedge_at - now)
+            done, _ = wait(list(pending), timeout=max(0, timeout), return_when=FIRST_COMPLETED)
+            for future in done:
+                source = pending.pop(future)
+                res = self._resolve(source, future)
+                if res is not False:
+                    answers.append((res, source))
+
+        # anything still out keeps running and fills the cache for later
+        for future, source in pending.items():
+            if len(answers) >= wanted:
+                break
+            res = self._stale(source, "did not answer within %ds" % self.fetch_timeout)
+            if res is not False:
+                answers.append((res, source))
+
+        if len(answers) == 0:
+            self.console.error("Do not have a highest block from sources.")
+            return (0, 'failure')
+        return max(answers, key=lambda answer: answer[0])
+
+
+    def stats(self):
+        """Returns a copy of the hit/miss/shared/stale/error/open counters."""
+        with self.lock:
+            return dict(self.counters)
+
+
+    def source_stats(self):
+        """Latency and breaker state of every source in use."""
+        return dict((source, self.registry[source].stats())
+            for source in self.sources if source in self.registry)
+
+
+    def local_sources(self):
+        """Sources in use that are worked out in this process, like 'fleet'."""
+        return [source for source in self.sources
+            if source in self.registry and self.registry[source].local]
+
+
+    def remote_sources(self):
+        """Sources in use that have to be asked over the network."""
+        return [source for source in self.sources
+            if source in self.registry and not self.registry[source].local]
+
+
+    def _wanted(self, available):
+        if self.strategy == 'fastest':
+            return min(1, available)
+        if self.strategy == 'quorum':
+            return min(max(1, self.quorum), available)
+        return available
+
+
+    def _start(self, source, answers, pending):
+        res = self._lookup(source)
+        if isinstance(res, int):
+            answers.append((res, source))
+        elif res is not None:
+            pending[res] = source
+
+
+    def _lookup(self, source):
+        """Returns a usable block number, None if the source has nothing to
+        offer right now, or a future for a fetch to wait on."""
+        with self.lock:
+            now = time.time()
+            entry = self.cache.get(source)
+            if entry is not None and now - entry[1] < self.ttl_seconds:
+                self.counters['hits'] += 1
+                return entry[0]
+            stale = entry[0] if entry is not None and now - entry[1] < self.stale_seconds else None
+            future = self.inflight.get(source)
+            if future is None:
+                if not self.registry[source].local and \
+                        now - self.attempted.get(source, 0) < self.ttl_seconds:
+                    # failed recently, don't hammer it again until the TTL is up
+                    if stale is not None:
+                        self.counters['stale'] += 1
+                    return stale
+                if not self.registry[source].breaker.allow(now):
+                    self.counters['open'] += 1
+                    return stale
+                self.counters['misses'] += 1
+                self.attempted[source] = now
+                future = self.executor.submit(self._fetch, source)
+                self.inflight[source] = future
+            else:
+                self.counters['shared'] += 1
+            if stale is not None:
+                # refresh in the background, answer now
+                self.counters['stale'] += 1
+                return stale
+            return future
+
+
+    def _fetch(self, source):
+        try:
+            res = self.registry[source].fetch()
+            if res is not False and res is not None:
+                with self.lock:
+                    self.cache[source] = (int(res), time.time())
+                return int(res)
+            return False
+        finally:
+            with self.lock:
+                self.inflight.pop(source, None)
+
+
+    def _resolve(self, source, future):
+        """Result of a finished fetch, falling back to a stale value."""
+        try:
+            res = future.result()
+        except Exception as e:
+            self.console.error("Error getting highest block from source %s: %s" % (source, e))
+            res = False
+        if res is not False:
+            return res
+        return self._stale(source, "failed")
+
+
+    def _stale(self, source, why):
+        with self.lock:
+            self.counters['errors'] += 1
+            entry = self.cache.get(source)
+            if entry is not None and time.time() - entry[1] < self.stale_seconds:
+                self.counters['stale'] += 1
+                return entry[0]
+        self.console.warn("Source %s %s" % (source, why))
+        return False
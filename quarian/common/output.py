@@ -1,58 +1,203 @@
 """
     Output
-    Handles output to stdout for now, will eventually use logging.
+    Handles output to stdout. Records are queued by the caller and
+    formatted and written in batches by a background writer thread.
 """
 
 from colored import fg, bg, attr
+import atexit
+import json
+import queue
+import sys
+import threading
 import time
 
 class OutputException(Exception):
     pass
 
 class Output(object):
-    """A wrapper for EGS output to stdout, stderr, etc."""
+    """A wrapper for EGS output to stdout, stderr, etc.
+
+    Level checks happen before anything is formatted, and messages accept
+    logging-style arguments (`console.debug("at %d (%s)", block, uri)`) so
+    suppressed messages cost a comparison. Fields bound with bind() (the
+    core binds `node` and `check`) are attached to every record logged
+    from the same thread, and are emitted as keys in 'json' format."""
 
     loglevel = None
     levels = [ 'off', 'fatal', 'error', 'warn', 'info', 'debug', 'trace' ]
+    formats = [ 'text', 'json' ]
+    log_format = 'text'
+    # records written per batch, and how long to wait for a batch to fill
+    batch_size = 256
+    flush_interval = 0.2
+    # records beyond this are dropped (and counted) rather than block callers
+    max_queued = 100000
+
+    tags = {
+        'fatal': (fg('red'), "[FATAL]"),
+        'error': (fg('red'), "[ERROR]"),
+        'warn': (fg('yellow'), "[WARN] "),
+        'info': (fg('cyan'), "[INFO] "),
+        'debug': (fg('magenta'), "[DEBUG]"),
+        'trace': (fg('magenta'), "[TRACE]")
+    }
 
-    def __init__(self):
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdout
         self.set_loglevel('info')
+        self.dropped = 0
+        self.queue = queue.Queue(self.max_queued)
+        self.context = threading.local()
+        self.static_fields = None
+        self._last_second = None
+        self._last_logtime = None
+        self.writer = threading.Thread(target=self._drain, name='quarian-output', daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
 
     def set_loglevel(self, level):
         if not level.lower() in self.levels:
-            raise Exception("Unsupported log level %d" % level)
+            raise OutputException("Unsupported log level %s" % level)
         else:
             self.loglevel = self.levels.index(level.lower())
 
-    def log(self, msg, level='info'):
-        level = self._getlevel(level)
-        if level <= self.loglevel:
-            # TODO use stderr, stdout properly
-            # TODO use logging
-            print(msg, flush=True)
+    def set_format(self, log_format):
+        if not log_format.lower() in self.formats:
+            raise OutputException("Unsupported log format %s" % log_format)
+        self.log_format = log_format.lower()
+
+    def enabled(self, level):
+        """True if messages at `level` would be written."""
+        return self._getlevel(level) <= self.loglevel
+
+    def bind(self, **fields):
+        """Attach fields to every record logged from this thread."""
+        bound = getattr(self.context, 'fields', None)
+        self.context.fields = dict(bound or {}, **fields)
+
+    def bind_all(self, **fields):
+        """Attach fields to every record logged from any thread."""
+        self.static_fields = dict(self.static_fields or {}, **fields)
+
+    def unbind(self, *names):
+        """Remove bound fields, or all of them if no names are given."""
+        bound = getattr(self.context, 'fields', None)
+        if not bound:
+            return
+        if not names:
+            self.context.fields = None
+        else:
+            # queued records hold a reference to the old dict, don't mutate it
+            self.context.fields = dict((k, v) for k, v in bound.items() if k not in names)
+
+    def log(self, msg, level='info', *args):
+        if self._getlevel(level) > self.loglevel:
+            return
+        self._enqueue(level, msg, args)
+
+    def error(self, msg, *args):
+        if self.loglevel >= 2:
+            self._enqueue('error', msg, args)
+
+    def warn(self, msg, *args):
+        if self.loglevel >= 3:
+            self._enqueue('warn', msg, args)
+
+    def info(self, msg, *args):
+        if self.loglevel >= 4:
+            self._enqueue('info', msg, args)
+
+    def debug(self, msg, *args):
+        if self.loglevel >= 5:
+            self._enqueue('debug', msg, args)
+
+    def flush(self, timeout=5):
+        """Block until everything queued so far has been written."""
+        done = threading.Event()
+        try:
+            self.queue.put(done, timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
 
-    def warn(self, msg):
-        msg = self._pad(msg)
-        msg = "%s %s[WARN]  %s%s" % (self._logtime(), fg('yellow'), attr(0), msg)
-        return self.log(msg, 'warn')
+    def close(self):
+        """Write out anything still queued and stop the writer."""
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join(5)
 
-    def error(self, msg):
-        msg = self._pad(msg)
-        msg = "%s %s[ERROR] %s%s" % (self._logtime(), fg('red'), attr(0), msg)
-        return self.log(msg, 'error')
+    def _enqueue(self, level, msg, args):
+        fields = getattr(self.context, 'fields', None)
+        if self.static_fields:
+            fields = dict(self.static_fields, **(fields or {}))
+        record = (time.time(), level, msg, args, fields)
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
 
-    def info(self, msg):
-        msg = self._pad(msg)
-        msg = "%s %s[INFO]  %s%s" % (self._logtime(), fg('cyan'), attr(0), msg)
-        return self.log(msg, 'info')
+    def _drain(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                remaining = deadline - time.time()
+                try:
+                    if remaining > 0:
+                        batch.append(self.queue.get(timeout=remaining))
+                    else:
+                        batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            waiters = []
+            for record in batch:
+                if record is None:
+                    running = False
+                elif isinstance(record, threading.Event):
+                    waiters.append(record)
+                else:
+                    try:
+                        lines.append(self._format(record))
+                    except Exception as e:
+                        lines.append("Unformattable log record %r: %s\n" % (record[2], e))
+            if self.dropped:
+                lines.append("Output queue full, dropped %d records\n" % self.dropped)
+                self.dropped = 0
+            if lines:
+                try:
+                    self.stream.write(''.join(lines))
+                    self.stream.flush()
+                except Exception:
+                    pass
+            for waiter in waiters:
+                waiter.set()
 
-    def debug(self, msg):
-        msg = self._pad(msg)
-        msg = "%s %s[DEBUG] %s%s" % (self._logtime(), fg('magenta'), attr(0), msg)
-        return self.log(msg, 'debug')
+    def _format(self, record):
+        created, level, msg, args, fields = record
+        if args:
+            msg = msg % args
+        if self.log_format == 'json':
+            entry = {
+                'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(created)) + \
+                    ('.%03dZ' % ((created % 1) * 1000)),
+                'level': level,
+                'msg': msg
+            }
+            if fields:
+                entry.update(fields)
+            return json.dumps(entry, ensure_ascii=False) + "\n"
+        color, tag = self.tags[level]
+        return "%s %s%s %s%s\n" % (self._logtime(created), color, tag, attr(0), self._pad(msg))
 
-    def _logtime(self):
-        return time.strftime('[%Y-%m-%d %H:%M:%S]')
+    def _logtime(self, created):
+        second = int(created)
+        if second != self._last_second:
+            self._last_second = second
+            self._last_logtime = time.strftime('[%Y-%m-%d %H:%M:%S]', time.localtime(created))
+        return self._last_logtime
 
     def _getlevel(self, level):
         level = level.lower()
@@ -64,9 +209,6 @@ class Output(object):
     def _pad(self, string):
         """Pad trailing multilines"""
         lines = string.split("\n")
-        skip = True
-        for line in lines:
-            if skip:
-                skip = False
-            line = "                           " + line
+        for i in range(1, len(lines)):
+            lines[i] = "                           " + lines[i]
         return "\n".join(lines)
@@ -0,0 +1,111 @@
+"""
+    Plugins
+    Resolves check names from the checklist to check classes, importing
+    only the checks that are actually used.
+"""
+
+import importlib
+import inspect
+import threading
+
+ENTRY_POINT_GROUP = 'quarian.checks'
+
+# built-in checks, by "module:Class" so naming one does not import it
+_registry = {
+    'chaintip': 'quarian.checks.chaintip:CheckChainTip',
+    'cron': 'quarian.checks.timer:CheckTimer',
+    'peercount': 'quarian.checks.peercount:CheckPeerCount',
+    'proxy': 'quarian.checks.proxy:CheckProxy',
+    'timer': 'quarian.checks.timer:CheckTimer'
+}
+_lock = threading.Lock()
+
+
+class PluginException(Exception):
+    pass
+
+
+def register_check(name, target=None):
+    """Register a check under `name`. `target` is a CheckBase subclass or a
+    "module:Class" string, imported on first use. Without `target` this
+    returns a class decorator:
+
+        @register_check('diskspace')
+        class CheckDiskSpace(CheckBase): ...
+    """
+    if target is None:
+        def decorator(cls):
+            register_check(name, cls)
+            return cls
+        return decorator
+    with _lock:
+        _registry[name] = target
+    return target
+
+
+def registered_checks():
+    """Names of built-in and explicitly registered checks. Entry points and
+    modules dropped into quarian/checks are only found when asked for."""
+    with _lock:
+        return sorted(_registry)
+
+
+def load_check(name):
+    """The check class for `name`, imported now if it has not been.
+    Looks at registered checks, then the 'quarian.checks' entry point
+    group, then for a module of that name in quarian/checks."""
+    with _lock:
+        target = _registry.get(name)
+    if target is None:
+        target = _from_entry_points(name)
+    if target is None:
+        target = _from_checks_package(name)
+    if target is None:
+        raise PluginException("No check named %s is registered, installed or in quarian/checks" % name)
+    if isinstance(target, str):
+        module_name, _, class_name = target.partition(':')
+        try:
+            target = getattr(importlib.import_module(module_name), class_name)
+        except (ImportError, AttributeError) as e:
+            raise PluginException("Check %s (%s) could not be loaded: %s" % (name, module_name, e))
+    with _lock:
+        _registry[name] = target
+    return target
+
+
+def _from_entry_points(name):
+    try:
+        from importlib import metadata
+    except ImportError:
+        return None
+    try:
+        eps = metadata.entry_points()
+        if hasattr(eps, 'select'):
+            eps = eps.select(group=ENTRY_POINT_GROUP)
+        else:
+            eps = eps.get(ENTRY_POINT_GROUP, [])
+    except Exception:
+        return None
+    for ep in eps:
+        if ep.name == name:
+            try:
+                return ep.load()
+            except Exception as e:
+                raise PluginException("Check %s from entry point %s could not be loaded: %s" % \
+                    (name, ep.value, e))
+    return None
+
+
+def _from_checks_package(name):
+    """A check module dropped into quarian/checks without registering it."""
+    from quarian.checks.base import CheckBase
+    try:
+        module = importlib.import_module("quarian.checks.%s" % name)
+    except ImportError as e:
+        if getattr(e, 'name', None) == "quarian.checks.%s" % name:
+            return None
+        raise PluginException("Check %s could not be loaded: %s" % (name, e))
+    for _, cls in inspect.getmembers(module, inspect.isclass):
+        if issubclass(cls, CheckBase) and cls is not CheckBase and cls.__module__ == module.__name__:
+            return cls
+    return None
@@ -0,0 +1,140 @@
+"""
+    Poller
+    Runs every node's checklist in parallel on a bounded worker pool.
+"""
+
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Poller(object):
+    """Concurrent polling engine. Each node's checklist runs on its own
+    worker and dispatch() never waits for it, so a single black-holed node
+    can never hold back the others: every RPC call made for a node in one
+    poll shares node_deadline_seconds, and once it is spent the rest fail
+    at once. A node that is still busy when it is dispatched again is
+    skipped rather than queued twice."""
+
+    max_concurrent_nodes = 16
+    node_deadline_seconds = 20
+
+    def __init__(self, core, max_concurrent_nodes=None, node_deadline_seconds=None):
+        self.core = core
+        self.console = core.console
+        if max_concurrent_nodes is not None:
+            self.max_concurrent_nodes = int(max_concurrent_nodes)
+        if node_deadline_seconds is not None:
+            self.node_deadline_seconds = int(node_deadline_seconds)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrent_nodes,
+            thread_name_prefix='quarian-node')
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+
+    def dispatch(self, nodes, on_done=None):
+        """Queue a poll of every node in `nodes`. `on_done(node, result)` is
+        called from the worker once a node's checklist finishes; `result` is
+        what Quarian.check returned, or None if it raised."""
+        dispatched = []
+        for node in nodes:
+            with self.lock:
+                if node in self.in_flight:
+                    self.console.warn("Node busy for %ds, skipping (%s)" % \
+                        (time.time() - self.in_flight[node], node))
+                    continue
+                self.in_flight[node] = time.time()
+            self.executor.submit(self._run_node, node, on_done)
+            dispatched.append(node)
+        return dispatched
+
+
+    def dispatch_batch(self, nodes, on_done=None):
+        """Like dispatch(), but the checklists run once for the whole batch:
+        every node's snapshot is taken on its own worker, and the worker
+        that takes the last one hands them all to Quarian.evaluate_batch.
+        A slow node delays the batch's decisions, never the other polls."""
+        batch = { 'nodes': [], 'snapshots': [], 'left': 0, 'started': time.time() }
+        with self.lock:
+            for node in nodes:
+                if node in self.in_flight:
+                    self.console.warn("Node busy for %ds, skipping (%s)" % \
+                        (time.time() - self.in_flight[node], node))
+                    continue
+                self.in_flight[node] = time.time()
+                batch['nodes'].append(node)
+            batch['left'] = len(batch['nodes'])
+        for node in batch['nodes']:
+            self.executor.submit(self._collect_node, node, batch, on_done)
+        return batch['nodes']
+
+
+    def busy(self):
+        with self.lock:
+            return len(self.in_flight)
+
+
+    def _collect_node(self, node, batch, on_done):
+        started = time.time()
+        snapshot = None
+        try:
+            snapshot = self.core.collect(node)
+        except Exception as e:
+            self.console.error("Polling node raised %s (%s)" % (e, node))
+        self._check_deadline(node, time.time() - started)
+        with self.lock:
+            if snapshot is not None:
+                batch['snapshots'].append((node, snapshot))
+            batch['left'] -= 1
+            if batch['left']:
+                return
+        self._evaluate_batch(batch, on_done)
+
+
+    def _evaluate_batch(self, batch, on_done):
+        results = {}
+        try:
+            results = self.core.evaluate_batch(batch['snapshots'])
+        except Exception as e:
+            self.console.error("Evaluating a batch of %d nodes raised %s" % (len(batch['nodes']), e))
+        finally:
+            elapsed = time.time() - batch['started']
+            if elapsed > self.node_deadline_seconds:
+                self.console.warn("Batch of %d nodes took %.1fs, over the %ds deadline" % \
+                    (len(batch['nodes']), elapsed, self.node_deadline_seconds))
+            with self.lock:
+                for node in batch['nodes']:
+                    self.in_flight.pop(node, None)
+        if on_done is not None:
+            for node in batch['nodes']:
+                try:
+                    on_done(node, results.get(node))
+                except Exception as e:
+                    self.console.error("Poll callback failed: %s (%s)" % (e, node))
+
+
+    def _run_node(self, node, on_done):
+        started = time.time()
+        result = None
+        try:
+            result = self.core.check(node)
+        except Exception as e:
+            self.console.error("Polling node raised %s (%s)" % (e, node))
+        finally:
+            self._check_deadline(node, time.time() - started)
+            with self.lock:
+                self.in_flight.pop(node, None)
+        if on_done is not None:
+            try:
+                on_done(node, result)
+            except Exception as e:
+                self.console.error("Poll callback failed: %s (%s)" % (e, node))
+
+
+    def _check_deadline(self, node, elapsed):
+        # the node's RPC calls were cut off at the deadline, count it anyway
+        if elapsed > self.node_deadline_seconds:
+            self.core.metrics.deadline_overruns.inc(node=node)
+            self.console.warn("Node took %.1fs, over its %ds deadline (%s)" % \
+                (elapsed, self.node_deadline_seconds, node))
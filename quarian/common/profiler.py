@@ -0,0 +1,207 @@
+"""
+    Profiler
+    Wall and CPU time of the polling hot path, by cycle, node, check and
+    RPC method, for `quarian.py --profile`.
+"""
+
+import functools
+import threading
+import time
+
+from .clients import NodeClient
+
+
+class Profiler(object):
+    """Times the hot path by wrapping its methods when installed, so a
+    Quarian started without --profile runs exactly the code it always has.
+    Every wrapped call is a frame on a per-thread stack, and its wall and
+    CPU time (of the calling thread) are added to its stack path, e.g.
+
+        node;check:chaintip;rpc:eth_syncing
+
+    with time spent in wrapped callees counted separately as "self" time.
+    Roots are `node` (one node's poll), `batch` (checks over a batch of
+    nodes), `cycle` (the main loop handing out polls), `restart` and
+    `log_format` (the log writer thread). Node polls are also totalled
+    per node.
+
+    Every `interval_seconds` the report is logged in short and written to
+    `<prefix>.txt` in full, with `<prefix>.folded` next to it holding the
+    collapsed stacks (self wall time in microseconds) for flamegraph.pl or
+    speedscope. Figures are totals since startup."""
+
+    interval_seconds = 60
+    top = 20
+
+    def __init__(self, core, prefix, interval_seconds=None):
+        self.core = core
+        self.console = core.console
+        self.prefix = prefix
+        if interval_seconds is not None:
+            self.interval_seconds = float(interval_seconds)
+        # path -> [calls, wall, self wall, cpu, self cpu]
+        self.paths = {}
+        # uri -> [polls, wall, cpu]
+        self.nodes = {}
+        self.started = time.time()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+
+    def install(self):
+        """Wrap the core's hot path. Checks loaded later, e.g. by a
+        settings reload, are wrapped as they are created."""
+        core = self.core
+        self.wrap(core, 'check', 'node', node=True)
+        self.wrap(core, 'collect', 'node', node=True)
+        self.wrap(core, 'evaluate', 'evaluate')
+        self.wrap(core, 'evaluate_batch', 'batch')
+        self.wrap(core, 'take_snapshot', 'rpc:batch')
+        self.wrap(core, '_record_history', 'history')
+        self.wrap(core, '_conclude', 'conclude')
+        self.wrap(core, 'get_highest_known_block', 'chain_tip')
+        self.wrap(core.poller, 'dispatch', 'cycle')
+        self.wrap(core.poller, 'dispatch_batch', 'cycle')
+        self.wrap(core.restarts, 'restart', 'restart')
+        self.wrap(core.console, '_enqueue', 'log')
+        self.wrap(core.console, '_format', 'log_format')
+        self.wrap(NodeClient, 'call', lambda client, method, *args, **kwargs: 'rpc:%s' % method)
+        self.wrap(NodeClient, 'post', 'rpc:post')
+        web3 = NodeClient.__dict__['web3']
+        NodeClient.web3 = property(self._timed(web3.fget, 'web3'))
+        for check_instance in core.check_instances.values():
+            self._wrap_check(check_instance)
+        instantiate = core._instantiate_check
+
+        def instantiate_check(name):
+            return self._wrap_check(instantiate(name))
+        core._instantiate_check = instantiate_check
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='quarian-profile', daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        self.stopping.set()
+        self.write()
+
+
+    def wrap(self, owner, attr, name, node=False):
+        """Replace `owner.attr` with a timed version. `name` is the frame
+        name, or a callable building it from the call's arguments."""
+        setattr(owner, attr, self._timed(getattr(owner, attr), name, node))
+
+
+    def report(self):
+        """The full report, as text."""
+        with self.lock:
+            paths = dict((path, list(stats)) for path, stats in self.paths.items())
+            nodes = dict((uri, list(stats)) for uri, stats in self.nodes.items())
+        elapsed = time.time() - self.started
+        lines = ["Profile of %.0fs, totals since startup" % elapsed, "",
+            "%10s %10s %10s %10s %9s  %s" % ('wall s', 'self wall', 'cpu s', 'self cpu', 'calls', 'path')]
+        for path, stats in sorted(paths.items(), key=lambda item: -item[1][2])[:self.top * 2]:
+            calls, wall, self_wall, cpu, self_cpu = stats
+            lines.append("%10.3f %10.3f %10.3f %10.3f %9d  %s" % (wall, self_wall, cpu, self_cpu,
+                calls, ';'.join(path)))
+        lines.extend(["", "%10s %10s %10s %9s  %s" % ('wall s', 'per poll', 'cpu s', 'polls', 'node')])
+        for uri, stats in sorted(nodes.items(), key=lambda item: -item[1][1])[:self.top]:
+            polls, wall, cpu = stats
+            lines.append("%10.3f %9.1fms %10.3f %9d  %s" % (wall, 1000 * wall / polls, cpu, polls, uri))
+        return "\n".join(lines) + "\n"
+
+
+    def folded(self):
+        """Collapsed stacks: one `frame;frame;frame microseconds` line per
+        path, the self wall time spent in it."""
+        with self.lock:
+            paths = [(path, stats[2]) for path, stats in self.paths.items()]
+        return "".join("%s %d\n" % (';'.join(path), int(self_wall * 1e6))
+            for path, self_wall in sorted(paths) if self_wall >= 1e-6)
+
+
+    def summary(self):
+        """One line: where the hot path's wall and CPU time went, by frame."""
+        parts = []
+        for label, index in (('wall', 2), ('cpu', 4)):
+            frames = {}
+            with self.lock:
+                for path, stats in self.paths.items():
+                    frames[path[-1]] = frames.get(path[-1], 0) + stats[index]
+            total = sum(frames.values())
+            if not total:
+                return "nothing profiled yet"
+            parts.append("%s %s" % (label, ", ".join("%s %.0f%%" % (name, 100 * seconds / total)
+                for name, seconds in sorted(frames.items(), key=lambda item: -item[1])[:6])))
+        return "; ".join(parts)
+
+
+    def write(self):
+        try:
+            with open("%s.txt" % self.prefix, 'w') as f:
+                f.write(self.report())
+            with open("%s.folded" % self.prefix, 'w') as f:
+                f.write(self.folded())
+        except OSError as e:
+            self.console.error("Could not write profile %s: %s" % (self.prefix, e))
+
+
+    def _run(self):
+        while not self.stopping.wait(self.interval_seconds):
+            self.write()
+            self.console.info("Profile: %s (%s.txt, %s.folded)" % (self.summary(),
+                self.prefix, self.prefix))
+
+
+    def _wrap_check(self, check_instance):
+        name = check_instance.name
+        self.wrap(check_instance, 'check', 'check:%s' % name)
+        self.wrap(check_instance, 'evaluate_fleet', 'check:%s' % name)
+        self.wrap(check_instance, 'in_spec', 'in_spec:%s' % name)
+        self.wrap(check_instance, 'set_geth_instance', 'set_geth_instance')
+        return check_instance
+
+
+    def _timed(self, function, name, node=False):
+        profiler = self
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            stack = getattr(profiler.local, 'stack', None)
+            if stack is None:
+                stack = profiler.local.stack = []
+            frame = [name(*args, **kwargs) if callable(name) else name, 0.0, 0.0]
+            stack.append(frame)
+            wall = time.perf_counter()
+            cpu = time.thread_time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                wall = time.perf_counter() - wall
+                cpu = time.thread_time() - cpu
+                path = tuple(entry[0] for entry in stack)
+                stack.pop()
+                if stack:
+                    stack[-1][1] += wall
+                    stack[-1][2] += cpu
+                with profiler.lock:
+                    stats = profiler.paths.get(path)
+                    if stats is None:
+                        stats = profiler.paths[path] = [0, 0.0, 0.0, 0.0, 0.0]
+                    stats[0] += 1
+                    stats[1] += wall
+                    stats[2] += wall - frame[1]
+                    stats[3] += cpu
+                    stats[4] += cpu - frame[2]
+                    if node and args:
+                        totals = profiler.nodes.get(args[0])
+                        if totals is None:
+                            totals = profiler.nodes[args[0]] = [0, 0.0, 0.0]
+                        totals[0] += 1
+                        totals[1] += wall
+                        totals[2] += cpu
+        return timed
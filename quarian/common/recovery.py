@@ -0,0 +1,189 @@
+"""
+    Recovery
+    Follows restarted nodes until they are serving and importing blocks.
+"""
+
+import threading
+
+import requests
+
+
+class RecoveryTracker(object):
+    """Watches every node whose restart command succeeded. Until the node
+    answers RPC again and its block height moves, its checks are
+    suppressed: a node that is still starting up is unreachable or stalled
+    by nature, and restarting it again only starts it over.
+
+    Recovery is timed from when the restart command returned: time to RPC
+    is until the first poll the node answers, time to tip until the first
+    poll it is within `tip_blocks` of the chain tip. Both are observed per
+    node and restart reason. A node that isn't back at the tip within
+    `timeout_seconds` is handed back to its checks and no longer followed.
+
+    A restart handed to the http-restarter may leave the old geth answering
+    for a while, so an answer only counts once the node has been seen down
+    since, or the restarter's /ready has seen geth answer after the job.
+    /ready is asked at most once every `ready_interval_seconds` per job;
+    polls in between reuse its last answer."""
+
+    tip_blocks = 5
+    timeout_seconds = 900
+    ready_timeout_seconds = 5
+    ready_interval_seconds = 10
+
+    def __init__(self, core, tip_blocks=None, timeout_seconds=None):
+        self.core = core
+        self.console = core.console
+        self.configure(tip_blocks, timeout_seconds)
+        # uri -> restarted, reasons, down, ready, ready_at, ready_answer,
+        # rpc_at, height, importing_at
+        self.entries = {}
+        # uri -> (ready_url, job_id, request_options) of a restart underway
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+
+    def configure(self, tip_blocks=None, timeout_seconds=None):
+        if tip_blocks is not None:
+            self.tip_blocks = int(tip_blocks)
+        if timeout_seconds is not None:
+            self.timeout_seconds = float(timeout_seconds)
+
+
+    def restarter_job(self, uri, ready_url, job_id, request_options=None):
+        """Note that `uri` is being restarted by http-restarter job `job_id`,
+        whose /ready is at `ready_url`. `request_options` (headers, cert)
+        are passed to requests when asking it."""
+        with self.lock:
+            self.jobs[uri] = (ready_url, job_id, request_options or {})
+
+
+    def restarted(self, uri, reasons, now=None):
+        """Start following `uri`, whose restart just succeeded."""
+        with self.lock:
+            self.entries[uri] = {
+                'restarted': self.core.clock() if now is None else now,
+                'reasons': list(reasons),
+                'down': False,
+                'ready': self.jobs.pop(uri, None),
+                'ready_at': None,
+                'ready_answer': False,
+                'rpc_at': None,
+                'height': None,
+                'importing_at': None
+            }
+
+
+    def is_tracking(self, uri):
+        return uri in self.entries
+
+
+    def is_suppressed(self, uri):
+        """True while the node's checks should not run."""
+        entry = self.entries.get(uri)
+        return entry is not None and entry['importing_at'] is None
+
+
+    def recovering_count(self):
+        with self.lock:
+            return sum(1 for entry in self.entries.values() if entry['importing_at'] is None)
+
+
+    def forget(self, uri):
+        with self.lock:
+            self.entries.pop(uri, None)
+            self.jobs.pop(uri, None)
+
+
+    def observe(self, uri, snapshot):
+        """Follow a poll of a restarted node. Returns True if its checks
+        should still be suppressed."""
+        with self.lock:
+            entry = self.entries.get(uri)
+            if entry is None:
+                return False
+            if snapshot.error is not None:
+                entry['down'] = True
+            waiting = entry['rpc_at'] is None and not entry['down'] and entry['ready'] is not None
+        now = self.core.clock()
+        elapsed = now - entry['restarted']
+        height = self._height(uri, snapshot)
+        if height is not None and waiting and not self._restarter_ready(uri, entry, now):
+            # may still be the geth that is being restarted
+            height = None
+        if height is not None:
+            with self.lock:
+                first = entry['rpc_at'] is None
+                importing = not first and entry['importing_at'] is None and height > entry['height']
+                if first:
+                    entry['rpc_at'] = now
+                    entry['height'] = height
+                elif importing:
+                    entry['importing_at'] = now
+            if first:
+                self._observe(self.core.metrics.restart_time_to_rpc, entry, uri, elapsed)
+                self.console.info("Node answering RPC %.1fs after its restart, at block %d (%s)" % \
+                    (elapsed, height, uri))
+            elif importing:
+                self.console.info("Node importing blocks %.1fs after its restart, resuming checks (%s)" % \
+                    (elapsed, uri))
+            tip, provider = self.core.get_highest_known_block()
+            # without a tip there is nothing to measure against, keep following
+            if provider != 'failure' and tip - height <= self.tip_blocks:
+                self._observe(self.core.metrics.restart_time_to_tip, entry, uri, elapsed)
+                self.console.info("Node back at the chain tip %.1fs after its restart (%s)" % \
+                    (elapsed, uri))
+                self.forget(uri)
+                return False
+        if elapsed > self.timeout_seconds:
+            self.console.warn("Node not back at the chain tip %ds after its restart, " \
+                "no longer following it (%s)" % (elapsed, uri))
+            self.forget(uri)
+            return False
+        with self.lock:
+            return entry['importing_at'] is None
+
+
+    def _restarter_ready(self, uri, entry, now):
+        """Whether the http-restarter has seen geth answer since the
+        entry's job finished, asking it again only once the last answer is
+        `ready_interval_seconds` old."""
+        if entry['ready_at'] is not None and now - entry['ready_at'] < self.ready_interval_seconds:
+            return entry['ready_answer']
+        answer = self._ask_restarter(uri, *entry['ready'])
+        with self.lock:
+            entry['ready_at'] = now
+            entry['ready_answer'] = answer
+        return answer
+
+
+    def _ask_restarter(self, uri, ready_url, job_id, request_options):
+        """Asks the restarter's /ready about job `job_id`. A restarter that
+        can't be asked is trusted to have finished, as its job said."""
+        try:
+            res = requests.get(ready_url, **dict(request_options, timeout=self.ready_timeout_seconds))
+            ready = res.json()
+        except (requests.RequestException, ValueError) as e:
+            self.console.debug("Could not ask the restarter whether geth is back: %s (%s)", e, uri)
+            return True
+        if ready.get('job_id') != job_id:
+            # a newer job, which only follows ours finishing
+            return True
+        return ready.get('time_to_rpc') is not None
+
+
+    def _height(self, uri, snapshot):
+        if snapshot.has('eth_blockNumber'):
+            try:
+                return int(snapshot.results['eth_blockNumber'], 16)
+            except (TypeError, ValueError):
+                return None
+        if snapshot.error is None:
+            # polled without eth_blockNumber, the subscription has it
+            return self.core.heads.head(uri)
+        return None
+
+
+    def _observe(self, histogram, entry, uri, elapsed):
+        for reason in entry['reasons']:
+            histogram.observe(elapsed, node=uri, reason=reason)
@@ -0,0 +1,303 @@
+"""
+    Replay
+    Runs a recorded trace through the real checks on a virtual clock.
+"""
+
+import json
+import time
+
+from collections import Counter
+
+from .clients import RPCError
+from .core import Quarian
+from .trace import TraceReader, rebuild_snapshot
+
+
+class VirtualClock(object):
+    """Stands in for time.time. Only moves forward, to the timestamp of
+    the record being replayed."""
+
+    def __init__(self, start=0.0):
+        self.now = float(start)
+
+    def time(self):
+        return self.now
+
+    def set(self, ts):
+        if ts > self.now:
+            self.now = ts
+
+
+class ReplayOracle(object):
+    """Answers with the chain tip the trace says the core had."""
+
+    sources = []
+
+    def __init__(self):
+        self.tip = (0, 'failure')
+
+    def get_highest_known_block(self, sources=None):
+        return self.tip
+
+    def local_sources(self):
+        return []
+
+    def remote_sources(self):
+        return []
+
+    def stats(self):
+        return {}
+
+    def source_stats(self):
+        return {}
+
+
+class ReplayHeads(object):
+    """Recorded subscription heads, stale after head_stale_seconds of
+    virtual time like the live HeadTracker."""
+
+    reference = None
+
+    def __init__(self, core):
+        self.core = core
+        self.heads = {}
+
+    def head(self, uri):
+        entry = self.heads.get(uri)
+        if entry is None or self.core.clock() - entry[1] > self.core.head_stale_seconds:
+            return None
+        return entry[0]
+
+    def update(self, uri, number, ts):
+        self.heads[uri] = (number, ts)
+        self.core.history.record(uri, 'height', number, ts)
+
+    def follow(self, uri, reference=False):
+        pass
+
+    def unfollow(self, uri):
+        pass
+
+
+class ReplayClient(object):
+    """Answers call() from the node's recorded calls, then from its last
+    replayed snapshot. Anything else was never seen, so it raises."""
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.calls = {}
+        self.results = {}
+
+    def record(self, method, params, result):
+        self.calls[(method, json.dumps(params))] = result
+
+    def call(self, method, params=None):
+        key = (method, json.dumps(params or []))
+        if key in self.calls:
+            return self.calls[key]
+        if not params and method in self.results:
+            return self.results[method]
+        raise RPCError("%s was not recorded in the trace" % method)
+
+    @property
+    def web3(self):
+        raise RPCError("web3 calls are not recorded in traces")
+
+
+class ReplayClients(object):
+
+    def __init__(self, core):
+        self.core = core
+        self.clients = {}
+
+    def get(self, uri):
+        client = self.clients.get(uri)
+        if client is None:
+            client = ReplayClient(uri)
+            self.clients[uri] = client
+        return client
+
+    def timeout(self):
+        return (self.core.rpc_connect_timeout_seconds, self.core.rpc_timeout_seconds)
+
+    def set_deadline(self, deadline):
+        pass
+
+    def discard(self, uri):
+        self.clients.pop(uri, None)
+
+    def close(self):
+        self.clients = {}
+
+
+class ReplayRestarts(object):
+    """Takes the restart decisions instead of carrying them out. A replayed
+    restart is over as soon as it is decided, and the node is followed
+    until it recovers as it would be live."""
+
+    def __init__(self, core):
+        self.core = core
+        self.decisions = []
+        self.outcomes = []
+
+    def submit(self, uri, reasons, routine=False):
+        self.decisions.append((self.core.clock(), uri, list(reasons)))
+        self.core.recovery.restarted(uri, reasons)
+        return True
+
+    def recovered(self, uri):
+        pass
+
+    def is_recovering(self, uri):
+        return False
+
+    def is_pending(self, uri, routine=True):
+        return False
+
+    def pending_count(self):
+        return 0
+
+    def waiting_count(self):
+        return 0
+
+    def restarting_count(self):
+        return 0
+
+    def forget(self, uri):
+        pass
+
+    def configure(self, *args):
+        pass
+
+    def add_listener(self, listener):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class Replay(object):
+    """Feeds a trace recorded with --record through the checks configured
+    in the settings file, as fast as they run. Snapshots, calls, heads and
+    chain tips come from the trace, the clock jumps from one record to the
+    next, and restarts are only counted. Compare the restarts it decides
+    with the ones recorded live to tune allow_trailing_* and grace periods
+    against real incidents."""
+
+    def __init__(self, args, path):
+        self.path = path
+        start, meta = self._start()
+        self.clock = VirtualClock(start)
+        self.core = Quarian(args, clock=self.clock.time)
+        core = self.core
+        if meta.get('reference_node'):
+            # checks compare against the reference node's recorded heights
+            core.reference_node = meta['reference_node']
+        core.oracle = ReplayOracle()
+        core.heads = ReplayHeads(core)
+        core.clients = ReplayClients(core)
+        core.restarts = ReplayRestarts(core)
+        self.live = []
+
+
+    def run(self):
+        """Replays the whole trace and returns the report."""
+        core = self.core
+        counts = Counter()
+        nodes = set()
+        first = None
+        started = time.time()
+        for ts, kind, uri, fields in TraceReader(self.path):
+            self.clock.set(ts)
+            if first is None:
+                first = ts
+            counts[kind] += 1
+            if kind == 's':
+                nodes.add(uri)
+                snapshot = rebuild_snapshot(uri, ts, fields)
+                core.clients.get(uri).results = snapshot.results
+                core.console.bind(node=uri)
+                try:
+                    core.evaluate(uri, snapshot)
+                finally:
+                    core.console.unbind()
+            elif kind == 't':
+                core.oracle.tip = (fields[0], fields[1])
+            elif kind == 'h':
+                core.heads.update(uri, fields[0], ts)
+            elif kind == 'c':
+                core.clients.get(uri).record(*fields)
+            elif kind == 'r':
+                self.live.append((ts, uri, fields[0]))
+        elapsed = time.time() - started
+        core.console.flush()
+        return self._report(counts, nodes, first, elapsed)
+
+
+    def _start(self):
+        """Timestamp of the first record and the header it was written under."""
+        reader = TraceReader(self.path)
+        for ts, kind, uri, fields in reader:
+            return ts, reader.meta
+        raise ValueError("Trace %s is empty" % self.path)
+
+
+    def _report(self, counts, nodes, first, elapsed):
+        span = self.clock.now - first if first is not None else 0
+        decided = self.core.restarts.decisions
+        replayed = Counter()
+        live = Counter()
+        for ts, uri, reasons in decided:
+            for reason in reasons:
+                replayed[reason] += 1
+        for ts, uri, reasons in self.live:
+            for reason in reasons:
+                live[reason] += 1
+        per_node = {}
+        for ts, uri, reasons in decided:
+            per_node.setdefault(uri, [0, 0])[0] += 1
+        for ts, uri, reasons in self.live:
+            per_node.setdefault(uri, [0, 0])[1] += 1
+        return {
+            'trace': self.path,
+            'records': sum(counts.values()),
+            'snapshots': counts['s'],
+            'nodes': len(nodes),
+            'span_sec': round(span, 1),
+            'elapsed_sec': round(elapsed, 3),
+            'speedup': round(span / elapsed, 1) if elapsed > 0 else None,
+            'restarts': {
+                'replayed': len(decided),
+                'live': len(self.live),
+                'replayed_by_reason': dict(replayed),
+                'live_by_reason': dict(live)
+            },
+            'differing_nodes': dict((uri, { 'replayed': c[0], 'live': c[1] })
+                for uri, c in sorted(per_node.items()) if c[0] != c[1]),
+            'decisions': [{ 'at': ts, 'node': uri, 'reasons': reasons }
+                for ts, uri, reasons in decided]
+        }
+
+
+def format_report(report, limit=20):
+    """Human readable summary of a replay report."""
+    restarts = report['restarts']
+    lines = [
+        "Replayed %s: %d records, %d snapshots of %d nodes" % \
+            (report['trace'], report['records'], report['snapshots'], report['nodes']),
+        "  %.1fs of trace in %.3fs (%sx real time)" % \
+            (report['span_sec'], report['elapsed_sec'], report['speedup']),
+        "  restarts   replayed %d, live %d" % (restarts['replayed'], restarts['live'])
+    ]
+    for reason in sorted(set(restarts['replayed_by_reason']) | set(restarts['live_by_reason'])):
+        lines.append("    %-12s replayed %d, live %d" % (reason,
+            restarts['replayed_by_reason'].get(reason, 0), restarts['live_by_reason'].get(reason, 0)))
+    differing = report['differing_nodes']
+    if differing:
+        lines.append("  nodes restarted a different number of times (%d):" % len(differing))
+        for uri in sorted(differing)[:limit]:
+            lines.append("    %s replayed %d, live %d" % (uri, differing[uri]['replayed'],
+                differing[uri]['live']))
+        if len(differing) > limit:
+            lines.append("    ... and %d more" % (len(differing) - limit))
+    return "\n".join(lines)
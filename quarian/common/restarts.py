@@ -0,0 +1,278 @@
+"""
+    Restarts
+    Runs node restarts off the polling path and rolls them through the
+    fleet a few nodes at a time.
+"""
+
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# how a restart ended, as passed to listeners
+SUCCEEDED = 'success'
+FAILED = 'failure'
+# the restarter merged it into another restart, or throttled it
+MERGED = 'merged'
+
+
+class RestartExecutor(object):
+    """Queues restarts onto a small worker pool so a slow restart command
+    never stalls polling. A node with a restart already queued or running
+    is not restarted again; the new reasons are merged into the pending
+    one. Listeners registered with add_listener are called with
+    (uri, reasons, result, duration) when a restart finishes, where result
+    is SUCCEEDED, FAILED or MERGED.
+
+    Restarts are also rolled through the fleet rather than fired at once.
+    At most `max_restarting_fraction` of the nodes (and at least one) are
+    restarting at a time, where a node counts from when its restart starts
+    until the core reports it back in spec through recovered(), or
+    `recovery_timeout_seconds` pass. Restarts start at least
+    `stagger_seconds` apart, and routine ones, like the timer check's,
+    wait behind restarts of nodes that are actually unwell. Under a
+    ShardSupervisor the limit counts the whole fleet: slots are claimed
+    from the supervisor's shared RestartSlots."""
+
+    max_concurrent_restarts = 4
+    max_restarting_fraction = 0.1
+    stagger_seconds = 10
+    recovery_timeout_seconds = 900
+    history_size = 256
+    # how often to look for a slot freed by another shard
+    shared_slot_poll_seconds = 1
+
+    def __init__(self, core, restart, max_concurrent_restarts=None, max_restarting_fraction=None,
+            stagger_seconds=None, recovery_timeout_seconds=None, slots=None):
+        """`restart` is the blocking callable that restarts one node and
+        returns a Boolean, or MERGED if it was not issued because the
+        restarter merged or throttled it; normally Quarian._restart_geth.
+        `slots` is the fleet's shared RestartSlots when running as a shard."""
+        self.core = core
+        self.console = core.console
+        self.restart = restart
+        self.slots = slots
+        if max_concurrent_restarts is not None:
+            self.max_concurrent_restarts = int(max_concurrent_restarts)
+        self.configure(max_restarting_fraction, stagger_seconds, recovery_timeout_seconds)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrent_restarts,
+            thread_name_prefix='quarian-restart')
+        # queued or running, by uri
+        self.pending = {}
+        # waiting for a slot, repairs ahead of routine restarts
+        self.urgent = deque()
+        self.routine = deque()
+        # uri -> when its restart started, until it is back in spec
+        self.restarting = {}
+        self.last_start = 0
+        self.outcomes = deque(maxlen=self.history_size)
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.dispatcher = threading.Thread(target=self._dispatch,
+            name='quarian-restart-dispatch', daemon=True)
+        self.dispatcher.start()
+
+
+    def configure(self, max_restarting_fraction=None, stagger_seconds=None,
+            recovery_timeout_seconds=None):
+        """Change the rollout limits, e.g. after a settings reload."""
+        if max_restarting_fraction is not None:
+            self.max_restarting_fraction = float(max_restarting_fraction)
+        if stagger_seconds is not None:
+            self.stagger_seconds = float(stagger_seconds)
+        if recovery_timeout_seconds is not None:
+            self.recovery_timeout_seconds = float(recovery_timeout_seconds)
+        wakeup = getattr(self, 'wakeup', None)
+        if wakeup is not None:
+            with wakeup:
+                wakeup.notify()
+
+
+    def submit(self, uri, reasons, routine=False):
+        """Queue a restart of `uri`. Returns False if one was already
+        pending and the request was merged into it."""
+        with self.lock:
+            if uri in self.pending:
+                pending = self.pending[uri]
+                for reason in reasons:
+                    if reason not in pending['reasons']:
+                        pending['reasons'].append(reason)
+                if pending['routine'] and not routine and uri in self.routine:
+                    # it needs a repair now, not maintenance later
+                    self.routine.remove(uri)
+                    self.urgent.append(uri)
+                    pending['routine'] = False
+                    self.wakeup.notify()
+                self.console.debug("Restart already pending, merged %s (%s)" % \
+                    (",".join(reasons), uri))
+                return False
+            self.pending[uri] = { 'reasons': list(reasons), 'queued': time.time(), 'routine': routine }
+            (self.routine if routine else self.urgent).append(uri)
+            self.wakeup.notify()
+        self.console.info("Queued restart for %s (%s)" % (",".join(reasons), uri))
+        return True
+
+
+    def recovered(self, uri):
+        """The node is back in spec after a restart; its slot is free."""
+        if uri not in self.restarting:
+            return
+        with self.lock:
+            if uri in self.pending:
+                # restart command is still running
+                return
+            started = self._free(uri)
+            if started is None:
+                return
+            self.wakeup.notify()
+        self.console.info("Node back in spec %.1fs after its restart started (%s)" % \
+            (time.time() - started, uri))
+
+
+    def is_recovering(self, uri):
+        """True between a node's restart starting and it being back in spec."""
+        return uri in self.restarting
+
+
+    def is_pending(self, uri, routine=True):
+        """True while a restart of `uri` is queued or running. With
+        `routine` False, routine restarts still waiting for a slot don't
+        count, as the node is fine until then."""
+        with self.lock:
+            pending = self.pending.get(uri)
+            if pending is None:
+                return False
+            return routine or not (pending['routine'] and uri in self.routine)
+
+
+    def pending_count(self):
+        with self.lock:
+            return len(self.pending)
+
+
+    def waiting_count(self):
+        with self.lock:
+            return len(self.urgent) + len(self.routine)
+
+
+    def restarting_count(self):
+        with self.lock:
+            return len(self.restarting)
+
+
+    def forget(self, uri):
+        """Drop a node that left the nodelist. A restart already running
+        finishes, one still waiting is dropped."""
+        with self.lock:
+            for queue in (self.urgent, self.routine):
+                if uri in queue:
+                    queue.remove(uri)
+                    self.pending.pop(uri, None)
+            self._free(uri)
+            self.wakeup.notify()
+
+
+    def capacity(self):
+        """How many nodes may be restarting at once, fleet-wide when the
+        slots are shared between shards."""
+        nodes = self.core.fleet_size if self.slots is not None else len(self.core.nodes)
+        return max(1, int(nodes * self.max_restarting_fraction))
+
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+    def _dispatch(self):
+        with self.lock:
+            while True:
+                delay = self._next_start(time.time())
+                if delay == 0:
+                    uri = (self.urgent or self.routine).popleft()
+                    now = time.time()
+                    self.restarting[uri] = now
+                    self.last_start = now
+                    self.executor.submit(self._run, uri)
+                    continue
+                self.wakeup.wait(delay)
+
+
+    def _next_start(self, now):
+        """0 if a queued restart may start now, otherwise how long to wait
+        (None for until something changes). Called with the lock held."""
+        for uri, started in list(self.restarting.items()):
+            if uri not in self.pending and now - started >= self.recovery_timeout_seconds:
+                self._free(uri)
+                self.console.warn("Node not back in spec %ds after its restart, " \
+                    "no longer waiting for it (%s)" % (now - started, uri))
+        if not self.urgent and not self.routine:
+            return None
+        since = now - self.last_start
+        if since < self.stagger_seconds:
+            return self.stagger_seconds - since
+        if not self._take_slot():
+            self.console.debug("%d nodes restarting, %d restarts waiting",
+                len(self.restarting), len(self.urgent) + len(self.routine))
+            waiting = [started + self.recovery_timeout_seconds - now
+                for uri, started in self.restarting.items() if uri not in self.pending]
+            if self.slots is not None:
+                # other shards don't wake us when they free a slot
+                waiting.append(self.shared_slot_poll_seconds)
+            return max(0.1, min(waiting)) if waiting else None
+        return 0
+
+
+    def _take_slot(self):
+        """Claim a restart slot if one is free. Called with the lock held."""
+        if self.slots is None:
+            return len(self.restarting) < self.capacity()
+        return self.slots.take(self.core.shard_index, self.capacity())
+
+
+    def _free(self, uri):
+        """Stop counting `uri` as restarting and give back its slot; returns
+        when its restart started, or None. Called with the lock held."""
+        started = self.restarting.pop(uri, None)
+        if started is not None and self.slots is not None:
+            self.slots.release(self.core.shard_index)
+        return started
+
+
+    def _run(self, uri):
+        started = time.time()
+        result = FAILED
+        try:
+            restarted = self.restart(uri)
+            result = MERGED if restarted == MERGED else SUCCEEDED if restarted else FAILED
+        except Exception as e:
+            self.console.error("Restart raised %s (%s)" % (e, uri))
+        duration = time.time() - started
+        with self.lock:
+            reasons = self.pending.pop(uri)['reasons']
+            if result != SUCCEEDED:
+                # it most likely never went down, don't hold its slot
+                self._free(uri)
+            self.wakeup.notify()
+        outcome = (uri, reasons, result, duration)
+        self.outcomes.append(outcome)
+
+        if result == SUCCEEDED:
+            self.console.info("Restart for %s succeeded in %.1fs (%s)" % \
+                (",".join(reasons), duration, uri))
+        elif result == MERGED:
+            self.console.info("Restart for %s not issued, the restarter merged it (%s)" % \
+                (",".join(reasons), uri))
+        else:
+            self.console.error("Restart for %s failed after %.1fs (%s)" % \
+                (",".join(reasons), duration, uri))
+        for listener in self.listeners:
+            try:
+                listener(*outcome)
+            except Exception as e:
+                self.console.error("Restart listener failed: %s" % e)
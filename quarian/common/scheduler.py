@@ -0,0 +1,138 @@
+"""
+    Scheduler
+    Per-node polling intervals on a priority queue.
+"""
+
+import heapq
+import random
+import threading
+import time
+
+
+class Scheduler(object):
+    """Keeps a next-due time for every node. A node that comes back healthy
+    has its interval stretched by `backoff_factor`, up to `max_interval`.
+    A node that is unhealthy, or that a check flagged with tighten(), drops
+    straight to `min_interval`. Every due time is jittered so nodes drift
+    apart instead of being polled in lockstep."""
+
+    base_interval = 30
+    min_interval = 5
+    max_interval = 120
+    backoff_factor = 1.5
+    jitter = 0.1
+
+    def __init__(self, base_interval=None, min_interval=None, max_interval=None,
+            backoff_factor=None, jitter=None):
+        if base_interval is not None:
+            self.base_interval = float(base_interval)
+        if min_interval is not None:
+            self.min_interval = float(min_interval)
+        if max_interval is not None:
+            self.max_interval = float(max_interval)
+        if backoff_factor is not None:
+            self.backoff_factor = float(backoff_factor)
+        if jitter is not None:
+            self.jitter = float(jitter)
+        self.min_interval = min(self.min_interval, self.base_interval)
+        self.max_interval = max(self.max_interval, self.base_interval)
+        self.heap = []
+        self.due_at = {}
+        self.intervals = {}
+        self.attention = set()
+        self.lock = threading.Lock()
+
+
+    def configure(self, base_interval, min_interval, max_interval, backoff_factor, jitter):
+        """Change the intervals in place, e.g. on a settings reload. Nodes
+        keep their schedule; their intervals are clamped to the new range."""
+        with self.lock:
+            self.base_interval = float(base_interval)
+            self.min_interval = min(float(min_interval), self.base_interval)
+            self.max_interval = max(float(max_interval), self.base_interval)
+            self.backoff_factor = float(backoff_factor)
+            self.jitter = float(jitter)
+            for uri, interval in self.intervals.items():
+                self.intervals[uri] = min(self.max_interval, max(self.min_interval, interval))
+
+
+    def add(self, uri, now=None):
+        """Schedule a new node somewhere within its first interval."""
+        now = time.time() if now is None else now
+        with self.lock:
+            if uri in self.intervals:
+                return
+            self.intervals[uri] = self.base_interval
+            self._push(uri, now + random.uniform(0, self.base_interval))
+
+
+    def remove(self, uri):
+        with self.lock:
+            self.intervals.pop(uri, None)
+            self.due_at.pop(uri, None)
+            self.attention.discard(uri)
+
+
+    def pop_due(self, now=None):
+        """Remove and return every node due by `now`. Popped nodes are not
+        scheduled again until report() is called for them."""
+        now = time.time() if now is None else now
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                when, uri = heapq.heappop(self.heap)
+                if self.due_at.get(uri) != when:
+                    # superseded or removed
+                    continue
+                del self.due_at[uri]
+                due.append((uri, now - when))
+        return due
+
+
+    def next_due(self):
+        """Earliest due time, or None if nothing is scheduled."""
+        with self.lock:
+            while self.heap and self.due_at.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            return self.heap[0][0] if self.heap else None
+
+
+    def tighten(self, uri):
+        """Poll `uri` at the minimum interval after its current poll."""
+        with self.lock:
+            self.attention.add(uri)
+            when = self.due_at.get(uri)
+            if when is not None and when > time.time() + self.min_interval:
+                # already waiting out a long interval, pull it in
+                self.intervals[uri] = self.min_interval
+                self._push(uri, time.time() + self._jittered(self.min_interval))
+
+
+    def report(self, uri, healthy, now=None):
+        """Record the outcome of a poll and schedule the next one."""
+        now = time.time() if now is None else now
+        with self.lock:
+            if uri not in self.intervals:
+                return
+            if uri in self.attention:
+                self.attention.discard(uri)
+                healthy = False
+            if healthy:
+                interval = min(self.max_interval, self.intervals[uri] * self.backoff_factor)
+            else:
+                interval = self.min_interval
+            self.intervals[uri] = interval
+            self._push(uri, now + self._jittered(interval))
+
+
+    def interval(self, uri):
+        return self.intervals.get(uri)
+
+
+    def _jittered(self, interval):
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+    def _push(self, uri, when):
+        self.due_at[uri] = when
+        heapq.heappush(self.heap, (when, uri))
@@ -0,0 +1,221 @@
+"""
+    Shard
+    Splits the nodelist across worker processes or cooperating instances.
+"""
+
+import bisect
+import hashlib
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+
+
+class HashRing(object):
+    """Consistent hash ring over shard numbers. Each shard owns `vnodes`
+    points on the ring, so changing the shard count only moves the nodes
+    that land on the added or removed shard's points."""
+
+    vnodes = 128
+
+    def __init__(self, shard_count, vnodes=None):
+        if vnodes is not None:
+            self.vnodes = int(vnodes)
+        self.points = []
+        self.owners = []
+        ring = []
+        for shard in range(shard_count):
+            for vnode in range(self.vnodes):
+                ring.append((self._hash("shard-%d-%d" % (shard, vnode)), shard))
+        ring.sort()
+        for point, shard in ring:
+            self.points.append(point)
+            self.owners.append(shard)
+
+    def shard_for(self, key):
+        i = bisect.bisect(self.points, self._hash(key)) % len(self.points)
+        return self.owners[i]
+
+    def _hash(self, key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+def shard_nodes(nodes, shard_index, shard_count):
+    """The nodes from `nodes` owned by shard `shard_index` of `shard_count`."""
+    if shard_count <= 1:
+        return list(nodes)
+    ring = HashRing(shard_count)
+    return [node for node in nodes if ring.shard_for(node) == shard_index]
+
+
+class SharedTip(object):
+    """Chain tip published by the supervisor process into shared memory,
+    so shards read it instead of each running their own tip fetches."""
+
+    def __init__(self, ctx):
+        self.block = ctx.Value('q', 0, lock=False)
+        self.updated = ctx.Value('d', 0.0, lock=False)
+        self.provider = ctx.Array('c', 32, lock=False)
+        self.lock = ctx.Lock()
+
+    def publish(self, block, provider):
+        with self.lock:
+            self.block.value = int(block)
+            self.provider.value = provider.encode('utf-8')[:31]
+            self.updated.value = time.time()
+
+    def read(self, max_age):
+        """Returns (block, provider), or None if nothing fresh was published."""
+        with self.lock:
+            if self.updated.value == 0 or time.time() - self.updated.value > max_age:
+                return None
+            return (self.block.value, self.provider.value.decode('utf-8'))
+
+
+class RestartSlots(object):
+    """Nodes restarting in each shard, kept in shared memory so the
+    restart rollout limit holds across the fleet rather than per shard."""
+
+    def __init__(self, ctx, shard_count):
+        self.counts = ctx.Array('i', int(shard_count), lock=False)
+        self.lock = ctx.Lock()
+
+    def take(self, shard, capacity):
+        """Claim a slot for `shard` unless `capacity` nodes are already
+        restarting fleet-wide. Returns whether it got one."""
+        with self.lock:
+            if sum(self.counts) >= capacity:
+                return False
+            self.counts[shard] += 1
+            return True
+
+    def release(self, shard):
+        with self.lock:
+            if self.counts[shard] > 0:
+                self.counts[shard] -= 1
+
+    def total(self):
+        with self.lock:
+            return sum(self.counts)
+
+    def reset(self, shard):
+        """Free the slots of a shard that died."""
+        with self.lock:
+            self.counts[shard] = 0
+
+
+def run_worker(args, shard_index, shard_count, shared_tip, reports, restart_slots):
+    """Process entry point for one shard."""
+    from .core import Quarian
+    args.shard_index = shard_index
+    args.shard_count = shard_count
+    q = Quarian(args, shared_tip=shared_tip, reports=reports, restart_slots=restart_slots)
+    q.check_every()
+
+
+class ShardSupervisor(object):
+    """Runs `shard_count` worker processes, each polling its slice of the
+    nodelist. The supervisor fetches the chain tip for all of them, merges
+    their metrics into its own /metrics endpoint, shares the restart
+    rollout limit between them, logs a fleet summary, and restarts
+    workers that die. A SIGHUP reloads settings here and is
+    passed on to every worker."""
+
+    def __init__(self, core, args, shard_count):
+        self.core = core
+        self.console = core.console
+        self.args = args
+        self.shard_count = int(shard_count)
+        self.ctx = multiprocessing.get_context('spawn')
+        self.shared_tip = SharedTip(self.ctx)
+        self.restart_slots = RestartSlots(self.ctx, self.shard_count)
+        self.reports = self.ctx.Queue()
+        self.workers = {}
+        self.summaries = {}
+
+
+    def run(self):
+        for index in range(self.shard_count):
+            self._spawn(index)
+        publisher = threading.Thread(target=self._publish_tip,
+            name='quarian-tip-publisher', daemon=True)
+        publisher.start()
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self._forward_reload)
+
+        interval = int(self.core.check_every_seconds)
+        last_summary = time.time()
+        while True:
+            self._drain_reports(1)
+            for index, proc in list(self.workers.items()):
+                if not proc.is_alive():
+                    self.console.error("Shard %d exited with code %s, restarting" % \
+                        (index, proc.exitcode))
+                    self._spawn(index)
+            if self.core.reload_requested:
+                self.core.reload_requested = False
+                self.core.reload_settings()
+            if time.time() - last_summary >= interval:
+                last_summary = time.time()
+                self._log_summary()
+
+
+    def _forward_reload(self, signum, frame):
+        self.core.reload_requested = True
+        for proc in list(self.workers.values()):
+            if proc.is_alive():
+                os.kill(proc.pid, signal.SIGHUP)
+
+
+    def _spawn(self, index):
+        # a replaced worker starts with no restarts in flight
+        self.restart_slots.reset(index)
+        proc = self.ctx.Process(target=run_worker,
+            args=(self.args, index, self.shard_count, self.shared_tip, self.reports,
+                self.restart_slots),
+            name='quarian-shard-%d' % index, daemon=True)
+        proc.start()
+        self.workers[index] = proc
+        self.console.info("Started shard %d/%d (pid %d)" % (index + 1, self.shard_count, proc.pid))
+
+
+    def _publish_tip(self):
+        while True:
+            try:
+                # the supervisor polls no nodes, so local sources like
+                # 'fleet' are left to the shards
+                sources = self.core.oracle.remote_sources()
+                if sources:
+                    block, provider = self.core.oracle.get_highest_known_block(sources)
+                    if provider != 'failure':
+                        self.shared_tip.publish(block, provider)
+            except Exception as e:
+                self.console.error("Publishing chain tip failed: %s" % e)
+            time.sleep(self.core.oracle.ttl_seconds)
+
+
+    def _drain_reports(self, timeout):
+        try:
+            report = self.reports.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while report is not None:
+            shard = report['shard']
+            self.core.metrics.set_remote(shard, report['metrics'])
+            self.summaries[shard] = report
+            try:
+                report = self.reports.get_nowait()
+            except queue.Empty:
+                report = None
+
+
+    def _log_summary(self):
+        nodes = sum([s['nodes'] for s in self.summaries.values()])
+        busy = sum([s['busy'] for s in self.summaries.values()])
+        restarting = sum([s['restarting'] for s in self.summaries.values()])
+        self.console.info("Fleet: %d nodes on %d/%d reporting shards, %d polls running, " \
+            "%d restarts pending, %d nodes restarting" % \
+            (nodes, len(self.summaries), self.shard_count, busy, restarting,
+            self.restart_slots.total()))
@@ -0,0 +1,95 @@
+"""
+    Snapshot
+    One JSON-RPC batch per node per cycle, shared by every check.
+"""
+
+import time
+
+from .clients import RPCError
+
+
+class NodeSnapshot(object):
+    """The results of one batched round trip to a node. Exposes the same
+    call(method) interface as NodeClient, so checks can read from either.
+    A transport failure is stored and re-raised from call(), which lets
+    checks keep handling ConnectionError and Timeout as they always have."""
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.results = {}
+        self.errors = {}
+        self.status_code = None
+        self.error = None
+        self.latency = None
+        self.taken_at = time.time()
+
+
+    def call(self, method, params=None):
+        if self.error is not None:
+            raise self.error
+        if method in self.errors:
+            raise self.errors[method]
+        if method not in self.results:
+            raise RPCError("%s was not collected in this snapshot" % method)
+        return self.results[method]
+
+
+    def has(self, method):
+        return self.error is None and method in self.results
+
+
+def take_snapshot(client, methods):
+    """Collect `methods` from the node behind `client` in a single batch.
+    Falls back to one call per method if the node rejects batches; the
+    calls share the node's deadline, see NodeClientRegistry.set_deadline."""
+    snapshot = NodeSnapshot(client.uri)
+    if not methods:
+        return snapshot
+
+    ids = {}
+    payload = []
+    for i, method in enumerate(methods):
+        ids[i] = method
+        payload.append({ 'jsonrpc': '2.0', 'method': method, 'params': [], 'id': i })
+
+    started = time.time()
+    try:
+        res = client.post(payload)
+    except Exception as e:
+        snapshot.error = e
+        return snapshot
+    finally:
+        snapshot.latency = time.time() - started
+    snapshot.status_code = res.status_code
+
+    try:
+        body = res.json()
+    except ValueError:
+        snapshot.error = RPCError("Node returned HTTP %d with a non-JSON body" % res.status_code)
+        return snapshot
+
+    if not isinstance(body, list):
+        # batches unsupported (or an error from a proxy), ask one at a time
+        for method in methods:
+            try:
+                snapshot.results[method] = client.call(method)
+            except RPCError as e:
+                snapshot.errors[method] = e
+            except Exception as e:
+                snapshot.error = e
+                break
+        return snapshot
+
+    for item in body:
+        method = ids.get(item.get('id'))
+        if method is None:
+            continue
+        if 'error' in item:
+            snapshot.errors[method] = RPCError("%s failed: %s" % \
+                (method, item['error'].get('message', item['error'])))
+        else:
+            snapshot.results[method] = item.get('result')
+    for method in methods:
+        if method not in snapshot.results and method not in snapshot.errors:
+            snapshot.errors[method] = RPCError("%s missing from batch response" % method)
+    return snapshot
@@ -0,0 +1,290 @@
+"""
+    Sources
+    Chain tip sources for the oracle, each with its own circuit breaker
+    and latency statistics.
+"""
+
+import threading
+import time
+
+import requests
+
+
+class CircuitBreaker(object):
+    """Opens after `failure_threshold` consecutive failures, so a source
+    that is down stops being asked. Once `cooldown_seconds` have passed a
+    single probe is let through: success closes the breaker, failure opens
+    it again for twice as long, up to `max_cooldown_seconds`."""
+
+    failure_threshold = 3
+    cooldown_seconds = 60
+    max_cooldown_seconds = 900
+
+    def __init__(self, failure_threshold=None, cooldown_seconds=None):
+        if failure_threshold is not None:
+            self.failure_threshold = int(failure_threshold)
+        if cooldown_seconds is not None:
+            self.cooldown_seconds = float(cooldown_seconds)
+        self.failures = 0
+        self.opened_at = None
+        self.cooldown = self.cooldown_seconds
+        self.probing = False
+        self.lock = threading.Lock()
+
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'half-open' if self.probing else 'open'
+
+
+    def allow(self, now=None):
+        """True if a request may be sent now. Claims the probe when the
+        cooldown is over, so only one caller gets to try."""
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or now - self.opened_at < self.cooldown:
+                return False
+            self.probing = True
+            return True
+
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+            self.cooldown = self.cooldown_seconds
+
+
+    def record_failure(self, now=None):
+        """Returns True if this failure opened the breaker."""
+        now = time.time() if now is None else now
+        with self.lock:
+            self.failures += 1
+            if self.probing:
+                self.probing = False
+                self.opened_at = now
+                self.cooldown = min(self.max_cooldown_seconds, self.cooldown * 2)
+                return True
+            if self.opened_at is None and self.failures >= self.failure_threshold:
+                self.opened_at = now
+                return True
+            return False
+
+
+class TipSource(object):
+    """A place to learn the chain tip from. Subclasses implement _fetch(),
+    returning a block number or False. fetch() times every call, keeps
+    latency statistics and feeds the breaker."""
+
+    name = None
+    # weight of the newest sample in the latency average
+    latency_alpha = 0.2
+    # local sources cost nothing to ask, so they get no breaker and are
+    # asked again right after a failure
+    local = False
+
+    def __init__(self, core, breaker=None, timeout=5):
+        self.core = core
+        self.console = core.console
+        self.metrics = getattr(core, 'metrics', None)
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.timeout = timeout
+        self.latency = None
+        self.last_latency = None
+        self.successes = 0
+        self.failures = 0
+        self.last_error = None
+        self.lock = threading.Lock()
+
+
+    def fetch(self):
+        started = time.time()
+        error = None
+        try:
+            res = self._fetch()
+        except Exception as e:
+            res = False
+            error = e
+        elapsed = time.time() - started
+        ok = res is not False and res is not None
+        with self.lock:
+            self.last_latency = elapsed
+            if ok:
+                self.successes += 1
+                self.latency = elapsed if self.latency is None else \
+                    self.latency + self.latency_alpha * (elapsed - self.latency)
+            else:
+                self.failures += 1
+                self.last_error = str(error) if error is not None else "no block returned"
+        if self.metrics is not None:
+            self.metrics.tip_source_duration.observe(elapsed, source=self.name)
+            if not ok:
+                self.metrics.tip_source_errors.inc(source=self.name)
+        if ok:
+            self.breaker.record_success()
+            return int(res)
+        if not self.local and self.breaker.record_failure():
+            self.console.warn("Chain tip source %s failed %d times, not asking it for %ds (%s)" % \
+                (self.name, self.breaker.failures, self.breaker.cooldown, self.last_error))
+        if error is not None:
+            raise error
+        return False
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                'latency': self.latency,
+                'last_latency': self.last_latency,
+                'successes': self.successes,
+                'failures': self.failures,
+                'last_error': self.last_error,
+                'breaker': self.breaker.state
+            }
+
+
+    def _fetch(self):
+        raise NotImplementedError("Chain tip sources must implement _fetch.")
+
+
+class EtherscanSource(TipSource):
+
+    name = 'etherscan'
+
+    def _fetch(self):
+        """Get the highest block from etherscan"""
+        core = self.core
+        res = requests.get(core.etherscan_api_uri,
+            data={ 'module': 'proxy', 'action':
+                'eth_blockNumber',
+                'apikey': core.etherscan_api_key },
+            headers= { 'user-agent': core.user_agent },
+            timeout=self.timeout)
+
+        if res.status_code == 200 and res.json():
+            try:
+                return int(res.json()['result'], 16)
+            except KeyError:
+                return False
+        return False
+
+
+class EtherchainSource(TipSource):
+
+    name = 'etherchain'
+
+    def _fetch(self):
+        """Get the highest block from etherchain.org as nicely as possible"""
+        core = self.core
+        res = requests.get(core.etherchain_api_uri,
+            headers = { 'user-agent': core.user_agent },
+            timeout=self.timeout)
+        if res.status_code == 200:
+            try:
+                return res.json()['recordsTotal']
+            except KeyError:
+                return False
+        return False
+
+
+class InfuraSource(TipSource):
+
+    name = 'infura'
+
+    def _fetch(self):
+        """Get the highest known block from Consensys Infura"""
+        core = self.core
+        infura_uri = core.infura_api_uri % (core.infura_api_key)
+        try:
+            number = core.clients.get(infura_uri).call('eth_blockNumber')
+            return int(number, 16)
+        except Exception:
+            self.console.error("Could not retrieve from Infura.")
+        return False
+
+
+class GethSource(TipSource):
+
+    name = 'geth'
+
+    def _fetch(self):
+        """Get the highest block from the local geth, the highest known
+        if geth is still syncing. Note that this is likely not going to
+        be tracking the true highest if you are just syncing or geth
+        is really far behind."""
+        core = self.core
+        head = core.heads.head(core.reference_node)
+        if head is not None:
+            return head
+        try:
+            reference = core.clients.get(core.reference_node)
+            syncing = reference.call('eth_syncing')
+            if syncing is False:
+                return int(reference.call('eth_blockNumber'), 16)
+            else:
+                return int(syncing['highestBlock'], 16)
+        except requests.ConnectionError:
+            self.console.error("Can't connect to canonical geth.")
+        return False
+
+
+class FleetSource(TipSource):
+    """The chain tip as seen by the monitored nodes themselves: the
+    `fleet_tip_quorum`-th highest head among nodes with a height sample
+    from the last `fleet_tip_max_age_seconds`. Requiring several nodes to
+    have reached a height keeps one node on a bad fork from setting the
+    tip. Costs no requests, but can't tell if the whole fleet is stuck,
+    so pair it with an external source."""
+
+    name = 'fleet'
+    local = True
+
+    def _fetch(self):
+        core = self.core
+        quorum = max(1, int(core.fleet_tip_quorum))
+        oldest = time.time() - core.fleet_tip_max_age_seconds
+        heights = []
+        for uri in core.nodes:
+            head = core.heads.head(uri)
+            if head is not None:
+                heights.append(head)
+                continue
+            sample = core.history.latest(uri, 'height')
+            if sample is not None and sample[0] >= oldest:
+                heights.append(int(sample[1]))
+        if len(heights) < quorum:
+            self.console.debug("Fleet tip needs %d fresh node heads, have %d", quorum, len(heights))
+            return False
+        heights.sort(reverse=True)
+        return heights[quorum - 1]
+
+
+SOURCES = {
+    'etherscan': EtherscanSource,
+    'etherchain': EtherchainSource,
+    'infura': InfuraSource,
+    'geth': GethSource,
+    'fleet': FleetSource
+}
+
+
+def register_source(name, cls):
+    """Make a TipSource subclass available to get_highest_from as `name`."""
+    SOURCES[name] = cls
+    return cls
+
+
+def build_sources(core, failure_threshold=None, cooldown_seconds=None, timeout=5):
+    """One instance of every registered source, keyed by name."""
+    built = {}
+    for name, cls in SOURCES.items():
+        source = cls(core, CircuitBreaker(failure_threshold, cooldown_seconds), timeout)
+        source.name = name
+        built[name] = source
+    return built
@@ -0,0 +1,182 @@
+"""
+    State
+    Compact per-node state shared by every check.
+"""
+
+import threading
+
+from array import array
+
+# marks an unset value; state values are timestamps and counters, never NaN
+UNSET = float('nan')
+
+
+class NodeStateStore(object):
+    """Column store of per-node floats keyed by node URI. Each node gets a
+    slot number, and each field is one array('d') indexed by slot, so a
+    field costs 8 bytes per node however large the fleet grows. Slots of
+    forgotten nodes are reused."""
+
+    def __init__(self):
+        self.slots = {}
+        self.free = []
+        self.columns = {}
+        self.size = 0
+        self.lock = threading.RLock()
+
+
+    def namespace(self, prefix, fields):
+        """Returns a CheckState view for `fields`, stored as `prefix.field`."""
+        with self.lock:
+            for field in fields:
+                self._column("%s.%s" % (prefix, field))
+        return CheckState(self, prefix)
+
+
+    def get(self, uri, name, default=None):
+        slot = self.slots.get(uri)
+        column = self.columns.get(name)
+        if slot is None or column is None:
+            return default
+        value = column[slot]
+        if value != value:
+            return default
+        return value
+
+
+    def set(self, uri, name, value):
+        """Store `value` for `uri`. Setting None clears the field."""
+        with self.lock:
+            slot = self._slot(uri)
+            self._column(name)[slot] = UNSET if value is None else value
+
+
+    def setdefault(self, uri, name, value):
+        """Store `value` unless a value is already set. Returns the value."""
+        with self.lock:
+            current = self.get(uri, name)
+            if current is None:
+                self.set(uri, name, value)
+                return value
+            return current
+
+
+    def nodes(self):
+        with self.lock:
+            return list(self.slots)
+
+
+    def slots_for(self, uris):
+        """Slot numbers of `uris`, as a NumPy index array for gather() and
+        scatter(). Nodes without a slot get one."""
+        import numpy
+        with self.lock:
+            return numpy.array([self._slot(uri) for uri in uris], dtype=numpy.intp)
+
+
+    def gather(self, name, slots):
+        """A NumPy copy of field `name` for `slots`, NaN where unset."""
+        import numpy
+        with self.lock:
+            column = numpy.frombuffer(self._column(name), dtype=numpy.float64)
+            values = column[slots]
+            # drop the view now: an array exporting its buffer can't grow
+            del column
+        return values
+
+
+    def scatter(self, name, slots, values):
+        """Write `values` (an array or a scalar, NaN to clear) into field
+        `name` for `slots`."""
+        import numpy
+        with self.lock:
+            column = numpy.frombuffer(self._column(name), dtype=numpy.float64)
+            column[slots] = values
+            del column
+
+
+    def export(self):
+        """Copy of the whole store as (uri of every slot, None if free,
+        {field: column bytes}), e.g. for a checkpoint. Holds the lock for
+        one memory copy per field."""
+        with self.lock:
+            nodes = [None] * self.size
+            for uri, slot in self.slots.items():
+                nodes[slot] = uri
+            return nodes, dict((name, column.tobytes()) for name, column in self.columns.items())
+
+
+    def restore(self, nodes, columns):
+        """Replace the store's contents with what export() returned."""
+        with self.lock:
+            self.size = len(nodes)
+            self.slots = dict((uri, slot) for slot, uri in enumerate(nodes) if uri is not None)
+            self.free = [slot for slot, uri in enumerate(nodes) if uri is None]
+            self.columns = {}
+            for name, raw in columns.items():
+                column = array('d')
+                column.frombytes(raw)
+                if len(column) != self.size:
+                    raise ValueError("Field %s has %d values for %d slots" % \
+                        (name, len(column), self.size))
+                self.columns[name] = column
+
+
+    def forget(self, uri):
+        """Drop every field of `uri` and free its slot."""
+        with self.lock:
+            slot = self.slots.pop(uri, None)
+            if slot is None:
+                return
+            for column in self.columns.values():
+                column[slot] = UNSET
+            self.free.append(slot)
+
+
+    def _slot(self, uri):
+        slot = self.slots.get(uri)
+        if slot is not None:
+            return slot
+        if self.free:
+            slot = self.free.pop()
+        else:
+            slot = self.size
+            self.size += 1
+            for column in self.columns.values():
+                column.append(UNSET)
+        self.slots[uri] = slot
+        return slot
+
+
+    def _column(self, name):
+        column = self.columns.get(name)
+        if column is None:
+            column = array('d', [UNSET]) * self.size
+            self.columns[name] = column
+        return column
+
+
+class CheckState(object):
+    """A check's view of the store. Fields are addressed by their short
+    name; the check's prefix keeps them apart from other checks."""
+
+    __slots__ = ('store', 'prefix')
+
+    def __init__(self, store, prefix):
+        self.store = store
+        self.prefix = prefix
+
+    def get(self, uri, field, default=None):
+        return self.store.get(uri, "%s.%s" % (self.prefix, field), default)
+
+    def set(self, uri, field, value):
+        self.store.set(uri, "%s.%s" % (self.prefix, field), value)
+
+    def setdefault(self, uri, field, value):
+        return self.store.setdefault(uri, "%s.%s" % (self.prefix, field), value)
+
+    def gather(self, field, slots):
+        return self.store.gather("%s.%s" % (self.prefix, field), slots)
+
+    def scatter(self, field, slots, values):
+        self.store.scatter("%s.%s" % (self.prefix, field), slots, values)
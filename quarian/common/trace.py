@@ -0,0 +1,197 @@
+"""
+    Trace
+    Append-only record of what the core saw from nodes and chain tip
+    sources, for replaying through the checks later.
+"""
+
+import gzip
+import json
+import threading
+import time
+
+import requests
+
+from .clients import RPCError
+from .snapshot import NodeSnapshot
+
+TRACE_VERSION = 1
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+class TraceWriter(object):
+    """Writes one JSON array per line, `[timestamp, kind, ...]`:
+
+        [ts, "n", id, uri]                  node id, before its first use
+        [ts, "s", id, latency, status, error, results, errors]
+                                            a snapshot; error is None,
+                                            "timeout", "connection" or a message
+        [ts, "c", id, method, params, result]
+                                            a call outside the snapshot
+        [ts, "h", id, number]               a subscribed head
+        [ts, "t", block, provider]          the chain tip, when it changes
+        [ts, "r", id, reasons]              checks asked for a restart
+
+    Every run starts with a `["quarian-trace", version, ts, meta]` header,
+    where meta holds what a replay needs to read the trace the same way,
+    like the reference node. Node URIs are written once and referred to by
+    id after that. A path
+    ending in .gz is gzip compressed. Nothing is opened until the first
+    record, and lines are flushed every `flush_seconds`, so a crash loses
+    at most that much and a truncated last line is skipped on reading."""
+
+    flush_seconds = 1.0
+
+    def __init__(self, path, meta=None):
+        self.path = path
+        self.meta = meta or {}
+        self.file = None
+        self.ids = {}
+        self.last_tip = None
+        self.last_flush = 0
+        self.lock = threading.Lock()
+
+
+    def snapshot(self, snapshot):
+        error = snapshot.error
+        if error is None:
+            kind = None
+        elif isinstance(error, requests.Timeout):
+            kind = 'timeout'
+        elif isinstance(error, requests.ConnectionError):
+            kind = 'connection'
+        else:
+            kind = str(error) or error.__class__.__name__
+        latency = round(snapshot.latency, 6) if snapshot.latency is not None else None
+        errors = dict((method, str(e)) for method, e in snapshot.errors.items())
+        self._write(snapshot.taken_at, 's', snapshot.uri, latency, snapshot.status_code, kind,
+            snapshot.results, errors)
+
+
+    def call(self, uri, method, params, result):
+        self._write(time.time(), 'c', uri, method, params or [], result)
+
+
+    def head(self, uri, number, ts=None):
+        self._write(ts if ts is not None else time.time(), 'h', uri, number)
+
+
+    def tip(self, block, provider):
+        """Written only when it differs from the last tip written."""
+        tip = (block, provider)
+        if tip == self.last_tip:
+            return
+        self.last_tip = tip
+        self._write_record([round(time.time(), 3), 't', block, provider])
+
+
+    def restart(self, uri, reasons):
+        self._write(time.time(), 'r', uri, list(reasons))
+
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+                self.last_flush = time.time()
+
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+    def _write(self, ts, kind, uri, *fields):
+        with self.lock:
+            node = self.ids.get(uri)
+            if node is None:
+                node = len(self.ids)
+                self.ids[uri] = node
+                self._line([round(ts, 3), 'n', node, uri])
+            self._line([round(ts, 3), kind, node] + list(fields))
+
+
+    def _write_record(self, record):
+        with self.lock:
+            self._line(record)
+
+
+    def _line(self, record):
+        """Called with the lock held."""
+        if self.file is None:
+            self.file = _open(self.path, 'a')
+            self.file.write(json.dumps(['quarian-trace', TRACE_VERSION, round(time.time(), 3),
+                self.meta]) + "\n")
+        self.file.write(json.dumps(record, separators=(',', ':')) + "\n")
+        now = time.time()
+        if now - self.last_flush >= self.flush_seconds:
+            self.file.flush()
+            self.last_flush = now
+
+
+class TraceReader(object):
+    """Iterates a trace as (timestamp, kind, uri, fields) in file order,
+    with node ids resolved back to URIs (uri is None for tips). A trace
+    appended to by several runs is read as one; `meta` is the header of
+    the run being read."""
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = {}
+
+
+    def __iter__(self):
+        nodes = {}
+        with _open(self.path, 'r') as f:
+            while True:
+                try:
+                    line = f.readline()
+                except (EOFError, OSError):
+                    # a gzip stream cut short by a crash
+                    return
+                if not line:
+                    return
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line of a trace that was still being written
+                    continue
+                if record[0] == 'quarian-trace':
+                    if record[1] > TRACE_VERSION:
+                        raise ValueError("Trace %s is version %d, this Quarian reads up to %d" % \
+                            (self.path, record[1], TRACE_VERSION))
+                    self.meta = record[3] if len(record) > 3 else {}
+                    nodes = {}
+                    continue
+                ts, kind = record[0], record[1]
+                if kind == 'n':
+                    nodes[record[2]] = record[3]
+                elif kind == 't':
+                    yield (ts, kind, None, record[2:])
+                else:
+                    yield (ts, kind, nodes[record[2]], record[3:])
+
+
+def rebuild_snapshot(uri, ts, fields):
+    """The NodeSnapshot a "s" record was written from, close enough for
+    checks: transport errors come back as the same requests exceptions."""
+    latency, status_code, error, results, errors = fields
+    snapshot = NodeSnapshot(uri)
+    snapshot.taken_at = ts
+    snapshot.latency = latency
+    snapshot.status_code = status_code
+    snapshot.results = results
+    snapshot.errors = dict((method, RPCError(message)) for method, message in errors.items())
+    if error == 'timeout':
+        snapshot.error = requests.Timeout("Timed out (recorded)")
+    elif error == 'connection':
+        snapshot.error = requests.ConnectionError("Connection failed (recorded)")
+    elif error is not None:
+        snapshot.error = RPCError(error)
+    return snapshot